@@ -26,6 +26,8 @@ class Authentication(MetaObject):
         The implementation of an Authentication policy.
         """
 
+        __slots__ = []
+
         @property
         def is_signed(self):
             """
@@ -66,6 +68,8 @@ class NoAuthentication(Authentication):
     gossiping purposes.
     """
     class Implementation(Authentication.Implementation):
+        __slots__ = []
+
         @property
         def is_signed(self):
             return True
@@ -91,6 +95,8 @@ class MemberAuthentication(Authentication):
     give you this permission in the form of a signed message.
     """
     class Implementation(Authentication.Implementation):
+        __slots__ = ["_member", "_is_signed"]
+
         def __init__(self, meta, member, is_signed=False):
             """
             Initialize a new MemberAuthentication.Implementation instance.
@@ -198,6 +204,8 @@ class DoubleMemberAuthentication(Authentication):
     forwarded to other nodes in the community.
     """
     class Implementation(Authentication.Implementation):
+        __slots__ = ["_members", "_regenerate_packet_func", "_signatures"]
+
         def __init__(self, meta, members, signatures=[]):
             """
             Initialize a new DoubleMemberAuthentication.Implementation instance.
@@ -284,7 +292,7 @@ class DoubleMemberAuthentication(Authentication):
         def is_signed(self):
             return all(self._signatures)
 
-        def set_signature(self, member, signature):
+        def set_signature(self, member, signature, regenerate_packet=True):
             """
             Set a verified signature for a specific member.
 
@@ -296,12 +304,18 @@ class DoubleMemberAuthentication(Authentication):
 
             @param signature: The signature for this message.
             @type signature: string
+
+            @param regenerate_packet: When True the packet is encoded again to include the new
+             signature.  Must be False when the signature is set while the packet is being encoded.
+            @type regenerate_packet: bool
             """
             #todo: verify the signature
             assert member in self._members
             assert member.signature_length == len(signature)
+            assert isinstance(regenerate_packet, bool)
             self._signatures[self._members.index(member)] = signature
-            self._regenerate_packet_func()
+            if regenerate_packet:
+                self._regenerate_packet_func()
 
         def setup(self, message_impl):
             if __debug__:
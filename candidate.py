@@ -1,3 +1,13 @@
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
+
+try:
+    # python 2.7 only...
+    from collections import OrderedDict
+except ImportError:
+    from .python27_ordereddict import OrderedDict
+
 if __debug__:
     from .dprint import dprint
     from .member import Member
@@ -26,14 +36,18 @@ CANDIDATE_WALK_LIFETIME = 57.5
 CANDIDATE_STUMBLE_LIFETIME = 57.5
 CANDIDATE_INTRO_LIFETIME = 27.5
 CANDIDATE_LIFETIME = 180.0
+CANDIDATE_EXPIRY_RESOLUTION = 1.0
 assert isinstance(CANDIDATE_ELIGIBLE_DELAY, float)
 assert isinstance(CANDIDATE_ELIGIBLE_BOOTSTRAP_DELAY, float)
 assert isinstance(CANDIDATE_WALK_LIFETIME, float)
 assert isinstance(CANDIDATE_STUMBLE_LIFETIME, float)
 assert isinstance(CANDIDATE_INTRO_LIFETIME, float)
 assert isinstance(CANDIDATE_LIFETIME, float)
+assert isinstance(CANDIDATE_EXPIRY_RESOLUTION, float)
 
 class Candidate(object):
+    __slots__ = ["_sock_addr", "_tunnel"]
+
     def __init__(self, sock_addr, tunnel):
         assert is_address(sock_addr), sock_addr
         assert isinstance(tunnel, bool), type(tunnel)
@@ -84,7 +98,13 @@ class WalkCandidate(Candidate):
 
     - INTRO: we know about this candidate through hearsay.  Viable up to CANDIDATE_INACTIVE seconds
       after the introduction-response message (talking about the candidate) was received.
+
+    Trackers keep hundreds of thousands of candidates, hence candidates use __slots__, equal
+    addresses share one tuple, and the association and global time containers are only created
+    when needed.
     """
+    __slots__ = ["_lan_address", "_wan_address", "_connection_type", "_associations", "_timestamps", "_global_times"]
+
     class Timestamps(object):
         __slots__ = ["timeout_adjustment", "last_walk", "last_stumble", "last_intro"]
 
@@ -109,12 +129,14 @@ class WalkCandidate(Candidate):
         assert isinstance(connection_type, unicode) and connection_type in (u"unknown", u"public", u"symmetric-NAT")
 
         super(WalkCandidate, self).__init__(sock_addr, tunnel)
-        self._lan_address = lan_address
-        self._wan_address = wan_address
+        self._lan_address = sock_addr if lan_address == sock_addr else lan_address
+        self._wan_address = sock_addr if wan_address == sock_addr else wan_address
         self._connection_type = connection_type
-        self._associations = set()
+        # set with (cid, Member) tuples, an empty tuple until the first association
+        self._associations = ()
         self._timestamps = dict()
-        self._global_times = dict()
+        # dictionary with cid:global_time pairs, None until the first global time is set
+        self._global_times = None
 
         if __debug__:
             if not (self.sock_addr == self._lan_address or self.sock_addr == self._wan_address):
@@ -139,28 +161,43 @@ class WalkCandidate(Candidate):
 
     def merge(self, other):
         assert isinstance(other, WalkCandidate), other
-        self._associations.update(other._associations)
-        
+        #TODO: this should be improved
+        from .dispersy import Dispersy
+        dispersy = Dispersy.get_instance()
+
+        for cid, member in other._associations:
+            if not (cid, member) in self._associations:
+                if not self._associations:
+                    self._associations = set()
+                self._associations.add((cid, member))
+                community = dispersy._communities.get(cid, None)
+                if community:
+                    community._candidates.associate(self, member)
+
         for cid, timestamps in other._timestamps.iteritems():
             if cid in self._timestamps:
                 self._timestamps[cid].merge(timestamps)
             else:
                 self._timestamps[cid] = timestamps
-                
-                #TODO: this should be improved
-                from .dispersy import Dispersy
-                dispersy = Dispersy.get_instance()
-                community = dispersy._communities.get(cid, None)
+
+            # add the candidate to the community or update its category
+            community = dispersy._communities.get(cid, None)
+            if community:
                 community.add_candidate(self)
-                
-        for cid, global_time in self._global_times.iteritems():
-            self._global_times[cid] = max(self._global_times.get(cid, 0), global_time)
-        
+
+        if other._global_times:
+            if self._global_times is None:
+                self._global_times = {}
+            for cid, global_time in other._global_times.iteritems():
+                self._global_times[cid] = max(self._global_times.get(cid, 0), global_time)
+
     def set_global_time(self, community, global_time):
+        if self._global_times is None:
+            self._global_times = {}
         self._global_times[community.cid] = max(self._global_times.get(community.cid, 0), global_time)
 
     def get_global_time(self, community):
-        return self._global_times.get(community.cid, 0)
+        return self._global_times.get(community.cid, 0) if self._global_times else 0
 
     def _get_or_create_timestamps(self, community):
         if __debug__:
@@ -180,7 +217,10 @@ class WalkCandidate(Candidate):
             from .community import Community
         assert isinstance(community, Community)
         assert isinstance(member, Member)
+        if not self._associations:
+            self._associations = set()
         self._associations.add((community.cid, member))
+        community._candidates.associate(self, member)
 
     def is_associated(self, community, member):
         """
@@ -200,8 +240,11 @@ class WalkCandidate(Candidate):
             from .community import Community
         assert isinstance(community, Community)
         assert isinstance(member, Member)
+        if not (community.cid, member) in self._associations:
+            raise KeyError((community.cid, member))
         self._associations.remove((community.cid, member))
-        if community.cid in self._global_times:
+        community._candidates.disassociate(self, member)
+        if self._global_times and community.cid in self._global_times:
             del self._global_times[community.cid]
 
     def get_members(self, community):
@@ -268,6 +311,7 @@ class WalkCandidate(Candidate):
             timestamps.last_walk = now - CANDIDATE_WALK_LIFETIME
             timestamps.last_stumble = now - CANDIDATE_STUMBLE_LIFETIME
             timestamps.last_intro = now - CANDIDATE_INTRO_LIFETIME
+            community._candidates.refresh(self, now)
 
     def obsolete(self, community, now):
         """
@@ -278,21 +322,27 @@ class WalkCandidate(Candidate):
             timestamps.last_walk = now - CANDIDATE_LIFETIME
             timestamps.last_stumble = now - CANDIDATE_LIFETIME
             timestamps.last_intro = now - CANDIDATE_LIFETIME
+            community._candidates.refresh(self, now)
 
-    def all_inactive(self, now):
+    def all_inactive(self, community, now):
         """
         Called to set SELF to inactive (or keep it at OBSOLETE) for all associated communities.
 
-        This is used when a timeout occurs while waiting for an introduction-response.  We choose to
-        set all communities to inactive to improve churn handling.  Setting the entire candidate to
-        inactive will not remove it and any associated 3-way handshake information.  This is
-        retained until the entire candidate becomes obsolete.
+        This is used when a timeout occurs while waiting for an introduction-response in COMMUNITY.
+        We choose to set all communities to inactive to improve churn handling.  Setting the entire
+        candidate to inactive will not remove it and any associated 3-way handshake information.
+        This is retained until the entire candidate becomes obsolete.
         """
-        for timestamps in self._timestamps.itervalues():
+        communities = community.dispersy._communities
+        for cid, timestamps in self._timestamps.iteritems():
             timestamps.last_walk = now - CANDIDATE_WALK_LIFETIME
             timestamps.last_stumble = now - CANDIDATE_STUMBLE_LIFETIME
             timestamps.last_intro = now - CANDIDATE_INTRO_LIFETIME
 
+            community = communities.get(cid, None)
+            if community:
+                community._candidates.refresh(self, now)
+
     def is_eligible_for_walk(self, community, now):
         """
         Returns True when the candidate is eligible for taking a step.
@@ -357,6 +407,9 @@ class WalkCandidate(Candidate):
         """
         self._get_or_create_timestamps(community).timeout_adjustment = 0.0
 
+        if not isinstance(self, BootstrapCandidate):
+            community.add_candidate(self)
+
     def stumble(self, community, now):
         """
         Called when we receive an introduction-request from this candidate.
@@ -383,9 +436,9 @@ class WalkCandidate(Candidate):
         assert connection_type in (u"unknown", u"public", "symmetric-NAT"), connection_type
         self._tunnel = tunnel
         if lan_address != ("0.0.0.0", 0):
-            self._lan_address = lan_address
+            self._lan_address = self._sock_addr if lan_address == self._sock_addr else lan_address
         if wan_address != ("0.0.0.0", 0):
-            self._wan_address = wan_address
+            self._wan_address = self._sock_addr if wan_address == self._sock_addr else wan_address
         # someone can also reset from a known connection_type to unknown (i.e. it now believes it is
         # no longer public nor symmetric NAT)
         self._connection_type = u"public" if connection_type == u"unknown" and lan_address == wan_address else connection_type
@@ -403,7 +456,397 @@ class WalkCandidate(Candidate):
             # should not occur
             return "{%s:%d %s:%d %s:%d}" % (self._sock_addr[0], self._sock_addr[1], self._lan_address[0], self._lan_address[1], self._wan_address[0], self._wan_address[1])
 
+class CandidateTable(object):
+    """
+    The WalkCandidate instances of one community.
+
+    Candidates are stored in sock_addr:candidate pairs, in the order that they were added.
+    Furthermore, every candidate is indexed by its category in COMMUNITY (u"walk", u"stumble", or
+    u"intro").  The index is updated by WalkCandidate.walk, stumble, and intro (through
+    Community.add_candidate).  Categories also change as time passes, hence the index is corrected
+    whenever a candidate is found in the wrong category.
+
+    Each category keeps a round robin cursor, allowing the next candidate in a category to be
+    obtained in O(1).
+
+    Each category also keeps two heaps used to select walk targets.  The waiting heap orders
+    candidates by the time they become eligible for a walk (CANDIDATE_ELIGIBLE_DELAY after the
+    previous walk).  Once eligible they move to the ready heap, ordered by their last walk,
+    stumble, or intro time.  Entries are pushed whenever a candidate changes and are never
+    updated, only the most recent entry for a candidate is valid.  Outdated entries are discarded
+    once they reach the top of their heap.
+
+    Finally, every candidate is registered in an expiry wheel under the time of its next state
+    transition in COMMUNITY, i.e. when its category changes or when it becomes obsolete.  The
+    wheel has CANDIDATE_EXPIRY_RESOLUTION second slots and is advanced by expire, which only
+    visits the candidates whose transition has passed.
+    """
+    def __init__(self, community):
+        self._community = community
+        # sock_addr:WalkCandidate pairs
+        self._candidates = OrderedDict()
+        # category:[WalkCandidate] pairs, in the order that the candidates entered the category.
+        # removed candidates leave a None behind until the list is compacted
+        self._categories = {u"walk":[], u"stumble":[], u"intro":[]}
+        # category:count pairs, the number of None entries in each category list
+        self._removed = {u"walk":0, u"stumble":0, u"intro":0}
+        # WalkCandidate:index pairs, the position of the candidate in its category list
+        self._positions = {}
+        # category:index pairs, where index is the position of the next round robin candidate
+        self._cursors = {u"walk":0, u"stumble":0, u"intro":0}
+        # WalkCandidate:category pairs
+        self._candidate_categories = {}
+        # category:[(eligible, counter, WalkCandidate, key)] heaps, where eligible is the time
+        # when the candidate can be walked to
+        self._waiting = {u"walk":[], u"stumble":[], u"intro":[]}
+        # category:[(key, counter, WalkCandidate, eligible)] heaps, where key is the time of the
+        # last walk, stumble, or intro
+        self._ready = {u"walk":[], u"stumble":[], u"intro":[]}
+        # breaks ties between heap entries without comparing candidates
+        self._counter = count()
+        # WalkCandidate:(counter, category, key, eligible) pairs describing the valid heap entry
+        self._walk_entries = {}
+        # Member:set([WalkCandidate]) pairs, the candidates associated with each member in this
+        # community
+        self._associations = {}
+        # slot:set([WalkCandidate]) pairs, where slot * CANDIDATE_EXPIRY_RESOLUTION is the time
+        # at which the candidates must be reconsidered
+        self._wheel = {}
+        # WalkCandidate:slot pairs
+        self._expiry_slots = {}
+        # the first slot that expire has not yet processed
+        self._next_slot = int(time() / CANDIDATE_EXPIRY_RESOLUTION)
+
+    def __contains__(self, sock_addr):
+        return sock_addr in self._candidates
+
+    def __getitem__(self, sock_addr):
+        return self._candidates[sock_addr]
+
+    def __setitem__(self, sock_addr, candidate):
+        assert isinstance(candidate, WalkCandidate), type(candidate)
+        previous = self._candidates.get(sock_addr)
+        if previous and not previous is candidate:
+            self._remove(previous)
+        self._candidates[sock_addr] = candidate
+        self.update_category(candidate, time())
+
+        cid = self._community.cid
+        for associated_cid, member in candidate._associations:
+            if associated_cid == cid:
+                self._associations.setdefault(member, set()).add(candidate)
+
+    def __delitem__(self, sock_addr):
+        self._remove(self._candidates.pop(sock_addr))
+
+    def _remove(self, candidate):
+        self._set_category(candidate, u"none")
+        self._unschedule(candidate)
+
+        cid = self._community.cid
+        for associated_cid, member in candidate._associations:
+            if associated_cid == cid:
+                self.disassociate(candidate, member)
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def __iter__(self):
+        return iter(self._candidates)
+
+    def get(self, sock_addr, default=None):
+        return self._candidates.get(sock_addr, default)
+
+    def keys(self):
+        return self._candidates.keys()
+
+    def iterkeys(self):
+        return self._candidates.iterkeys()
+
+    def itervalues(self):
+        return self._candidates.itervalues()
+
+    def iteritems(self):
+        return self._candidates.iteritems()
+
+    def associate(self, candidate, member):
+        """
+        Index CANDIDATE as being associated with MEMBER.  Candidates that are not in this table are
+        indexed once they are added.
+        """
+        if self._candidates.get(candidate.sock_addr) is candidate:
+            self._associations.setdefault(member, set()).add(candidate)
+
+    def disassociate(self, candidate, member):
+        candidates = self._associations.get(member)
+        if candidates:
+            candidates.discard(candidate)
+            if not candidates:
+                del self._associations[member]
+
+    def get_associated_candidates(self, member):
+        """
+        Returns the candidates in this table that are associated with MEMBER.
+        """
+        return self._associations.get(member, ())
+
+    def update_category(self, candidate, now):
+        """
+        Index CANDIDATE under its current category.
+        """
+        assert candidate.sock_addr in self._candidates, candidate
+        category = candidate.get_category(self._community, now)
+        self._set_category(candidate, category)
+        self._schedule(candidate, now)
+
+        if category != u"none":
+            key, eligible = self._get_walk_keys(candidate, category)
+            entry = self._walk_entries.get(candidate)
+            if entry is None or entry[1:] != (category, key, eligible):
+                counter = self._counter.next()
+                self._walk_entries[candidate] = (counter, category, key, eligible)
+                waiting = self._waiting[category]
+                heappush(waiting, (eligible, counter, candidate, key))
+
+                # discard outdated entries when they start to dominate the heaps
+                if len(waiting) + len(self._ready[category]) > 4 * (len(self._categories[category]) - self._removed[category]) + 32:
+                    self._rebuild_heaps(category)
+
+    def refresh(self, candidate, now):
+        """
+        Index CANDIDATE under its current category when it is in this table.  Must be called when
+        the timestamps of CANDIDATE are moved back in time.
+        """
+        if self._candidates.get(candidate.sock_addr) is candidate:
+            self.update_category(candidate, now)
+
+    def _get_transition_time(self, candidate, now):
+        """
+        Returns the first time after NOW at which CANDIDATE changes category in COMMUNITY.  When no
+        such change remains, the time at which CANDIDATE becomes obsolete in all communities is
+        returned instead.
+        """
+        timestamps = candidate._timestamps.get(self._community.cid)
+        if timestamps:
+            transitions = [transition
+                           for transition
+                           in (timestamps.last_walk + timestamps.timeout_adjustment,
+                               timestamps.last_walk + CANDIDATE_WALK_LIFETIME,
+                               timestamps.last_stumble + CANDIDATE_STUMBLE_LIFETIME,
+                               timestamps.last_intro + CANDIDATE_INTRO_LIFETIME)
+                           if transition > now]
+            if transitions:
+                return min(transitions)
+
+        if candidate._timestamps:
+            return max(max(timestamps.last_walk, timestamps.last_stumble, timestamps.last_intro) for timestamps in candidate._timestamps.itervalues()) + CANDIDATE_LIFETIME
+        return now + CANDIDATE_LIFETIME
+
+    def _schedule(self, candidate, now):
+        # the slot must start after the transition, otherwise expire would find the candidate
+        # unchanged
+        slot = max(int(self._get_transition_time(candidate, now) / CANDIDATE_EXPIRY_RESOLUTION) + 1, self._next_slot)
+        previous = self._expiry_slots.get(candidate)
+        if previous != slot:
+            if previous is not None:
+                self._wheel[previous].discard(candidate)
+            self._expiry_slots[candidate] = slot
+            try:
+                self._wheel[slot].add(candidate)
+            except KeyError:
+                self._wheel[slot] = set([candidate])
+
+    def _unschedule(self, candidate):
+        slot = self._expiry_slots.pop(candidate, None)
+        if slot is not None:
+            self._wheel[slot].discard(candidate)
+
+    def expire(self, now):
+        """
+        Reconsider the candidates whose state transition lies before NOW.  Candidates that are
+        obsolete in all communities are removed, all others are moved to their current category.
+
+        Returns a list with the removed candidates.
+        """
+        removed = []
+        last_slot = int(now / CANDIDATE_EXPIRY_RESOLUTION)
+        while self._next_slot <= last_slot:
+            candidates = self._wheel.pop(self._next_slot, None)
+            self._next_slot += 1
+            if candidates:
+                for candidate in candidates:
+                    del self._expiry_slots[candidate]
+                    if not self._candidates.get(candidate.sock_addr) is candidate:
+                        continue
+                    if candidate.is_all_obsolete(now):
+                        if __debug__: dprint("removing obsolete candidate ", candidate)
+                        del self._candidates[candidate.sock_addr]
+                        self._remove(candidate)
+                        removed.append(candidate)
+                    else:
+                        self.update_category(candidate, now)
+        return removed
+
+    def iter_active(self, now):
+        """
+        Yields the walk and stumble candidates, followed by the intro candidates that are walk or
+        stumble in another community.
+
+        The categories are kept current by expire, hence only the intro candidates require a time
+        check.
+        """
+        for category in (u"walk", u"stumble"):
+            for candidate in list(self._categories[category]):
+                if candidate:
+                    yield candidate
+        for candidate in list(self._categories[u"intro"]):
+            if candidate and candidate.is_any_active(now):
+                yield candidate
+
+    def _get_walk_keys(self, candidate, category):
+        """
+        Returns the (key, eligible) tuple for CANDIDATE in CATEGORY.
+        """
+        timestamps = candidate._timestamps[self._community.cid]
+        if category == u"walk":
+            key = timestamps.last_walk
+        elif category == u"stumble":
+            key = timestamps.last_stumble
+        else:
+            key = timestamps.last_intro
+        return key, timestamps.last_walk + CANDIDATE_ELIGIBLE_DELAY
+
+    def _rebuild_heaps(self, category):
+        waiting = []
+        for candidate in self._categories[category]:
+            if candidate is None:
+                continue
+            key, eligible = self._get_walk_keys(candidate, category)
+            counter = self._counter.next()
+            self._walk_entries[candidate] = (counter, category, key, eligible)
+            waiting.append((eligible, counter, candidate, key))
+        heapify(waiting)
+        self._waiting[category] = waiting
+        self._ready[category] = []
+
+    def _is_current(self, candidate, category, counter, now):
+        """
+        Returns True when the heap entry COUNTER for CANDIDATE in CATEGORY is still valid.
+        Candidates that are found in the wrong category are moved to their current category.
+        """
+        entry = self._walk_entries.get(candidate)
+        if entry is None or entry[0] != counter:
+            return False
+        if candidate.get_category(self._community, now) != category:
+            self.update_category(candidate, now)
+            return False
+        return True
+
+    def pop_walk_candidate(self, category, now):
+        """
+        Removes and returns the eligible candidate in CATEGORY with the oldest walk, stumble, or
+        intro time as a (key, counter, candidate, eligible) entry, or None when there is no eligible
+        candidate.
+
+        The entry must be given to restore_walk_candidates when the candidate was not walked to.
+        """
+        waiting = self._waiting[category]
+        ready = self._ready[category]
+
+        # move the candidates that became eligible
+        while waiting and waiting[0][0] <= now:
+            eligible, counter, candidate, key = heappop(waiting)
+            if self._is_current(candidate, category, counter, now):
+                heappush(ready, (key, counter, candidate, eligible))
+
+        while ready:
+            entry = heappop(ready)
+            if self._is_current(entry[2], category, entry[1], now):
+                return entry
+
+        return None
+
+    def restore_walk_candidates(self, category, entries):
+        """
+        Put ENTRIES, obtained from pop_walk_candidate, back.
+        """
+        ready = self._ready[category]
+        for entry in entries:
+            heappush(ready, entry)
+
+    def _set_category(self, candidate, category):
+        previous = self._candidate_categories.get(candidate, u"none")
+        if previous != category:
+            if previous != u"none":
+                candidates = self._categories[previous]
+                candidates[self._positions.pop(candidate)] = None
+                self._removed[previous] += 1
+                if self._removed[previous] * 2 > len(candidates):
+                    self._compact(previous)
+
+            if category == u"none":
+                del self._candidate_categories[candidate]
+                self._walk_entries.pop(candidate, None)
+            else:
+                candidates = self._categories[category]
+                self._positions[candidate] = len(candidates)
+                candidates.append(candidate)
+                self._candidate_categories[candidate] = category
+
+    def _compact(self, category):
+        """
+        Remove the None entries from the CATEGORY list, keeping the round robin order.
+        """
+        candidates = self._categories[category]
+        cursor = self._cursors[category]
+        self._cursors[category] = cursor - sum(1 for candidate in candidates[:cursor] if candidate is None)
+        # modify in place, next_in_category may hold a reference to this list
+        candidates[:] = [candidate for candidate in candidates if candidate is not None]
+        self._removed[category] = 0
+        positions = self._positions
+        for index, candidate in enumerate(candidates):
+            positions[candidate] = index
+
+    def next_in_category(self, category, now):
+        """
+        Returns the next active candidate in CATEGORY in round robin order, or None when there is
+        no such candidate.
+
+        Candidates that are no longer in CATEGORY are moved to their current category.
+        """
+        community = self._community
+        candidates = self._categories[category]
+        for _ in xrange(len(candidates)):
+            if not candidates:
+                break
+            index = self._cursors[category]
+            if index >= len(candidates):
+                index = 0
+            candidate = candidates[index]
+            self._cursors[category] = index + 1
+
+            if candidate is None:
+                continue
+            if candidate.get_category(community, now) != category:
+                self.update_category(candidate, now)
+            elif candidate.is_any_active(now):
+                return candidate
+
+        return None
+
+    def iter_category(self, category, now):
+        """
+        Yields all active candidates in CATEGORY, without moving the round robin cursor.
+        """
+        community = self._community
+        return (candidate
+                for candidate
+                in list(self._categories[category])
+                if candidate and candidate.get_category(community, now) == category and candidate.is_any_active(now))
+
 class BootstrapCandidate(WalkCandidate):
+    __slots__ = []
+
     def __init__(self, sock_addr, tunnel):
         super(BootstrapCandidate, self).__init__(sock_addr, tunnel, sock_addr, sock_addr, connection_type=u"public")
 
@@ -433,5 +876,7 @@ class BootstrapCandidate(WalkCandidate):
         return "B!" + super(BootstrapCandidate, self).__str__()
 
 class LoopbackCandidate(Candidate):
+    __slots__ = []
+
     def __init__(self):
         super(LoopbackCandidate, self).__init__(("localhost", 0), False)
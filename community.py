@@ -15,12 +15,6 @@ from random import random, Random, randint, shuffle
 from time import time
 from itertools import cycle
 
-try:
-    # python 2.7 only...
-    from collections import OrderedDict
-except ImportError:
-    from .python27_ordereddict import OrderedDict
-
 from .bloomfilter import BloomFilter
 from .conversion import BinaryConversion, DefaultConversion
 from .crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
@@ -33,7 +27,7 @@ from .resolution import PublicResolution, LinearResolution, DynamicResolution
 from .revision import update_revision_information
 from .statistics import CommunityStatistics
 from .timeline import Timeline
-from .candidate import WalkCandidate
+from .candidate import CandidateTable, WalkCandidate
 
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
@@ -316,7 +310,7 @@ class Community(object):
         self._nrsyncpackets = 0
         
         #Initialize all the candidate iterators
-        self._candidates = OrderedDict()
+        self._candidates = CandidateTable(self)
         self._walked_candidates = self._iter_category(u'walk')
         self._stumbled_candidates = self._iter_category(u'stumble')
         self._introduced_candidates = self._iter_category(u'intro')
@@ -386,7 +380,10 @@ class Community(object):
                 if isinstance(meta_message.distribution, SyncDistribution) and meta_message.batch.max_window >= sync_interval:
                     dprint("when sync is enabled the interval should be greater than the walking frequency.  otherwise you are likely to receive duplicate packets [", meta_message.name, "]", level="warning")
 
-    def _initialize_timeline(self):
+    def _get_timeline_mapping(self):
+        """
+        Returns meta_message.id:handle_callback pairs for the messages that build the timeline.
+        """
         mapping = {}
         for name in [u"dispersy-authorize", u"dispersy-revoke", u"dispersy-dynamic-settings"]:
             try:
@@ -395,13 +392,36 @@ class Community(object):
                 if __debug__: dprint("unable to load permissions from database [could not obtain '", name, "']", level="warning")
             else:
                 mapping[meta.database_id] = meta.handle_callback
+        return mapping
+
+    def _initialize_timeline(self):
+        mapping = self._get_timeline_mapping()
 
         if mapping:
-            for packet, in list(self._dispersy.database.execute(u"SELECT packet FROM sync WHERE meta_message IN (" + ", ".join("?" for _ in mapping) + ") ORDER BY global_time, packet",
-                                                                mapping.keys())):
+            execute = self._dispersy.database.execute
+            meta_message_ids = u", ".join(u"?" for _ in mapping)
+
+            # a snapshot is valid when all permission messages that it contains are still in the
+            # database.  only newer permission messages need to be processed
+            high_water_mark = 0
+            try:
+                snapshot_sync_id, snapshot_count, snapshot = execute(u"SELECT sync, count, snapshot FROM timeline_snapshot WHERE community = ?", (self._database_id,)).next()
+            except StopIteration:
+                pass
+            else:
+                count, = execute(u"SELECT COUNT(*) FROM sync WHERE meta_message IN (" + meta_message_ids + ") AND id <= ?", mapping.keys() + [snapshot_sync_id]).next()
+                if count == snapshot_count and self._timeline.load_snapshot(str(snapshot)):
+                    if __debug__: dprint("loaded timeline snapshot with ", count, " permission messages")
+                    high_water_mark = snapshot_sync_id
+                elif __debug__:
+                    dprint("ignoring timeline snapshot, expected ", snapshot_count, " permission messages but found ", count, level="warning")
+
+            for packet_id, packet in list(execute(u"SELECT id, packet FROM sync WHERE meta_message IN (" + meta_message_ids + ") AND id > ? ORDER BY global_time, packet",
+                                                  mapping.keys() + [high_water_mark])):
                 message = self._dispersy.convert_packet_to_message(str(packet), self, verify=False)
                 if message:
                     if __debug__: dprint("processing ", message.name)
+                    message.packet_id = packet_id
                     mapping[message.database_id]([message], initializing=True)
                 else:
                     # TODO: when a packet conversion fails we must drop something, and preferably check
@@ -410,6 +430,23 @@ class Community(object):
                         dprint("invalid message in database [", self.get_classification(), "; ", self.cid.encode("HEX"), "]", level="error")
                         dprint(str(packet).encode("HEX"), level="error")
 
+    def _store_timeline_snapshot(self):
+        """
+        Store a snapshot of the timeline, allowing _initialize_timeline to skip the permission
+        messages that it contains when the community is loaded again.
+        """
+        mapping = self._get_timeline_mapping()
+        if mapping:
+            execute = self._dispersy.database.execute
+            snapshot_sync_id, snapshot_count = execute(u"SELECT MAX(id), COUNT(*) FROM sync WHERE meta_message IN (" + u", ".join(u"?" for _ in mapping) + ")", mapping.keys()).next()
+            snapshot = self._timeline.get_snapshot() if snapshot_count else None
+            if snapshot:
+                if __debug__: dprint("storing timeline snapshot with ", snapshot_count, " permission messages (", len(snapshot), " bytes)")
+                execute(u"INSERT OR REPLACE INTO timeline_snapshot (community, sync, count, snapshot) VALUES (?, ?, ?, ?)",
+                        (self._database_id, snapshot_sync_id, snapshot_count, buffer(snapshot)))
+            else:
+                execute(u"DELETE FROM timeline_snapshot WHERE community = ?", (self._database_id,))
+
     # @property
     def __get_dispersy_auto_load(self):
         """
@@ -427,6 +464,7 @@ class Community(object):
         assert isinstance(auto_load, bool)
         self._dispersy.database.execute(u"UPDATE community SET auto_load = ? WHERE master = ?",
                                         (1 if auto_load else 0, self._master_member.database_id))
+        self._dispersy._update_packet_filter()
     # .setter was introduced in Python 2.6
     dispersy_auto_load = property(__get_dispersy_auto_load, __set_dispersy_auto_load)
 
@@ -1007,6 +1045,14 @@ class Community(object):
         """
         return 10 * 1025
 
+    @property
+    def dispersy_decoded_message_cache_size(self):
+        """
+        The maximum number of decoded messages, loaded from the database, that are cached.
+        @rtype: int
+        """
+        return 1024
+
     @property
     def dispersy_acceptable_global_time_range(self):
         return 10000
@@ -1119,6 +1165,7 @@ class Community(object):
             self._dispersy.callback.unregister(id_)
         self._pending_callbacks = []
 
+        self._store_timeline_snapshot()
         self._dispersy.detach_community(self)
 
     def claim_global_time(self):
@@ -1241,6 +1288,26 @@ class Community(object):
         if default:
             self._conversions[None] = conversion
         self._conversions[conversion.prefix] = conversion
+        self._dispersy._update_packet_filter()
+
+    def get_packet_prefixes(self):
+        """
+        Returns the first 23 bytes, i.e. the conversion prefix followed by the message byte, of
+        every packet that this community is able to decode.
+
+        Returns None when this can not be determined in advance, for instance because conversions
+        are created when a packet is received.
+
+        @rtype: frozenset or None
+        """
+        prefixes = set()
+        for prefix, conversion in self._conversions.iteritems():
+            if prefix:
+                message_bytes = conversion.get_message_bytes()
+                if message_bytes is None:
+                    return None
+                prefixes.update(prefix + byte for byte in message_bytes)
+        return frozenset(prefixes)
 
     @documentation(Dispersy.take_step)
     def dispersy_take_step(self, allow_sync):
@@ -1289,70 +1356,43 @@ class Community(object):
         """
         Yields all active candidates that are part of COMMUNITY.
         """
-        now = time()
-        return (candidate for candidate in self._candidates.itervalues() if candidate.in_community(self, now) and candidate.is_any_active(now))
+        return self._candidates.iter_active(time())
 
     def _iter_category(self, category):
+        """
+        Yields the active candidates in CATEGORY in round robin order, or None when there are none.
+        """
+        next_in_category = self._candidates.next_in_category
         while True:
-            no_result = True
-            
-            keys = self._candidates.keys()
-            key_index = 0
-            key_value = None
-
-            while True:
-                try:
-                    key_value = keys[key_index]
-                    candidate = self._candidates[key_value]
-                    
-                    if candidate.in_community(self, time()) and candidate.is_any_active(time()) and category == candidate.get_category(self, time()):
-                        no_result = False
-                        yield candidate
-                        
-                        keys = self._candidates.keys()
-                        if key_value in keys:
-                            key_index = keys.index(key_value)
-                        
-                    key_index += 1
-                        
-                except IndexError:
-                    break
-            
-            if no_result:
-                yield None
-                
+            yield next_in_category(category, time())
+
     def _iter_categories(self, categories, once = False):
-        while True:
-            no_result = True
+        """
+        Yields the active candidates in CATEGORIES, or None when there are none.
 
-            keys = self._candidates.keys()
-            key_index = 0
-            key_value = None
-            
-            while True:
-                try:
-                    key_value = keys[key_index]
-                    candidate = self._candidates[key_value]
-                    
-                    if candidate.in_community(self, time()) and candidate.is_any_active(time()) and candidate.get_category(self, time()) in categories:
-                        no_result = False
-                        yield candidate
-                        
-                        keys = self._candidates.keys()
-                        if key_value in keys:
-                            key_index = keys.index(key_value)
-                        
-                    key_index += 1
-                        
-                except IndexError:
-                    break
-                    
-            if no_result:
+        When ONCE is True all candidates are yielded once.  Otherwise the categories take turns
+        yielding their next candidate in round robin order.
+        """
+        if once:
+            now = time()
+            candidates = [candidate for category in categories for candidate in self._candidates.iter_category(category, now)]
+            for candidate in candidates:
+                yield candidate
+            if not candidates:
                 yield None
-            
-            if once:
-                break
-                
+
+        else:
+            next_in_category = self._candidates.next_in_category
+            for offset in cycle(xrange(len(categories))):
+                now = time()
+                for category in categories[offset:] + categories[:offset]:
+                    candidate = next_in_category(category, now)
+                    if candidate:
+                        yield candidate
+                        break
+                else:
+                    yield None
+
     def _iter_bootstrap(self, once = False):
         while True:
             no_result = True
@@ -1399,59 +1439,71 @@ class Community(object):
         Yields a mixture of all candidates that we could get our hands on that are part of
         COMMUNITY.
         """
-        # TODO we can optimize by not doing all the sorting until we select where we want to pick a
-        # node.  since we always just need one candidate the other sorts would be useless
-
         # 13/02/12 Boudewijn: normal peers can not be visited multiple times within 30 seconds,
         # bootstrap peers can not be visited multiple times within 55 seconds.  this is handled by
         # the Candidate.is_eligible_for_walk(...) method
-        
+
+        # the candidate table keeps the eligible candidates of each category in a heap ordered by
+        # last_walk, last_stumble, and last_intro.  candidates are only removed from these heaps
+        # while we are yielding them and are put back once this generator is closed
         now = time()
-        categories = {u"walk":[], u"stumble":[], u"intro":[], u"none":[]}
-        for candidate in self._candidates.itervalues():
-            if candidate.is_eligible_for_walk(self, now):
-                categories[candidate.get_category(self, now)].append(candidate)
-
-        walks = sorted(categories[u"walk"], key=lambda candidate: candidate.last_walk(self))
-        stumbles = sorted(categories[u"stumble"], key=lambda candidate: candidate.last_stumble(self))
-        intros = sorted(categories[u"intro"], key=lambda candidate: candidate.last_intro(self))
-
-        while walks or stumbles or intros:
-            r = random()
-
-            # 13/02/12 Boudewijn: we decrease the 1% chance to contact a bootstrap peer to .5%
-            if r <= .4975: # ~50%
-                if walks:
-                    if __debug__: dprint("yield [%2d:%2d:%2d walk   ] " % (len(walks), len(stumbles), len(intros)), walks[0])
-                    yield walks.pop(0)
-
-            elif r <= .995: # ~50%
-                if stumbles or intros:
-                    while True:
-                        if random() <= .5:
-                            if stumbles:
-                                if __debug__: dprint("yield [%2d:%2d:%2d stumble] " % (len(walks), len(stumbles), len(intros)), stumbles[0])
-                                yield stumbles.pop(0)
-                                break
-
-                        else:
-                            if intros:
-                                if __debug__: dprint("yield [%2d:%2d:%2d intro  ] " % (len(walks), len(stumbles), len(intros)), intros[0])
-                                yield intros.pop(0)
-                                break
-
-            else: # ~.5%
-                candidate = self._bootstrap_candidates.next()
-                if candidate:
-                    if __debug__: dprint("yield [%2d:%2d:%2d bootstr] " % (len(walks), len(stumbles), len(intros)), candidate)
-                    yield candidate
-        
+        pop_walk_candidate = self._candidates.pop_walk_candidate
+        heads = dict((category, pop_walk_candidate(category, now)) for category in (u"walk", u"stumble", u"intro"))
+        taken = {u"walk":[], u"stumble":[], u"intro":[]}
+
+        def pop(category):
+            entry = heads[category]
+            taken[category].append(entry)
+            heads[category] = pop_walk_candidate(category, now)
+            return entry[2]
+
+        try:
+            while heads[u"walk"] or heads[u"stumble"] or heads[u"intro"]:
+                r = random()
+
+                # 13/02/12 Boudewijn: we decrease the 1% chance to contact a bootstrap peer to .5%
+                if r <= .4975: # ~50%
+                    if heads[u"walk"]:
+                        candidate = pop(u"walk")
+                        if __debug__: dprint("yield [walk   ] ", candidate)
+                        yield candidate
+
+                elif r <= .995: # ~50%
+                    if heads[u"stumble"] or heads[u"intro"]:
+                        while True:
+                            if random() <= .5:
+                                if heads[u"stumble"]:
+                                    candidate = pop(u"stumble")
+                                    if __debug__: dprint("yield [stumble] ", candidate)
+                                    yield candidate
+                                    break
+
+                            else:
+                                if heads[u"intro"]:
+                                    candidate = pop(u"intro")
+                                    if __debug__: dprint("yield [intro  ] ", candidate)
+                                    yield candidate
+                                    break
+
+                else: # ~.5%
+                    candidate = self._bootstrap_candidates.next()
+                    if candidate:
+                        if __debug__: dprint("yield [bootstr] ", candidate)
+                        yield candidate
+
+        finally:
+            restore_walk_candidates = self._candidates.restore_walk_candidates
+            for category, entries in taken.iteritems():
+                if heads[category]:
+                    entries.append(heads[category])
+                restore_walk_candidates(category, entries)
+
         bootstrap_candidates = list(self._iter_bootstrap(once = True))
         shuffle(bootstrap_candidates)
         
         for candidate in bootstrap_candidates:
             if candidate:
-                if __debug__: dprint("yield [%2d:%2d:%2d bootstr] " % (len(walks), len(stumbles), len(intros)), candidate)
+                if __debug__: dprint("yield [bootstr] ", candidate)
             yield candidate
             
         if __debug__: dprint("no candidates or bootstrap candidates available")
@@ -1471,7 +1523,11 @@ class Community(object):
     def add_candidate(self, candidate):
         assert candidate.sock_addr not in self._dispersy._bootstrap_candidates.iterkeys(), "none of the bootstrap candidates may be in self._candidates"
         
-        if candidate.sock_addr not in self._candidates:
+        if candidate.sock_addr in self._candidates:
+            if self._candidates[candidate.sock_addr] is candidate:
+                self._candidates.update_category(candidate, time())
+
+        else:
             self._candidates[candidate.sock_addr] = candidate
             
             self._dispersy.statistics.total_candidates_discovered += 1
@@ -1638,6 +1694,10 @@ class HardKilledCommunity(Community):
         # match
         return [DefaultConversion(self)]
 
+    def get_packet_prefixes(self):
+        # conversions are created when a packet is received
+        return None
+
     def get_conversion(self, prefix=None):
         if not prefix in self._conversions:
 
@@ -8,7 +8,6 @@ from .authentication import NoAuthentication, MemberAuthentication, DoubleMember
 from .bloomfilter import BloomFilter
 from .crypto import ec_check_public_bin
 from .destination import MemberDestination, CommunityDestination, CandidateDestination
-from .dispersydatabase import DispersyDatabase
 from .distribution import FullSyncDistribution, LastSyncDistribution, DirectDistribution
 from .message import DelayPacketByMissingMember, DropPacket, Message
 from .resolution import PublicResolution, LinearResolution, DynamicResolution
@@ -50,7 +49,7 @@ class Conversion(object):
         assert len(community_version) == 1, community_version
 
         # the dispersy database
-        self._dispersy_database = DispersyDatabase.get_instance()
+        self._dispersy_database = community.dispersy.database
 
         # the community that this conversion belongs to.
         self._community = community
@@ -92,7 +91,7 @@ class Conversion(object):
         assert data[:22] == self._prefix
         raise NotImplementedError("The subclass must implement decode_message")
 
-    def decode_message(self, address, data, verify=True):
+    def decode_message(self, address, data, verify=True, lazy_payload=False):
         """
         DATA is a string, where the first byte is the on-the-wire Dispersy version, the second byte
         is the on-the-wire Community version and the following 20 bytes is the Community Identifier.
@@ -105,6 +104,23 @@ class Conversion(object):
         assert data[:22] == self._prefix
         raise NotImplementedError("The subclass must implement decode_message")
 
+    def decode_payload(self, lazy_payload):
+        """
+        Decode the payload of a message that was decoded with LAZY_PAYLOAD=True.
+
+        LAZY_PAYLOAD is the opaque object that decode_message handed to the Message.Implementation.
+
+        Returns a Payload.Implementation instance.
+        """
+        raise NotImplementedError("The subclass must implement decode_payload")
+
+    def get_message_bytes(self):
+        """
+        Returns the message bytes, the 23rd byte of each packet, that this conversion is able to
+        decode, or None when this can not be determined in advance.
+        """
+        return None
+
     def encode_message(self, message, sign=True):
         """
         Encode a Message instance into a binary string where the first byte is the on-the-wire
@@ -234,6 +250,9 @@ class BinaryConversion(Conversion):
             if debug_non_available:
                 dprint("unable to define non-available messages ", ", ".join(debug_non_available), level="warning")
 
+    def get_message_bytes(self):
+        return self._decode_message_map.keys()
+
     def define_meta_message(self, byte, meta, encode_payload_func, decode_payload_func):
         assert isinstance(byte, str)
         assert len(byte) == 1
@@ -1039,8 +1058,9 @@ class BinaryConversion(Conversion):
 
     def _encode_member_authentication_signature(self, container, message, sign):
         assert message.authentication.member.private_key, (message.authentication.member.database_id, message.authentication.member.mid.encode("HEX"), id(message.authentication.member))
+        data = "".join(container)
         if sign:
-            data = "".join(container)
+            self._community.dispersy.statistics.sign_count += 1
             signature = message.authentication.member.sign(data)
             message.authentication.set_signature(signature)
             return data + signature
@@ -1055,8 +1075,10 @@ class BinaryConversion(Conversion):
             if signature:
                 signatures.append(signature)
             elif sign and member.private_key:
+                self._community.dispersy.statistics.sign_count += 1
                 signature = member.sign(data)
-                message.authentication.set_signature(member, signature)
+                # we are encoding the packet right now, hence it must not be regenerated
+                message.authentication.set_signature(member, signature, regenerate_packet=False)
                 signatures.append(signature)
             else:
                 signatures.append("\x00" * member.signature_length)
@@ -1066,6 +1088,7 @@ class BinaryConversion(Conversion):
         assert isinstance(message, Message.Implementation), message
         assert message.name in self._encode_message_map, message.name
         encode_functions = self._encode_message_map[message.name]
+        self._community.dispersy.statistics.encode_count += 1
 
         # community prefix, message-id
         container = [self._prefix, encode_functions.byte]
@@ -1317,7 +1340,7 @@ class BinaryConversion(Conversion):
     def _decode_empty_destination(self, placeholder):
         placeholder.destination = placeholder.meta.destination.Implementation(placeholder.meta.destination)
 
-    def _decode_message(self, candidate, data, verify, allow_empty_signature):
+    def _decode_message(self, candidate, data, verify, allow_empty_signature, lazy_payload=False):
         """
         Decode a binary string into a Message structure, with some
         Dispersy specific parameters.
@@ -1327,6 +1350,10 @@ class BinaryConversion(Conversion):
 
         Invalid signature(s) will cause DropPacket to be raised, except when ALLOW_EMPTY_SIGNATURE
         is True and the failed signature consist of \x00 bytes.
+
+        When LAZY_PAYLOAD is True the payload is not decoded.  Instead it will be decoded the first
+        time that message.payload is accessed, at which point DropPacket or DelayPacket may be
+        raised.
         """
         assert isinstance(data, str)
         assert isinstance(verify, bool)
@@ -1369,6 +1396,15 @@ class BinaryConversion(Conversion):
         assert isinstance(placeholder.distribution, Distribution.Implementation)
 
         # payload
+        if lazy_payload:
+            # the payload is decoded when the message.payload property is first accessed.  the
+            # placeholder contains everything that the payload decoder needs
+            return placeholder.meta.Implementation(placeholder.meta, placeholder.authentication, placeholder.resolution, placeholder.distribution, placeholder.destination, None, conversion=self, candidate=candidate, packet=placeholder.data, lazy_payload=placeholder)
+
+        self._decode_payload(decode_functions, placeholder)
+        return placeholder.meta.Implementation(placeholder.meta, placeholder.authentication, placeholder.resolution, placeholder.distribution, placeholder.destination, placeholder.payload, conversion=self, candidate=candidate, packet=placeholder.data)
+
+    def _decode_payload(self, decode_functions, placeholder):
         placeholder.offset, placeholder.payload = decode_functions.payload(placeholder, placeholder.offset, placeholder.data[:placeholder.first_signature_offset])
         if placeholder.offset != placeholder.first_signature_offset:
             if __debug__: dprint("invalid packet size for ", placeholder.meta.name, " data:", placeholder.first_signature_offset, "; offset:", placeholder.offset, level="warning")
@@ -1379,7 +1415,7 @@ class BinaryConversion(Conversion):
             assert isinstance(placeholder.payload, Payload.Implementation), type(placeholder.payload)
             assert isinstance(placeholder.offset, (int, long))
 
-        return placeholder.meta.Implementation(placeholder.meta, placeholder.authentication, placeholder.resolution, placeholder.distribution, placeholder.destination, placeholder.payload, conversion=self, candidate=candidate, packet=placeholder.data)
+        return placeholder.payload
 
     def decode_meta_message(self, data):
         """
@@ -1398,14 +1434,23 @@ class BinaryConversion(Conversion):
 
         return decode_functions.meta
 
-    def decode_message(self, candidate, data, verify=True):
+    def decode_message(self, candidate, data, verify=True, lazy_payload=False):
         """
         Decode a binary string into a Message.Implementation structure.
         """
         assert isinstance(candidate, Candidate), candidate
         assert isinstance(data, str), data
         assert isinstance(verify, bool)
-        return self._decode_message(candidate, data, verify, False)
+        assert isinstance(lazy_payload, bool)
+        return self._decode_message(candidate, data, verify, False, lazy_payload)
+
+    def decode_payload(self, lazy_payload):
+        """
+        Decode the payload of a message that was decoded with LAZY_PAYLOAD=True.
+        """
+        assert isinstance(lazy_payload, self.Placeholder), lazy_payload
+        assert lazy_payload.payload is None
+        return self._decode_payload(self._decode_message_map[lazy_payload.data[22]], lazy_payload)
 
 class DefaultConversion(BinaryConversion):
     """
@@ -1,9 +1,3 @@
-try:
-    # python 2.7 only...
-    from collections import OrderedDict
-except ImportError:
-    from .python27_ordereddict import OrderedDict
-
 from time import time, sleep
 import socket
 
@@ -19,7 +13,8 @@ from .revision import update_revision_information
 update_revision_information("$HeadURL$", "$Revision$")
 
 class DebugOnlyMember(Member):
-    _cache = OrderedDict()
+    # debug members hold a private key, they may never be returned for a Member(public_key) call
+    _caches = {}
 
     def __init__(self, public_key, private_key=""):
         super(DebugOnlyMember, self).__init__(public_key)
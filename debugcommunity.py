@@ -77,6 +77,9 @@ class DebugNode(Node):
     def create_protected_full_sync_text_message(self, text, global_time):
         return self._create_text_message(u"protected-full-sync-text", text, global_time)
 
+    def create_protected_doublemember_text_message(self, other, text, global_time):
+        return self._create_doublemember_text_message(u"protected-doublemember-text", other, text, global_time)
+
     def create_dynamic_resolution_text_message(self, text, global_time, policy):
         assert isinstance(policy, (PublicResolution.Implementation, LinearResolution.Implementation))
         return self._create_text_message(u"dynamic-resolution-text", text, global_time, resolution=(policy,))
@@ -97,6 +100,7 @@ class DebugCommunityConversion(BinaryConversion):
         self.define_meta_message(chr(11), community.get_meta_message(u"last-1-doublemember-text"), self._encode_text, self._decode_text)
         self.define_meta_message(chr(12), community.get_meta_message(u"protected-full-sync-text"), self._encode_text, self._decode_text)
         self.define_meta_message(chr(13), community.get_meta_message(u"dynamic-resolution-text"), self._encode_text, self._decode_text)
+        self.define_meta_message(chr(14), community.get_meta_message(u"protected-doublemember-text"), self._encode_text, self._decode_text)
 
     def _encode_text(self, message):
         return pack("!B", len(message.payload.text)), message.payload.text
@@ -122,6 +126,8 @@ class DebugCommunityConversion(BinaryConversion):
 
 class TextPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_text"]
+
         def __init__(self, meta, text):
             assert isinstance(text, str)
             super(TextPayload.Implementation, self).__init__(meta)
@@ -166,6 +172,7 @@ class DebugCommunity(Community):
                 Message(self, u"DESC-text", MemberAuthentication(), PublicResolution(), FullSyncDistribution(enable_sequence_number=False, synchronization_direction=u"DESC", priority=128), CommunityDestination(node_count=10), TextPayload(), self.check_text, self.on_text),
                 Message(self, u"protected-full-sync-text", MemberAuthentication(), LinearResolution(), FullSyncDistribution(enable_sequence_number=False, synchronization_direction=u"ASC", priority=128), CommunityDestination(node_count=10), TextPayload(), self.check_text, self.on_text),
                 Message(self, u"dynamic-resolution-text", MemberAuthentication(), DynamicResolution(PublicResolution(), LinearResolution()), FullSyncDistribution(enable_sequence_number=False, synchronization_direction=u"ASC", priority=128), CommunityDestination(node_count=10), TextPayload(), self.check_text, self.on_text, self.undo_text),
+                Message(self, u"protected-doublemember-text", DoubleMemberAuthentication(allow_signature_func=self.allow_signature_func), LinearResolution(), FullSyncDistribution(enable_sequence_number=False, synchronization_direction=u"ASC", priority=128), CommunityDestination(node_count=10), TextPayload(), self.check_text, self.on_text),
                 ]
 
     def create_full_sync_text(self, text, store=True, update=True, forward=True):
@@ -229,8 +236,7 @@ class DebugCommunity(Community):
     #
 
     def check_text(self, messages):
-        for message in messages:
-            allowed, proof = self._timeline.check(message)
+        for message, (allowed, _) in zip(messages, self._timeline.check_batch(messages)):
             if allowed:
                 yield message
             else:
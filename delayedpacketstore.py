@@ -0,0 +1,152 @@
+try:
+    # python 2.7 only...
+    from collections import OrderedDict
+except ImportError:
+    from .python27_ordereddict import OrderedDict
+
+from .revision import update_revision_information
+
+if __debug__:
+    from .dprint import dprint
+
+# update version information directly from SVN
+update_revision_information("$HeadURL$", "$Revision$")
+
+class DelayedPacketStore(object):
+    """
+    Holds the packets that are delayed until a missing item, i.e. a public key or a message, is
+    received.
+
+    The store is bounded by MAX_BYTES in total and by MAX_CANDIDATE_BYTES for each candidate
+    address.  When a new packet does not fit, the least recently used packets are evicted, first
+    from the same candidate address and then from the entire store.  Adding a packet that is
+    already delayed for the same key counts as using it.
+
+    Packets are grouped by a key, usually the identifier of the outstanding request, allowing all
+    packets waiting for the same response to be obtained at once.
+    """
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_candidate_bytes=256 * 1024):
+        assert isinstance(max_bytes, (int, long))
+        assert isinstance(max_candidate_bytes, (int, long))
+        assert 0 < max_candidate_bytes <= max_bytes
+        self._max_bytes = max_bytes
+        self._max_candidate_bytes = max_candidate_bytes
+        # (key, packet):candidate pairs, least recently used first
+        self._packets = OrderedDict()
+        # key:[packet] pairs
+        self._keys = dict()
+        # sock_addr:OrderedDict((key, packet):None) pairs, least recently used first
+        self._addresses = dict()
+        # sock_addr:bytes pairs
+        self._address_bytes = dict()
+        self._bytes = 0
+        self._evictions = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def max_candidate_bytes(self):
+        return self._max_candidate_bytes
+
+    @property
+    def count(self):
+        """
+        The number of packets held.
+        """
+        return len(self._packets)
+
+    @property
+    def bytes(self):
+        """
+        The number of packet bytes held.
+        """
+        return self._bytes
+
+    @property
+    def evictions(self):
+        """
+        The number of packets that were evicted, or not stored at all, because of the byte budgets.
+        """
+        return self._evictions
+
+    def reset_statistics(self):
+        self._evictions = 0
+
+    def add(self, key, candidate, packet):
+        """
+        Hold PACKET, received from CANDIDATE, until it is obtained using pop(KEY).
+
+        Returns False when PACKET is larger than the per candidate budget and is therefore not
+        stored.
+        """
+        assert isinstance(key, (int, long, str)), type(key)
+        assert isinstance(packet, str), type(packet)
+        entry = (key, packet)
+        if entry in self._packets:
+            candidate = self._packets.pop(entry)
+            self._packets[entry] = candidate
+            entries = self._addresses[candidate.sock_addr]
+            del entries[entry]
+            entries[entry] = None
+            return True
+
+        size = len(packet)
+        if size > self._max_candidate_bytes:
+            if __debug__: dprint("unable to delay ", size, " byte packet from ", candidate)
+            self._evictions += 1
+            return False
+
+        # evict from the same candidate address
+        sock_addr = candidate.sock_addr
+        while sock_addr in self._addresses and self._address_bytes[sock_addr] + size > self._max_candidate_bytes:
+            self._discard(iter(self._addresses[sock_addr]).next())
+            self._evictions += 1
+
+        # evict from the entire store
+        while self._bytes + size > self._max_bytes:
+            self._discard(iter(self._packets).next())
+            self._evictions += 1
+
+        self._packets[entry] = candidate
+        self._keys.setdefault(key, []).append(packet)
+        if sock_addr in self._addresses:
+            self._addresses[sock_addr][entry] = None
+            self._address_bytes[sock_addr] += size
+        else:
+            self._addresses[sock_addr] = OrderedDict([(entry, None)])
+            self._address_bytes[sock_addr] = size
+        self._bytes += size
+        return True
+
+    def pop(self, key):
+        """
+        Remove and return the (candidate, packet) tuples held for KEY, in the order that they were
+        added.
+        """
+        packets = self._keys.get(key, ())
+        # _discard modifies the list
+        return [(self._discard((key, packet)), packet) for packet in list(packets)]
+
+    def _discard(self, entry):
+        key, packet = entry
+        candidate = self._packets.pop(entry)
+        size = len(packet)
+        self._bytes -= size
+
+        packets = self._keys[key]
+        packets.remove(packet)
+        if not packets:
+            del self._keys[key]
+
+        sock_addr = candidate.sock_addr
+        entries = self._addresses[sock_addr]
+        del entries[entry]
+        if entries:
+            self._address_bytes[sock_addr] -= size
+        else:
+            del self._addresses[sock_addr]
+            del self._address_bytes[sock_addr]
+
+        return candidate
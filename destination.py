@@ -6,7 +6,7 @@ update_revision_information("$HeadURL$", "$Revision$")
 
 class Destination(MetaObject):
     class Implementation(MetaObject.Implementation):
-        pass
+        __slots__ = []
 
     def setup(self, message):
         """
@@ -21,6 +21,8 @@ class CandidateDestination(Destination):
     A destination policy where the message is sent to one or more specified candidates.
     """
     class Implementation(Destination.Implementation):
+        __slots__ = ["_candidates"]
+
         def __init__(self, meta, *candidates):
             """
             Construct a CandidateDestination.Implementation object.
@@ -52,6 +54,8 @@ class MemberDestination(Destination):
     not be sent and will be silently dropped.
     """
     class Implementation(Destination.Implementation):
+        __slots__ = ["_members"]
+
         def __init__(self, meta, *members):
             """
             Construct an AddressDestination.Implementation object.
@@ -81,6 +85,8 @@ class CommunityDestination(Destination):
     community.yield_random_candidates(...) to receive the message.
     """
     class Implementation(Destination.Implementation):
+        __slots__ = []
+
         @property
         def node_count(self):
             return self._meta._node_count
@@ -46,11 +46,18 @@ from random import random, shuffle
 from socket import inet_aton, error as socket_error
 from time import time
 
+try:
+    # python 2.7 only...
+    from collections import OrderedDict
+except ImportError:
+    from .python27_ordereddict import OrderedDict
+
 from .authentication import NoAuthentication, MemberAuthentication, DoubleMemberAuthentication
 from .bloomfilter import BloomFilter
 from .bootstrap import get_bootstrap_candidates
 from .callback import Callback
-from .candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate
+from .candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate, CANDIDATE_EXPIRY_RESOLUTION
+from .delayedpacketstore import DelayedPacketStore
 from .destination import CommunityDestination, CandidateDestination, MemberDestination
 from .dispersydatabase import DispersyDatabase
 from .distribution import SyncDistribution, FullSyncDistribution, LastSyncDistribution, DirectDistribution
@@ -80,6 +87,15 @@ update_revision_information("$HeadURL$", "$Revision$")
 # the callback identifier for the task that periodically takes a step
 CANDIDATE_WALKER_CALLBACK_ID = "dispersy-candidate-walker"
 
+# the candidate walker gives active communities up to WALKER_MAX_WEIGHT times as many steps as idle
+# communities
+WALKER_MAX_WEIGHT = 4.0
+
+# an idle community takes a step every WALKER_STEP_INTERVAL seconds, while all communities together
+# take at most WALKER_STEP_BUDGET steps per second
+WALKER_STEP_INTERVAL = 5.0
+WALKER_STEP_BUDGET = 10.0
+
 class SignatureRequestCache(Cache):
     cleanup_delay = 0.0
 
@@ -113,7 +129,7 @@ class IntroductionRequestCache(Cache):
     def on_timeout(self):
         # helper_candidate did not respond to a request message in this community.  after some time
         # inactive candidates become obsolete and will be removed by
-        # _periodically_cleanup_candidates
+        # _periodically_expire_candidates
         if __debug__:
             dprint("walker timeout for ", self.helper_candidate)
             
@@ -125,20 +141,56 @@ class IntroductionRequestCache(Cache):
         # of the candidate.
         now = time()
         self.helper_candidate.obsolete(self.community, now)
-        self.helper_candidate.all_inactive(now)
+        self.helper_candidate.all_inactive(self.community, now)
 
 class MissingSomethingCache(Cache):
     cleanup_delay = 0.0
+    # the number of other candidates that are asked, one after another, when the request times out
+    max_retries = 2
 
     def __init__(self, timeout):
         if __debug__: dprint(self.__class__.__name__, ": waiting for ", timeout, " seconds")
         self.timeout_delay = timeout
         self.callbacks = []
+        # the (meta, payload) tuple used to send the request, or None when the request can not be
+        # retried
+        self.request = None
+        # the candidates that may provide the missing item, the first ASKED have been asked
+        self.candidates = []
+        self.asked = 0
+
+    def add_candidate(self, candidate):
+        """
+        Remember that CANDIDATE may provide the missing item.
+        """
+        if len(self.candidates) <= self.max_retries and not any(candidate.sock_addr == other.sock_addr for other in self.candidates):
+            self.candidates.append(candidate)
+
+    def send_request(self):
+        """
+        Send the request to the next candidate that has not been asked yet.
+        """
+        assert self.request
+        assert self.asked < len(self.candidates)
+        candidate = self.candidates[self.asked]
+        self.asked += 1
+        meta, payload = self.request
+        community = meta.community
+        if __debug__: dprint(candidate, " sending ", meta.name, " (attempt ", self.asked, ")")
+        community.dispersy._forward([meta.impl(distribution=(community.global_time,), destination=(candidate,), payload=payload)])
 
     def on_timeout(self):
+        if self.request and self.asked < len(self.candidates):
+            self.send_request()
+            return True
+
         if __debug__: dprint(self.__class__.__name__, ": timeout on ", len(self.callbacks), " callbacks")
         for func, args in self.callbacks:
             func(None, *args)
+        if self.request:
+            # the packets that were delayed until the response arrived
+            dispersy = self.request[0].community.dispersy
+            dispersy.statistics.delay_timeout += len(dispersy.delayed_packets.pop(self.identifier))
 
     @staticmethod
     def properties_to_identifier(*args):
@@ -259,7 +311,11 @@ class Dispersy(Singleton):
     """
     def __init__(self, callback, working_directory, database_filename=u"dispersy.db"):
         """
-        Initialize the Dispersy singleton instance.
+        Initialize a Dispersy instance.
+
+        Usually there is one Dispersy instance, obtained using Dispersy.get_instance(...).
+        However, multiple instances can run in one process when each is given its own callback.
+        Each instance binds itself to the thread of its callback.
 
         Currently we use the rawserver to schedule events.  This may change in the future to offload
         all data processing to a different thread.  The only mechanism used from the rawserver is
@@ -283,9 +339,15 @@ class Dispersy(Singleton):
         # the raw server
         self._callback = callback
 
-        # batch caching incoming packets
+        # batch caching incoming packets.  community:{meta:(task_identifier, timestamp, batch)}
+        # pairs, communities without cached batches are removed
         self._batch_cache = {}
 
+        # decoded messages from the database.  community.cid:OrderedDict pairs, where the
+        # OrderedDict contains (member.database_id, global_time):(message, verified) pairs in least
+        # recently used order
+        self._decoded_message_cache = {}
+
         # where we store all data
         self._working_directory = os.path.abspath(working_directory)
 
@@ -295,16 +357,32 @@ class Dispersy(Singleton):
             if not os.path.isdir(database_directory):
                 os.makedirs(database_directory)
             database_filename = os.path.join(database_directory, database_filename)
-        self._database = DispersyDatabase.get_instance(database_filename)
+        database = DispersyDatabase.has_instance()
+        if database is None:
+            self._database = DispersyDatabase.get_instance(database_filename)
+        elif database.file_path() == database_filename and not database_filename == u":memory:":
+            self._database = database
+        else:
+            # another Dispersy instance is running in this process, this instance gets its own
+            # database.  members are created in the database of the Dispersy instance that is bound
+            # to the current thread, see member.get_database
+            self._database = DispersyDatabase(database_filename)
+
+        # bind this instance to the callback thread, allowing multiple Dispersy instances to run in
+        # one process as long as each has its own callback
+        self._callback.register(self._bind_instance, priority=1024)
 
         # peer selection candidates.  address:Candidate pairs (where
         # address is obtained from socket.recv_from)
         self._candidates = GlobalCandidateCache(self)
-        self._callback.register(self._periodically_cleanup_candidates)
+        self._callback.register(self._periodically_expire_candidates)
 
         # assigns temporary cache objects to unique identifiers
         self._request_cache = RequestCache(self._callback)
 
+        # holds the packets that are delayed until a MissingSomethingCache request is answered
+        self._delayed_packets = DelayedPacketStore()
+
         # indicates what our connection type is.  currently it can be u"unknown", u"public", or
         # u"symmetric-NAT"
         self._connection_type = u"unknown"
@@ -330,6 +408,11 @@ class Dispersy(Singleton):
         self._communities = {}
         self._walker_commmunities = []
 
+        # (prefixes, cids) tuple used by the endpoint to reject packets for unknown communities,
+        # conversions, and messages.  see packet_filter
+        self._packet_filter = None
+        self._update_packet_filter()
+
         # communication endpoint
         self._endpoint = DummyEndpoint()
 
@@ -364,6 +447,25 @@ class Dispersy(Singleton):
             self._callback.register(self._stats_candidates)
             self._callback.register(self._stats_detailed_candidates)
 
+    def _bind_instance(self):
+        """
+        Bind this Dispersy instance to the current (callback) thread until the callback stops.
+
+        Dispersy.get_instance() and Member creation, when called from this thread, will use this
+        instance and its database.  When the callback stops the instance is unbound and, when this
+        instance created its own database, that database is closed.
+        """
+        Dispersy.bind_instance(self, singleton_placeholder=Dispersy)
+        try:
+            while True:
+                yield 3600.0
+
+        finally:
+            if Dispersy.has_instance() is self:
+                Dispersy.unbind_instance(singleton_placeholder=Dispersy)
+            if not self._database is DispersyDatabase.has_instance():
+                self._database.close()
+
     @staticmethod
     def _guess_lan_address():
         """
@@ -458,6 +560,47 @@ class Dispersy(Singleton):
     # .setter was introduced in Python 2.6
     endpoint = property(__get_endpoint, __set_endpoint)
 
+    @property
+    def packet_filter(self):
+        """
+        The filter used by the endpoint to reject packets before they are given to Dispersy.
+
+        This is either None, when all packets must be accepted, or a (prefixes, cids) tuple.  A
+        packet is accepted when its first 23 bytes, i.e. the conversion prefix followed by the
+        message byte, are in PREFIXES or when its community identifier is in CIDS.
+
+        The endpoint reads this property from its own thread, hence the filter is replaced, never
+        modified.
+        @rtype: (frozenset, frozenset) or None
+        """
+        return self._packet_filter
+
+    def _update_packet_filter(self):
+        """
+        Rebuild the packet filter.
+
+        Must be called whenever a community is attached or detached, or when the communities that
+        can be auto loaded change.
+        """
+        prefixes = set()
+        cids = set()
+        for community in self._communities.itervalues():
+            community_prefixes = community.get_packet_prefixes()
+            if community_prefixes is None:
+                cids.add(community.cid)
+            else:
+                prefixes.update(community_prefixes)
+
+        # communities that are not loaded, but will be when a packet is received
+        if self._auto_load_communities:
+            classifications = self._auto_load_communities.keys()
+            cids.update(str(mid)
+                        for mid,
+                        in self._database.execute(u"SELECT member.mid FROM community JOIN member ON member.id = community.master WHERE community.auto_load = 1 AND community.classification IN (" + ", ".join("?" * len(classifications)) + ")",
+                                                  classifications))
+
+        self._packet_filter = (frozenset(prefixes), frozenset(cids))
+
     @property
     def lan_address(self):
         """
@@ -523,6 +666,14 @@ class Dispersy(Singleton):
         """
         return self._request_cache
 
+    @property
+    def delayed_packets(self):
+        """
+        The store holding the packets that are delayed until an outstanding request is answered.
+        @rtype: DelayedPacketStore
+        """
+        return self._delayed_packets
+
     @property
     def statistics(self):
         """
@@ -608,6 +759,7 @@ class Dispersy(Singleton):
         assert kargs is None or isinstance(kargs, dict)
         assert not community.get_classification() in self._auto_load_communities
         self._auto_load_communities[community.get_classification()] = (community, args, kargs if kargs else {})
+        self._update_packet_filter()
 
     def undefine_auto_load(self, community):
         """
@@ -620,6 +772,7 @@ class Dispersy(Singleton):
         assert issubclass(community, Community)
         assert community.get_classification() in self._auto_load_communities
         del self._auto_load_communities[community.get_classification()]
+        self._update_packet_filter()
 
     def attach_progress_handler(self, func):
         assert callable(func), "handler must be callable"
@@ -735,8 +888,20 @@ class Dispersy(Singleton):
         assert not community in self._walker_commmunities
         self._communities[community.cid] = community
         community.dispersy_check_database()
+        self._update_packet_filter()
 
         if community.dispersy_enable_candidate_walker:
+            # the walker scheduler state is kept in the community because the walker is restarted
+            # whenever a community is attached or detached.  a new community starts at the lowest
+            # pass value, otherwise it would take every step until it caught up with the others
+            now = time()
+            community.__walk_pass = min(other.__walk_pass for other in self._walker_commmunities) if self._walker_commmunities else 0.0
+            community.__walk_start = now
+            community.__walk_steps = 0
+            community.__walk_weight = 1.0
+            community.__walk_activity = 0.0
+            community.__walk_churn = 0.0
+            community.__walk_sample = (now, community.statistics.messages_stored, community.statistics.candidates_joined)
             self._walker_commmunities.insert(0, community)
             # restart walker scheduler
             self._callback.replace_register(CANDIDATE_WALKER_CALLBACK_ID, self._candidate_walker)
@@ -785,10 +950,13 @@ class Dispersy(Singleton):
                 self._callback.unregister(CANDIDATE_WALKER_CALLBACK_ID)
 
         # remove any items that are left in the cache
-        for meta in community.get_meta_messages():
-            if meta.batch.enabled and meta in self._batch_cache:
-                task_identifier, _, _ = self._batch_cache[meta]
-                self._callback.unregister(task_identifier)
+        for task_identifier, _, _ in self._batch_cache.pop(community, {}).itervalues():
+            self._callback.unregister(task_identifier)
+
+        # remove all decoded messages
+        self._decoded_message_cache.pop(community.cid, None)
+
+        self._update_packet_filter()
 
     def reclassify_community(self, source, destination):
         """
@@ -927,12 +1095,12 @@ class Dispersy(Singleton):
         assert isinstance(member, Member)
         assert isinstance(global_time, (int, long))
         try:
-            packet, = self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                             (community.database_id, member.database_id, global_time)).next()
+            packet_id, packet = self._database.execute(u"SELECT id, packet FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                       (community.database_id, member.database_id, global_time)).next()
         except StopIteration:
             return None
         else:
-            return self.convert_packet_to_message(str(packet), community)
+            return self._decode_stored_message(community, member.database_id, global_time, packet_id, str(packet), True)
 
     def get_last_message(self, community, member, meta):
         if __debug__:
@@ -941,12 +1109,56 @@ class Dispersy(Singleton):
         assert isinstance(member, Member)
         assert isinstance(meta, Message)
         try:
-            packet, = self._database.execute(u"SELECT packet FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time DESC LIMIT 1",
-                                             (member.database_id, meta.database_id)).next()
+            packet_id, global_time, packet = self._database.execute(u"SELECT id, global_time, packet FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time DESC LIMIT 1",
+                                                                    (member.database_id, meta.database_id)).next()
         except StopIteration:
             return None
         else:
-            return self.convert_packet_to_message(str(packet), community)
+            return self._decode_stored_message(community, member.database_id, global_time, packet_id, str(packet), True)
+
+    def _decode_stored_message(self, community, member_database_id, global_time, packet_id, packet, verify):
+        """
+        Returns the Message.Implementation for PACKET or None when it can not be decoded.
+
+        PACKET must be the packet that is stored in the database for COMMUNITY, with PACKET_ID,
+        created by the member with MEMBER_DATABASE_ID at GLOBAL_TIME.  The decoded messages are kept
+        in a bounded per community cache, hence the same packet is only decoded, and verified, once.
+        The returned message is shared and must not be modified.
+        """
+        assert isinstance(member_database_id, (int, long))
+        assert isinstance(global_time, (int, long))
+        assert isinstance(packet_id, (int, long))
+        assert isinstance(packet, str)
+        assert isinstance(verify, bool)
+        cache = self._decoded_message_cache.get(community.cid)
+        if cache is None:
+            cache = self._decoded_message_cache[community.cid] = OrderedDict()
+
+        key = (member_database_id, global_time)
+        value = cache.pop(key, None)
+        if value and value[0].packet_id == packet_id and value[0].packet == packet and (value[1] or not verify):
+            # move to the most recently used position
+            cache[key] = value
+            return value[0]
+
+        message = self.convert_packet_to_message(packet, community, verify=verify)
+        if message:
+            message.packet_id = packet_id
+            cache[key] = (message, verify)
+            if len(cache) > community.dispersy_decoded_message_cache_size:
+                cache.popitem(last=False)
+        return message
+
+    def _invalidate_stored_messages(self, community, keys):
+        """
+        Remove decoded messages from the cache.
+
+        KEYS is an iterator with (member.database_id, global_time) tuples.
+        """
+        cache = self._decoded_message_cache.get(community.cid)
+        if cache:
+            for key in keys:
+                cache.pop(key, None)
 
     def wan_address_unvote(self, voter):
         """
@@ -1126,6 +1338,7 @@ class Dispersy(Singleton):
                         # replace our current message with the other one
                         self._database.execute(u"UPDATE sync SET packet = ? WHERE community = ? AND member = ? AND global_time = ?",
                                                (buffer(message.packet), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        self._invalidate_stored_messages(community, [(message.authentication.member.database_id, message.distribution.global_time)])
 
                         # notify that global times have changed
                         # community.update_sync_range(message.meta, [message.distribution.global_time])
@@ -1561,23 +1774,7 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         except StopIteration:
             return None
 
-        # find associated conversion
-        try:
-            conversion = community.get_conversion(packet[:22])
-        except KeyError:
-            if __debug__: dprint("unable to convert a ", len(packet), " byte packet (unknown conversion)", level="warning")
-            return None
-
-        # attempt conversion
-        try:
-            message = conversion.decode_message(LoopbackCandidate(), packet, verify)
-
-        except (DropPacket, DelayPacket), exception:
-            if __debug__: dprint("unable to convert a ", len(packet), " byte packet (", exception, ")", level="warning")
-            return None
-
-        message.packet_id = packet_id
-        return message
+        return self._decode_stored_message(community, member.database_id, global_time, packet_id, str(packet), verify)
 
     def convert_packet_to_meta_message(self, packet, community=None, load=True, auto_load=True):
         """
@@ -1674,7 +1871,7 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
             probably indicates that we are running outdated software.
 
         All packets are grouped by their meta message.  All batches are scheduled based on the
-        meta.batch.max_window and meta.batch.priority.  Finally, the candidate table is updated in
+        meta.batch.window and meta.batch.priority.  Finally, the candidate table is updated in
         regards to the incoming source addresses.
 
         @param packets: The sequence of packets.
@@ -1691,26 +1888,43 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         
         self._statistics.received_count += len(packets)
 
-        sort_key = lambda tup: (tup[0].batch.priority, tup[0]) # meta, address, packet, conversion
-        groupby_key = lambda tup: tup[0] # meta, address, packet, conversion
-        for meta, iterator in groupby(sorted(self._convert_packets_into_batch(packets), key=sort_key), key=groupby_key):
-            batch = [(self._candidates.get(candidate.sock_addr) or self._bootstrap_candidates.get(candidate.sock_addr) or candidate, packet, conversion)
-                     for _, candidate, packet, conversion
-                     in iterator]
+        # group the packets by meta message in a single pass
+        batches = {}
+        for meta, candidate, packet, conversion in self._convert_packets_into_batch(packets):
+            try:
+                batches[meta].append((candidate, packet, conversion))
+            except KeyError:
+                batches[meta] = [(candidate, packet, conversion)]
+
+        for meta, batch in sorted(batches.iteritems(), key=lambda tup: tup[0].batch.priority):
+            # find the existing (bootstrap) candidate once for each address.  this is done per meta
+            # message because handling the previous batch may have created new candidates
+            candidates = {}
+            for index, (candidate, packet, conversion) in enumerate(batch):
+                sock_addr = candidate.sock_addr
+                try:
+                    existing = candidates[sock_addr]
+                except KeyError:
+                    existing = candidates[sock_addr] = self._candidates.get(sock_addr) or self._bootstrap_candidates.get(sock_addr)
+                if existing:
+                    batch[index] = (existing, packet, conversion)
 
             # schedule batch processing (taking into account the message priority)
             if meta.batch.enabled and cache:
-                if meta in self._batch_cache:
-                    task_identifier, current_timestamp, current_batch = self._batch_cache[meta]
+                community_cache = self._batch_cache.get(meta.community)
+                if community_cache and meta in community_cache:
+                    task_identifier, current_timestamp, current_batch = community_cache[meta]
                     current_batch.extend(batch)
                     if __debug__: dprint("adding ", len(batch), " ", meta.name, " messages to existing cache")
 
                 else:
+                    if community_cache is None:
+                        community_cache = self._batch_cache[meta.community] = {}
                     current_timestamp = timestamp
                     current_batch = batch
-                    task_identifier = self._callback.register(self._on_batch_cache_timeout, (meta, current_timestamp, current_batch), delay=meta.batch.max_window, priority=meta.batch.priority)
-                    self._batch_cache[meta] = (task_identifier, current_timestamp, current_batch)
-                    if __debug__: dprint("new cache with ", len(batch), " ", meta.name, " messages (batch window: ", meta.batch.max_window, ")")
+                    task_identifier = self._callback.register(self._on_batch_cache_timeout, (meta, current_timestamp, current_batch), delay=meta.batch.window, priority=meta.batch.priority)
+                    community_cache[meta] = (task_identifier, current_timestamp, current_batch)
+                    if __debug__: dprint("new cache with ", len(batch), " ", meta.name, " messages (batch window: ", meta.batch.window, ")")
 
                 while len(current_batch) > meta.batch.max_size:
                     # batch exceeds maximum size, schedule first max_size immediately
@@ -1718,8 +1932,8 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
                     if __debug__: dprint("schedule processing ", len(batch), " ", meta.name, " messages immediately (exceeded batch size)")
                     self._callback.register(self._on_batch_cache_timeout, (meta, current_timestamp, batch), priority=meta.batch.priority)
 
-                    task_identifier = self._callback.replace_register(task_identifier, self._on_batch_cache_timeout, (meta, timestamp, current_batch), delay=meta.batch.max_window, priority=meta.batch.priority)
-                    self._batch_cache[meta] = (task_identifier, timestamp, current_batch)
+                    task_identifier = self._callback.replace_register(task_identifier, self._on_batch_cache_timeout, (meta, timestamp, current_batch), delay=meta.batch.window, priority=meta.batch.priority)
+                    community_cache[meta] = (task_identifier, timestamp, current_batch)
 
             else:
                 # ignore cache, process batch immediately
@@ -1730,8 +1944,9 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         """
         Start processing a batch of messages once the cache timeout occurs.
 
-        This method is called meta.batch.max_window seconds after the first message in this batch
-        arrived.  All messages in this batch have been 'cached' together in self._batch_cache[meta].
+        This method is called meta.batch.window seconds after the first message in this batch
+        arrived.  All messages in this batch have been 'cached' together in
+        self._batch_cache[meta.community][meta].
         Hopefully the delay caused the batch to collect as many messages as possible.
         """
         assert isinstance(meta, Message)
@@ -1741,8 +1956,11 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         if __debug__:
             dprint("processing  ", len(batch), "x ", meta.name, " batched messages")
 
-        if meta in self._batch_cache and id(self._batch_cache[meta][2]) == id(batch):
-            self._batch_cache.pop(meta)
+        community_cache = self._batch_cache.get(meta.community)
+        if community_cache and meta in community_cache and community_cache[meta][2] is batch:
+            del community_cache[meta]
+            if not community_cache:
+                del self._batch_cache[meta.community]
 
         if not self._communities.get(meta.community.cid, None) == meta.community:
             if __debug__: 
@@ -1758,7 +1976,11 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
             self._statistics.drop_count += len(batch)
             return 0
 
-        return self._on_batch_cache(meta, batch)
+        begin = time()
+        result = self._on_batch_cache(meta, batch)
+        end = time()
+        meta.batch.batch_processed(len(batch), end - begin, end)
+        return result
 
     def _on_batch_cache(self, meta, batch):
         """
@@ -1885,6 +2107,13 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         if not messages:
             return 0
 
+        # decode the payload of the remaining messages.  payloads of duplicate or old messages are
+        # never decoded, except for sequence number and LastSyncDistribution messages whose payload
+        # is decoded in _convert_batch_into_messages
+        messages = list(self._decode_batch_payloads(messages))
+        if not messages:
+            return 0
+
         # check all remaining messages on the community side.  may yield Message.Implementation,
         # DropMessage, and DelayMessage instances
         try:
@@ -1912,12 +2141,21 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
             
             self._statistics.dict_inc(self._statistics.success, meta.name, len(messages))
             self._statistics.success_count += len(messages)
+            if isinstance(meta.distribution, SyncDistribution):
+                # only synchronized messages count towards the walker weight.  counting the walker
+                # messages themselves would give more steps to communities that already take many
+                meta.community.statistics.messages_stored += len(messages)
+
+                # resume the packets and messages that were waiting for these messages, i.e. after a
+                # dispersy-missing-message or dispersy-missing-last-message request
+                if not isinstance(meta.authentication, NoAuthentication):
+                    self.handle_missing_messages(messages, MissingMessageCache, MissingLastMessageCache)
 
             # tell what happened
             if __debug__:
                 debug_end = time()
                 level = "warning" if (debug_end - debug_begin) > 1.0 else "normal"
-                dprint("handled ", len(messages), "/", debug_count, " %.2fs" % (debug_end - debug_begin), " ", meta.name, " messages (with ", meta.batch.max_window, "s cache window)", level=level)
+                dprint("handled ", len(messages), "/", debug_count, " %.2fs" % (debug_end - debug_begin), " ", meta.name, " messages (with ", meta.batch.window, "s cache window)", level=level)
     
             # return the number of messages that were correctly handled (non delay, duplictes, etc)
             return len(messages)
@@ -1997,8 +2235,18 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
             assert isinstance(conversion, Conversion)
 
             try:
-                # convert binary data to internal Message
-                yield conversion.decode_message(candidate, packet)
+                # convert binary data to internal Message.  the payload is decoded in
+                # on_message_batch, after duplicate messages have been removed
+                message = conversion.decode_message(candidate, packet, lazy_payload=True)
+
+                # the distribution check for sequence numbers and LastSyncDistribution keeps track
+                # of the accepted messages, hence these messages must be valid before they are
+                # checked
+                distribution = message.meta.distribution
+                if isinstance(distribution, LastSyncDistribution) or (isinstance(distribution, FullSyncDistribution) and distribution.enable_sequence_number):
+                    message.payload
+
+                yield message
 
             except DropPacket, exception:
                 if __debug__:
@@ -2015,6 +2263,39 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
                 self._statistics.dict_inc(self._statistics.delay, "_convert_batch_into_messages:%s" % delay)
                 self._statistics.delay_count += 1
 
+    def _decode_batch_payloads(self, messages):
+        """
+        Decode the payload of MESSAGES that were decoded with lazy_payload=True.
+
+        Messages whose payload can not be decoded are dropped or delayed, exactly as they would have
+        been in _convert_batch_into_messages.
+        """
+        for message in messages:
+            if message.has_payload:
+                yield message
+                continue
+
+            try:
+                message.payload
+
+            except DropPacket, exception:
+                if __debug__:
+                    dprint("drop a ", len(message.packet), " byte packet (", exception, ") from ", message.candidate, level="warning")
+                self._statistics.dict_inc(self._statistics.drop, "_convert_batch_into_messages:%s" % exception)
+                self._statistics.drop_count += 1
+
+            except DelayPacket, delay:
+                if __debug__:
+                    dprint("delay a ", len(message.packet), " byte packet (", delay, ") from ", message.candidate)
+
+                if delay.create_request(message.candidate, message.packet):
+                    self._statistics.delay_send += 1
+                self._statistics.dict_inc(self._statistics.delay, "_convert_batch_into_messages:%s" % delay)
+                self._statistics.delay_count += 1
+
+            else:
+                yield message
+
     def _store(self, messages):
         """
         Store a message in the database.
@@ -2096,7 +2377,7 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
                 for member1, member2 in set(order(message.authentication.members[0].database_id, message.authentication.members[1].database_id) for message in messages):
                     assert member1 < member2, [member1, member2]
                     all_items = list(self._database.execute(u"""
-SELECT sync.id, sync.global_time
+SELECT sync.id, sync.member, sync.global_time
 FROM sync
 JOIN double_signed_sync ON double_signed_sync.sync = sync.id
 WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed_sync.member2 = ?
@@ -2107,7 +2388,7 @@ ORDER BY sync.global_time, sync.packet""", (meta.database_id, member1, member2))
             else:
                 for member_database_id in set(message.authentication.member.database_id for message in messages):
                     all_items = list(self._database.execute(u"""
-SELECT id, global_time
+SELECT id, member, global_time
 FROM sync
 WHERE meta_message = ? AND member = ?
 ORDER BY global_time, packet""", (meta.database_id, member_database_id)))
@@ -2115,14 +2396,16 @@ ORDER BY global_time, packet""", (meta.database_id, member_database_id)))
                         items.update(all_items[:len(all_items) - meta.distribution.history_size])
 
             if items:
-                self._database.executemany(u"DELETE FROM sync WHERE id = ?", [(syncid, ) for syncid,_ in items])
+                self._database.executemany(u"DELETE FROM sync WHERE id = ?", [(syncid, ) for syncid, _, _ in items])
                 assert len(items) == self._database.changes
                 if __debug__: dprint("deleted ", self._database.changes, " messages")
 
                 if is_double_member_authentication:
-                    self._database.executemany(u"DELETE FROM double_signed_sync WHERE sync = ?", [(syncid, ) for syncid,_ in items])
+                    self._database.executemany(u"DELETE FROM double_signed_sync WHERE sync = ?", [(syncid, ) for syncid, _, _ in items])
                     assert len(items) == self._database.changes
 
+                self._invalidate_stored_messages(meta.community, ((member_database_id, global_time) for _, member_database_id, global_time in items))
+
                 # update_sync_range.update(global_time for _, _, global_time in items)
 
             # 12/10/11 Boudewijn: verify that we do not have to many packets in the database
@@ -2223,6 +2506,7 @@ ORDER BY global_time, packet""", (meta.database_id, member_database_id)))
     def handle_missing_messages(self, messages, *classes):
         assert all(isinstance(message, Message.Implementation) for message in messages)
         assert all(issubclass(cls, MissingSomethingCache) for cls in classes)
+        delayed_packets = []
         for message in messages:
             for cls in classes:
                 cache = self._request_cache.pop(cls.message_to_identifier(message), cls)
@@ -2230,6 +2514,13 @@ ORDER BY global_time, packet""", (meta.database_id, member_database_id)))
                     if __debug__: dprint("found request cache for ", message)
                     for response_func, response_args in cache.callbacks:
                         response_func(message, *response_args)
+                    delayed_packets.extend(self._delayed_packets.pop(cache.identifier))
+
+        if delayed_packets:
+            # process all packets that were waiting for MESSAGES at once
+            if __debug__: dprint("resume ", len(delayed_packets), " delayed packets")
+            self._statistics.delay_success += len(delayed_packets)
+            self.on_incoming_packets(delayed_packets)
 
     def create_introduction_request(self, community, destination, allow_sync, forward=True):
         assert isinstance(destination, WalkCandidate), [type(destination), destination]
@@ -2252,7 +2543,7 @@ ORDER BY global_time, packet""", (meta.database_id, member_database_id)))
 
         else:
             # flush any sync-able items left in the cache before we create a sync
-            flush_list = [(meta, tup) for meta, tup in self._batch_cache.iteritems() if meta.community == community and isinstance(meta.distribution, SyncDistribution)]
+            flush_list = [(meta, tup) for meta, tup in self._batch_cache.get(community, {}).iteritems() if isinstance(meta.distribution, SyncDistribution)]
             flush_list.sort(key=lambda tup: tup[0].batch.priority, reverse=True)
             for meta, (task_identifier, timestamp, batch) in flush_list:
                 if __debug__: dprint("flush cached ", len(batch), "x ", meta.name, " messages (id: ", task_identifier, ")")
@@ -2399,6 +2690,9 @@ WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND
 
             # update sender candidate
             candidate.update(candidate.tunnel, source_lan_address, source_wan_address, payload.connection_type)
+            if not candidate.in_community(community, now):
+                # churn that our own walker did not cause, see _update_walker_weight
+                community.statistics.candidates_joined += 1
             candidate.stumble(community, now)
             # candidate.active(community, now)
             self._filter_duplicate_candidate(candidate)
@@ -2778,7 +3072,9 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
            message.destination.members.
 
          - CommunityDestination causes a message to be sent to one or more addresses to be picked
-           from the database candidate table.
+           from the database candidate table.  These addresses are picked once for all messages.
+
+        The messages are grouped by candidate and given to the endpoint in a single call.
 
         @param messages: A sequence with one or more messages.
         @type messages: [Message.Implementation]
@@ -2789,32 +3085,49 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         assert all(message.community == messages[0].community for message in messages)
         assert all(message.meta == messages[0].meta for message in messages)
 
-        result = False
         meta = messages[0].meta
         if isinstance(meta.destination, CommunityDestination):
             # CommunityDestination.node_count is allowed to be zero
             if meta.destination.node_count > 0:
-                result = all(self._send(list(islice(meta.community.dispersy_yield_random_candidates(), meta.destination.node_count)), [message]) for message in messages)
+                # select the candidates once for the entire batch
+                candidates = [candidate for candidate in islice(meta.community.dispersy_yield_random_candidates(), meta.destination.node_count) if candidate]
+                messages = list(messages)
+                batch = dict((candidate, messages) for candidate in candidates)
+            else:
+                batch = {}
 
         elif isinstance(meta.destination, CandidateDestination):
             # CandidateDestination.candidates may be empty
-            result = all(self._send(message.destination.candidates, [message]) for message in messages)
+            batch = {}
+            for message in messages:
+                for candidate in message.destination.candidates:
+                    if candidate:
+                        if candidate in batch:
+                            batch[candidate].append(message)
+                        else:
+                            batch[candidate] = [message]
 
         elif isinstance(meta.destination, MemberDestination):
             # MemberDestination.candidates may be empty
-            result = all(self._send([candidate
-                                            for candidate
-                                            in self._candidates.itervalues()
-                                            if any(candidate.is_associated(message.community, member)
-                                                   for member
-                                                   in message.destination.members)],
-                                           [message])
-                       for message
-                       in messages)
+            batch = {}
+            get_associated_candidates = meta.community._candidates.get_associated_candidates
+            for message in messages:
+                # a message is sent once to each candidate, even when the candidate is associated
+                # with more than one of its members
+                candidates = set()
+                for member in message.destination.members:
+                    candidates.update(get_associated_candidates(member))
+                for candidate in candidates:
+                    if candidate in batch:
+                        batch[candidate].append(message)
+                    else:
+                        batch[candidate] = [message]
 
         else:
             raise NotImplementedError(meta.destination)
-        
+
+        result = self._send_batch(batch)
+
         if __debug__ and not result:
             candidates = list(islice(meta.community.dispersy_yield_random_candidates(), 10))
             dprint("_forward failed, did not send %d %s messages destinationtype %s nr candidates %d"%(len(messages), meta.name, type(meta.destination), len(candidates)), level="warning")
@@ -2848,6 +3161,35 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 self._statistics.dict_inc(self._statistics.outgoing, message.meta.name, len(candidates))
         
         return messages_send
+
+    def _send_batch(self, batch):
+        """
+        Send messages to candidates, where each candidate may receive different messages.
+
+        All packets are handed to the endpoint at once, hence the endpoint only needs to queue
+        them once.  If BATCH is empty or the endpoint reported a failure this method will return
+        False.
+
+        @param batch: A dictionary containing Candidate:[Message.Implementation] pairs.
+        @type batch: dict
+        """
+        assert isinstance(batch, dict), type(batch)
+        assert all(isinstance(candidate, Candidate) for candidate in batch.iterkeys())
+        assert all(isinstance(messages, list) for messages in batch.itervalues())
+        assert all(isinstance(message, Message.Implementation) for messages in batch.itervalues() for message in messages)
+
+        messages_send = False
+        if batch:
+            messages_send = self._endpoint.send_batch(dict((candidate, [message.packet for message in messages])
+                                                           for candidate, messages
+                                                           in batch.iteritems()))
+
+        if messages_send:
+            for messages in batch.itervalues():
+                for message in messages:
+                    self._statistics.dict_inc(self._statistics.outgoing, message.meta.name)
+
+        return messages_send
     
     def declare_malicious_member(self, member, packets):
         """
@@ -2897,6 +3239,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         # remove all messages created by the malicious member
         self._database.execute(u"DELETE FROM sync WHERE community = ? AND member = ?",
                                (community.database_id, member.database_id))
+        self._invalidate_stored_messages(community, [key for key in self._decoded_message_cache.get(community.cid, ()) if key[0] == member.database_id])
 
         # TODO: if we have a address for the malicious member, we can also remove her from the
         # candidate table
@@ -2928,10 +3271,10 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             self._statistics.dict_inc(self._statistics.outgoing, u"-malicious-proof", len(packets))
             self._endpoint.send([candidate], packets)
 
-    def create_missing_message(self, community, candidate, member, global_time, response_func=None, response_args=(), timeout=10.0):
+    def create_missing_message(self, community, candidate, member, global_time, response_func=None, response_args=(), timeout=10.0, delayed_packet=None):
         # ensure that the identifier is 'triggered' somewhere, i.e. using
         # handle_missing_messages(messages, MissingMessageCache)
-        
+
         sendRequest = False
 
         identifier = MissingMessageCache.properties_to_identifier(community, member, global_time)
@@ -2941,15 +3284,20 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             cache = MissingMessageCache(timeout)
             self._request_cache.set(identifier, cache)
 
-            meta = community.get_meta_message(u"dispersy-missing-message")
-            request = meta.impl(distribution=(community.global_time,), destination=(candidate,), payload=(member, [global_time]))
-            self._forward([request])
-            
+            cache.request = (community.get_meta_message(u"dispersy-missing-message"), (member, [global_time]))
+            cache.add_candidate(candidate)
+            cache.send_request()
+
             sendRequest = True
 
+        else:
+            cache.add_candidate(candidate)
+
         if response_func:
             cache.callbacks.append((response_func, response_args))
-        
+        if delayed_packet:
+            self._delayed_packets.add(identifier, *delayed_packet)
+
         return sendRequest
 
     def on_missing_message(self, messages):
@@ -2973,7 +3321,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             self._statistics.dict_inc(self._statistics.outgoing, u"-missing-message", len(responses))
             self._endpoint.send([candidate], [packet for _, packet in responses])
 
-    def create_missing_last_message(self, community, candidate, member, message, count_, response_func=None, response_args=(), timeout=10.0):
+    def create_missing_last_message(self, community, candidate, member, message, count_, response_func=None, response_args=(), timeout=10.0, delayed_packet=None):
         if __debug__:
             from .community import Community
             assert isinstance(community, Community)
@@ -2994,12 +3342,18 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             cache = MissingLastMessageCache(timeout)
             self._request_cache.set(identifier, cache)
 
-            meta = community.get_meta_message(u"dispersy-missing-last-message")
-            request = meta.impl(distribution=(community.global_time,), destination=(candidate,), payload=(member, message, count_))
-            self._forward([request])
+            cache.request = (community.get_meta_message(u"dispersy-missing-last-message"), (member, message, count_))
+            cache.add_candidate(candidate)
+            cache.send_request()
             sendRequest = True
 
-        cache.callbacks.append((response_func, response_args))
+        else:
+            cache.add_candidate(candidate)
+
+        if response_func:
+            cache.callbacks.append((response_func, response_args))
+        if delayed_packet:
+            self._delayed_packets.add(identifier, *delayed_packet)
         return sendRequest
 
     def on_missing_last_message(self, messages):
@@ -3095,22 +3449,20 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
         """
         We received a dispersy-identity message.
         """
-        for message in messages:
-            # get cache object linked to this request and stop timeout from occurring
-            identifier = MissingMemberCache.message_to_identifier(message)
-            cache = self._request_cache.pop(identifier, MissingMemberCache)
-            if cache:
-                for func, args in cache.callbacks:
-                    func(message, *args)
+        self.handle_missing_messages(messages, MissingMemberCache)
 
-    def create_missing_identity(self, community, candidate, dummy_member, response_func=None, response_args=(), timeout=4.5, forward=True):
+    def create_missing_identity(self, community, candidate, dummy_member, response_func=None, response_args=(), timeout=4.5, forward=True, delayed_packet=None):
         """
         Create a dispersy-missing-identity message.
 
         To verify a message signature we need the corresponding public key from the member who made
         the signature.  When we are missing a public key, we can request a dispersy-identity message
         which contains this public key.
-        
+
+        Only one request is outstanding for each missing public key.  Other candidates that
+        trigger the same request are asked when the request times out.  DELAYED_PACKET, a
+        (candidate, packet) tuple, is processed again once the dispersy-identity message arrives.
+
         # @return True if actual request is made
         """
         if __debug__:
@@ -3133,13 +3485,19 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             self._request_cache.set(identifier, cache)
 
             if __debug__: dprint(candidate, " sending missing-identity ", dummy_member.mid.encode("HEX"))
-            meta = community.get_meta_message(u"dispersy-missing-identity")
-            request = meta.impl(distribution=(community.global_time,), destination=(candidate,), payload=(dummy_member.mid,))
-            self._forward([request])
-            
+            cache.request = (community.get_meta_message(u"dispersy-missing-identity"), (dummy_member.mid,))
+            cache.add_candidate(candidate)
+            cache.send_request()
+
             sendRequest = True
 
-        cache.callbacks.append((response_func, response_args))
+        else:
+            cache.add_candidate(candidate)
+
+        if response_func:
+            cache.callbacks.append((response_func, response_args))
+        if delayed_packet:
+            self._delayed_packets.add(identifier, *delayed_packet)
         return sendRequest
 
     def on_missing_identity(self, messages):
@@ -3381,6 +3739,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 # add our own signatures and we can handle the message
                 for signature, member in new_submsg.authentication.signed_members:
                     if not signature and member.private_key:
+                        self._statistics.sign_count += 1
                         new_submsg.authentication.set_signature(member, member.sign(new_body))
 
                 assert new_submsg.authentication.is_signed
@@ -3534,16 +3893,11 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
     def on_missing_proof(self, messages):
         community = messages[0].community
         for message in messages:
-            try:
-                packet, = self._database.execute(u"SELECT packet FROM sync WHERE community = ? AND member = ? AND global_time = ? LIMIT 1",
-                                                 (community.database_id, message.payload.member.database_id, message.payload.global_time)).next()
-
-            except StopIteration:
+            msg = self.load_message(community, message.payload.member, message.payload.global_time)
+            if msg is None:
                 if __debug__: dprint("someone asked for proof for a message that we do not have", level="warning")
 
             else:
-                packet = str(packet)
-                msg = self.convert_packet_to_message(packet, community, verify=False)
                 allowed, proofs = community.timeline.check(msg)
                 if allowed and proofs:
                     if __debug__:
@@ -3887,10 +4241,10 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 # search for the second offending dispersy-undo message
                 member = message.authentication.member
                 undo_own_meta = community.get_meta_message(u"dispersy-undo-own")
-                for packet_id, packet in self._database.execute(u"SELECT id, packet FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
-                                                                            (community.database_id, member.database_id, undo_own_meta.database_id)):
-                    msg = Packet(undo_own_meta, str(packet), packet_id).load_message()
-                    if message.payload.global_time == msg.payload.global_time:
+                for packet_id, global_time, packet in list(self._database.execute(u"SELECT id, global_time, packet FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
+                                                                                   (community.database_id, member.database_id, undo_own_meta.database_id))):
+                    msg = self._decode_stored_message(community, member.database_id, global_time, packet_id, str(packet), False)
+                    if msg and message.payload.global_time == msg.payload.global_time:
                         if __debug__: dprint("detected malicious behavior", level="warning")
                         self.declare_malicious_member(member, [msg, message])
 
@@ -3925,6 +4279,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
 
         self._database.executemany(u"UPDATE sync SET undone = ? WHERE community = ? AND member = ? AND global_time = ?",
                                    ((message.packet_id, message.community.database_id, message.payload.member.database_id, message.payload.global_time) for message in messages))
+        self._invalidate_stored_messages(messages[0].community, ((message.payload.member.database_id, message.payload.global_time) for message in messages))
         for meta, iterator in groupby(messages, key=lambda x: x.payload.packet.meta):
             sub_messages = list(iterator)
             meta.undo_callback([(message.payload.member, message.payload.global_time, message.payload.packet) for message in sub_messages])
@@ -4345,8 +4700,7 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                 yield message
 
         else:
-            for message in messages:
-                allowed, proofs = meta.community.timeline.check(message)
+            for message, (allowed, _) in zip(messages, meta.community.timeline.check_batch(messages)):
                 if allowed:
                     yield message
                 else:
@@ -4408,21 +4762,28 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
     def _candidate_walker(self):
         """
         Periodically select a candidate and take a step in the network.
+
+        The steps are divided over the communities using stride scheduling.  Every community has a
+        pass value that increases by 1 / weight for each step that it takes, and the community with
+        the lowest pass value takes the next step.  The weight of a community is updated after each
+        of its steps, see _update_walker_weight.
+
+        A community with weight W asks for W steps every WALKER_STEP_INTERVAL seconds.  The walker
+        takes as many steps as all communities together ask for, but never more than
+        WALKER_STEP_BUDGET steps per second.  Once the budget is exceeded, i.e. with more than 50
+        idle communities, the steps are divided in proportion to the weights and the interval
+        between the steps of each community becomes larger.
         """
         walker_communities = self._walker_commmunities
 
-        steps = 0
-        start = time()
-
-        # delay will never be less than 0.1, hence we can accommodate 50 communities before the
-        # interval between each step becomes larger than 5.0 seconds
-        optimaldelay = max(0.1, 5.0 / len(walker_communities))
+        optimaltime = time()
+        optimaldelay = 1.0 / min(WALKER_STEP_BUDGET, sum(community.__walk_weight for community in walker_communities) / WALKER_STEP_INTERVAL)
         if __debug__: dprint("there are ", len(walker_communities), " walker enabled communities.  pausing ", optimaldelay, "s (on average) between each step")
 
         if __debug__:
             RESETS = 0
             STEPS = 0
-            START = start
+            START = optimaltime
             DELAY = 0.0
             for community in walker_communities:
                 community.__MOST_RECENT_WALK = 0.0
@@ -4431,8 +4792,9 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             community.__most_recent_sync = 0.0
 
         while True:
-            community = walker_communities.pop(0)
-            walker_communities.append(community)
+            # with equal weights this is round robin, starting with the most recently attached
+            # community
+            community = min(walker_communities, key=lambda community: community.__walk_pass)
 
             actualtime = time()
             allow_sync = actualtime - community.__most_recent_sync > 4.5
@@ -4442,10 +4804,9 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
 
             if __debug__:
                 NOW = time()
-                OPTIMALSTEPS = (NOW - START) / optimaldelay
                 STEPDIFF = NOW - community.__MOST_RECENT_WALK
                 community.__MOST_RECENT_WALK = NOW
-                dprint(community.cid.encode("HEX"), " taking step every ", "%.2f" % DELAY, " sec in ", len(walker_communities), " communities.  steps: ", STEPS, "/", int(OPTIMALSTEPS), " ~ %.2f." % (-1.0 if OPTIMALSTEPS == 0.0 else (STEPS / OPTIMALSTEPS)), "  diff: %.1f" % STEPDIFF, ".  resets: ", RESETS)
+                dprint(community.cid.encode("HEX"), " taking step every ", "%.2f" % DELAY, " sec in ", len(walker_communities), " communities.  steps: ", STEPS, " in %.1f" % (NOW - START), " seconds.  diff: %.1f" % STEPDIFF, ".  resets: ", RESETS)
                 STEPS += 1
 
             # walk
@@ -4453,17 +4814,24 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
             assert community.dispersy_enable_candidate_walker_responses
             try:
                 community.dispersy_take_step(allow_sync)
-                steps += 1
             except Exception:
                 dprint(community.cid.encode("HEX"), " causes an exception during dispersy_take_step", exception=True, level="error")
 
-            optimaltime = start + steps * optimaldelay
             actualtime = time()
+            weight = community.__walk_weight = self._update_walker_weight(community, actualtime)
+            community.__walk_pass += 1.0 / weight
+            community.__walk_steps += 1
+            community.statistics.walk_steps += 1
+            community.statistics.walk_weight = weight
+            community.statistics.walk_rate = community.__walk_steps / max(1.0, actualtime - community.__walk_start)
+
+            # the delay follows the weights, which change after every step
+            optimaldelay = 1.0 / min(WALKER_STEP_BUDGET, sum(community.__walk_weight for community in walker_communities) / WALKER_STEP_INTERVAL)
+            optimaltime += optimaldelay
 
             if optimaltime + 5.0 < actualtime:
                 # way out of sync!  reset start time
-                start = actualtime
-                steps = 0
+                optimaltime = actualtime
                 self._statistics.walk_reset += 1
                 if __debug__:
                     dprint("can not keep up!  resetting walker start time!", level="warning")
@@ -4475,18 +4843,52 @@ ORDER BY meta_message.priority DESC, sync.global_time * meta_message.direction""
                     DELAY = max(0.0, optimaltime - actualtime)
                 yield max(0.0, optimaltime - actualtime)
 
-    def _periodically_cleanup_candidates(self):
+    def _update_walker_weight(self, community, now):
+        """
+        Returns the walker weight of COMMUNITY, between 1.0 and WALKER_MAX_WEIGHT.
+
+        The weight grows with the recent activity in COMMUNITY: the number of received messages
+        with a SyncDistribution policy that were stored per second since its previous step,
+        smoothed over several steps.
+
+        The weight also grows with the churn in COMMUNITY: the number of candidates that joined per
+        WALKER_STEP_INTERVAL seconds, smoothed in the same way.  Only candidates that contacted us
+        while not being in the community are counted.  Candidates that we learn about through our
+        own introduction requests and the resulting punctures grow with the number of steps
+        themselves, hence they are not counted.
+
+        A community whose sync bloom filter received responses has more messages to synchronize,
+        which adds one to its weight.
         """
-        Periodically remove Candidate instance where all communities are obsolete.
+        messages_stored = community.statistics.messages_stored
+        candidates_joined = community.statistics.candidates_joined
+        sample_time, sample_stored, sample_joined = community.__walk_sample
+        if now > sample_time:
+            activity = (messages_stored - sample_stored) / (now - sample_time)
+            churn = (candidates_joined - sample_joined) * WALKER_STEP_INTERVAL / (now - sample_time)
+            community.__walk_activity = 0.75 * community.__walk_activity + 0.25 * activity
+            community.__walk_churn = 0.75 * community.__walk_churn + 0.25 * churn
+            community.__walk_sample = (now, messages_stored, candidates_joined)
+
+        backlog = 1.0 if community._sync_cache and community._sync_cache.responses_received > 0 else 0.0
+        return min(WALKER_MAX_WEIGHT, 1.0 + community.__walk_activity + community.__walk_churn + backlog)
+
+    def _periodically_expire_candidates(self):
+        """
+        Periodically advance the expiry wheel of every community.
+
+        Each community only visits the candidates that changed category or became obsolete since
+        the previous call.  Obsolete candidates are removed from the community and their WAN
+        address vote is withdrawn once no community knows them.
         """
         while True:
-            yield 5 * 60.0
+            yield CANDIDATE_EXPIRY_RESOLUTION
 
             now = time()
-            for key, candidate in [(key, candidate) for key, candidate in self._candidates.iteritems() if candidate.is_all_obsolete(now)]:
-                if __debug__: dprint("removing obsolete candidate ", candidate)
-                del self._candidates[key]
-                self.wan_address_unvote(candidate)
+            for community in self._communities.values():
+                for candidate in community._candidates.expire(now):
+                    if not candidate.sock_addr in self._candidates:
+                        self.wan_address_unvote(candidate)
 
     if __debug__:
         def _stats_candidates(self):
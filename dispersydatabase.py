@@ -21,7 +21,7 @@ from .revision import update_revision_information
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
 
-LATEST_VERSION = 15
+LATEST_VERSION = 16
 
 schema = u"""
 CREATE TABLE member(
@@ -83,6 +83,12 @@ CREATE TABLE malicious_proof(
  member INTEGER REFERENCES name(id),
  packet BLOB);
 
+CREATE TABLE timeline_snapshot(
+ community INTEGER PRIMARY KEY REFERENCES community(id),
+ sync INTEGER,                                  -- highest sync(id) of the permission messages in the snapshot
+ count INTEGER,                                 -- number of permission messages in the snapshot
+ snapshot BLOB);                                -- Timeline.get_snapshot()
+
 CREATE TABLE option(key TEXT PRIMARY KEY, value BLOB);
 INSERT INTO option(key, value) VALUES('database_version', '""" + str(LATEST_VERSION) + """');
 """
@@ -91,6 +97,12 @@ class DispersyDatabase(Database):
     if __debug__:
         __doc__ = schema
 
+    def close(self, commit=True):
+        super(DispersyDatabase, self).close(commit)
+        # the cached members refer to this database
+        from .member import Member
+        Member.remove_caches(self)
+
     def check_database(self, database_version):
         assert isinstance(database_version, unicode)
         assert database_version.isdigit()
@@ -354,11 +366,25 @@ UPDATE option SET value = '13' WHERE key = 'database_version';
 
             # upgrade from version 15 to version 16
             if database_version < 16:
-                # there is no version 16 yet...
-                # if __debug__: dprint("upgrade database ", database_version, " -> ", 16)
-                # self.executescript(u"""UPDATE option SET value = '16' WHERE key = 'database_version';""")
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 16)
+                self.executescript(u"""
+CREATE TABLE timeline_snapshot(
+ community INTEGER PRIMARY KEY REFERENCES community(id),
+ sync INTEGER,
+ count INTEGER,
+ snapshot BLOB);
+UPDATE option SET value = '16' WHERE key = 'database_version';
+""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 16, " (done)")
+
+            # upgrade from version 16 to version 17
+            if database_version < 17:
+                # there is no version 17 yet...
+                # if __debug__: dprint("upgrade database ", database_version, " -> ", 17)
+                # self.executescript(u"""UPDATE option SET value = '17' WHERE key = 'database_version';""")
                 # self.commit()
-                # if __debug__: dprint("upgrade database ", database_version, " -> ", 16, " (done)")
+                # if __debug__: dprint("upgrade database ", database_version, " -> ", 17, " (done)")
                 pass
 
         return LATEST_VERSION
@@ -22,6 +22,8 @@ global_time.
 
 class Distribution(MetaObject):
     class Implementation(MetaObject.Implementation):
+        __slots__ = ["_global_time"]
+
         def __init__(self, meta, global_time):
             assert isinstance(meta, Distribution)
             assert isinstance(global_time, (int, long))
@@ -56,6 +58,8 @@ class SyncDistribution(Distribution):
     message is used to retrieve an identity whenever it is needed.
     """
     class Implementation(Distribution.Implementation):
+        __slots__ = []
+
         @property
         def synchronization_direction(self):
             return self._meta._synchronization_direction
@@ -136,6 +140,8 @@ class FullSyncDistribution(SyncDistribution):
     is not currently, and my never be, implemented.
     """
     class Implementation(SyncDistribution.Implementation):
+        __slots__ = ["_sequence_number"]
+
         def __init__(self, meta, global_time, sequence_number=0):
             assert isinstance(sequence_number, (int, long))
             assert (meta._enable_sequence_number and sequence_number > 0) or (not meta._enable_sequence_number and sequence_number == 0), (meta._enable_sequence_number, sequence_number)
@@ -172,6 +178,8 @@ class FullSyncDistribution(SyncDistribution):
 
 class LastSyncDistribution(SyncDistribution):
     class Implementation(SyncDistribution.Implementation):
+        __slots__ = []
+
         @property
         def cluster(self):
             return self._meta._cluster
@@ -192,8 +200,8 @@ class LastSyncDistribution(SyncDistribution):
 
 class DirectDistribution(Distribution):
     class Implementation(Distribution.Implementation):
-        pass
+        __slots__ = []
 
 class RelayDistribution(Distribution):
     class Implementation(Distribution.Implementation):
-        pass
+        __slots__ = []
@@ -1,11 +1,14 @@
 # Python 2.5 features
 from __future__ import with_statement
 
+from collections import deque
 from itertools import product
+from random import Random
 from select import select
 from time import time
 from traceback import print_exc
 import errno
+import os
 import socket
 import sys
 import threading
@@ -26,11 +29,287 @@ else:
 
 TUNNEL_PREFIX = "ffffffff".decode("HEX")
 DEBUG = False
+
+try:
+    from select import epoll, EPOLLIN, EPOLLOUT, EPOLLERR, EPOLLHUP, EPOLLET
+    import fcntl
+except ImportError:
+    EPOLL_AVAILABLE = False
+else:
+    EPOLL_AVAILABLE = True
+
+# recvmmsg and sendmmsg are available since Linux 2.6.33 and 3.0 respectively (glibc 2.12 and 2.14)
+try:
+    import ctypes
+    import ctypes.util
+    from struct import Struct
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.recvmmsg
+    _libc.sendmmsg
+
+except (ImportError, OSError, AttributeError):
+    MMSG_AVAILABLE = False
+
+else:
+    MMSG_AVAILABLE = True
+    _MSG_DONTWAIT = 0x40
+    # sockaddr_in contains sin_family in host order, sin_port in network order, sin_addr as returned
+    # by inet_aton, and eight bytes of padding
+    _SIN_FAMILY_INET = Struct("=H").pack(socket.AF_INET)
+    _pack_sin_port = Struct(">H").pack
+    _unpack_sin_port = Struct(">H").unpack
+
+    class _IOVec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    class _SockAddrIn(ctypes.Structure):
+        _fields_ = [("sin_family", ctypes.c_ushort),
+                    ("sin_port", ctypes.c_ushort),
+                    ("sin_addr", ctypes.c_uint32),
+                    ("sin_zero", ctypes.c_char * 8)]
+
+    class _MsgHdr(ctypes.Structure):
+        _fields_ = [("msg_name", ctypes.c_void_p),
+                    ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.POINTER(_IOVec)),
+                    ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p),
+                    ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+
+    class _MMsgHdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", _MsgHdr),
+                    ("msg_len", ctypes.c_uint)]
+
+    _SOCKADDR_IN_SIZE = ctypes.sizeof(_SockAddrIn)
+    _IOVEC_SIZE = ctypes.sizeof(_IOVec)
+    _MMSGHDR_SIZE = ctypes.sizeof(_MMsgHdr)
+    _MSG_LEN_OFFSET = _MMsgHdr.msg_len.offset
+
+    # offset of the character data within a str object, used to point iovecs directly at the
+    # packets that are queued for sending
+    _probe = "probe"
+    _STRING_DATA_OFFSET = ctypes.cast(ctypes.c_char_p(_probe), ctypes.c_void_p).value - id(_probe)
+    del _probe
+
+    _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _libc.recvmmsg.restype = ctypes.c_int
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+# the dispersy-introduction-request, dispersy-introduction-response, dispersy-puncture-request, and
+# dispersy-puncture message bytes as defined by BinaryConversion.  these packets keep the walker
+# going and are send before any other packets
+WALKER_MESSAGE_BYTES = frozenset(chr(byte) for byte in (246, 245, 250, 249))
+PRIORITY_WALKER = 0
+PRIORITY_DATA = 1
+PRIORITY_NAMES = (u"walker", u"data")
+
+def convert_ipv6_address(sock_addr):
+    """
+    Returns an (ip, port) tuple for an address received on an AF_INET6 socket.  IPv4-mapped
+    addresses are converted into normal IPv4 addresses.
+    """
+    host, port = sock_addr[:2]
+    if host.startswith("::ffff:") and "." in host:
+        host = host[7:]
+    return (host, port)
+
+def get_packet_priority(data):
+    """
+    Returns PRIORITY_WALKER for walker packets and PRIORITY_DATA for all other packets.
+    """
+    return PRIORITY_WALKER if len(data) > 22 and data[22] in WALKER_MESSAGE_BYTES else PRIORITY_DATA
+
+class TokenBucket(object):
+    """
+    Allows RATE bytes per second, with bursts up to BURST bytes.
+    """
+    def __init__(self, rate, burst):
+        assert isinstance(rate, (int, long, float)), type(rate)
+        assert 0 < rate
+        assert isinstance(burst, (int, long, float)), type(burst)
+        assert 0 < burst
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._timestamp = time()
+
+    @property
+    def is_full(self):
+        return self._tokens >= self._burst
+
+    def _refill(self, now):
+        if now > self._timestamp:
+            self._tokens = min(self._burst, self._tokens + (now - self._timestamp) * self._rate)
+            self._timestamp = now
+
+    def consume(self, size, now):
+        """
+        Returns True and removes SIZE tokens when at least one token is available, otherwise
+        returns False.  Allowing the bucket to become negative ensures that packets larger than
+        BURST can still be send.
+        """
+        self._refill(now)
+        if self._tokens > 0:
+            self._tokens -= size
+            return True
+        return False
+
+    def refund(self, size):
+        self._tokens = min(self._burst, self._tokens + size)
+
+    def get_delay(self, now):
+        """
+        Returns the number of seconds until a token is available.
+        """
+        self._refill(now)
+        return 0.0 if self._tokens > 0 else (1 - self._tokens) / self._rate
+
+class SendQueue(object):
+    """
+    Queue for outgoing (sock_addr, data) tuples.
+
+    Each destination has its own queue and destinations are served round robin, hence one
+    destination that is sent a large amount of data can not starve the others.  Furthermore, all
+    walker packets are sent before any data packets.
+
+    The send rate can be limited both globally (RATE) and per destination (PEER_RATE), both in
+    bytes per second.
+    """
+    def __init__(self, rate=None, peer_rate=None):
+        assert rate is None or 0 < rate
+        assert peer_rate is None or 0 < peer_rate
+        # per priority: sock_addr:deque([data]) pairs and the sock_addrs in round robin order
+        self._queues = [{} for _ in PRIORITY_NAMES]
+        self._rounds = [deque() for _ in PRIORITY_NAMES]
+        self._length = 0
+        # allow bursts of up to 0.1 seconds
+        self._bucket = TokenBucket(rate, max(1500, rate / 10)) if rate else None
+        self._peer_rate = peer_rate
+        self._peer_buckets = {}
+        # per priority: the number of queued packets and the number of send packets and bytes
+        self._queued = [0 for _ in PRIORITY_NAMES]
+        self._packets = [0 for _ in PRIORITY_NAMES]
+        self._bytes = [0 for _ in PRIORITY_NAMES]
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def statistics(self):
+        return dict((name, {u"queued":self._queued[priority], u"packets":self._packets[priority], u"bytes":self._bytes[priority]})
+                    for priority, name
+                    in enumerate(PRIORITY_NAMES))
+
+    def reset_statistics(self):
+        self._packets = [0 for _ in PRIORITY_NAMES]
+        self._bytes = [0 for _ in PRIORITY_NAMES]
+
+    def append(self, priority, sock_addr, data):
+        queues = self._queues[priority]
+        if sock_addr in queues:
+            queues[sock_addr].append(data)
+        else:
+            queues[sock_addr] = deque((data,))
+            self._rounds[priority].append(sock_addr)
+        self._length += 1
+        self._queued[priority] += 1
+
+    def appendleft(self, priority, sock_addr, data):
+        """
+        Put a packet that was returned by pop, but could not be send, back at the front.
+        """
+        queues = self._queues[priority]
+        if sock_addr in queues:
+            queues[sock_addr].appendleft(data)
+        else:
+            queues[sock_addr] = deque((data,))
+            self._rounds[priority].appendleft(sock_addr)
+        self._length += 1
+        self._queued[priority] += 1
+        self._packets[priority] -= 1
+        self._bytes[priority] -= len(data)
+
+        if self._bucket:
+            self._bucket.refund(len(data))
+        if sock_addr in self._peer_buckets:
+            self._peer_buckets[sock_addr].refund(len(data))
+
+    def get_delay(self, now):
+        """
+        Returns the number of seconds until the rate limits allow a packet to be send.
+        """
+        if self._bucket:
+            delay = self._bucket.get_delay(now)
+            if delay:
+                return delay
+
+        if self._peer_rate:
+            delays = [self._peer_buckets[sock_addr].get_delay(now) if sock_addr in self._peer_buckets else 0.0
+                      for queues in self._queues
+                      for sock_addr in queues]
+            if delays:
+                return min(delays)
+
+        return 0.0
+
+    def pop(self, now):
+        """
+        Returns the next (priority, sock_addr, data) tuple or None when the queue is empty or when
+        the rate limits do not allow anything to be send at this time.
+        """
+        if self._bucket and self._bucket.get_delay(now):
+            return None
+
+        for priority in xrange(len(PRIORITY_NAMES)):
+            rounds = self._rounds[priority]
+            if not rounds:
+                continue
+
+            queues = self._queues[priority]
+            for _ in xrange(len(rounds)):
+                sock_addr = rounds[0]
+                queue = queues[sock_addr]
+
+                if self._peer_rate:
+                    bucket = self._peer_buckets.get(sock_addr)
+                    if bucket is None:
+                        bucket = self._peer_buckets[sock_addr] = TokenBucket(self._peer_rate, max(1500, self._peer_rate / 10))
+                    if not bucket.consume(len(queue[0]), now):
+                        rounds.rotate(-1)
+                        continue
+
+                data = queue.popleft()
+                if queue:
+                    rounds.rotate(-1)
+                else:
+                    del queues[sock_addr]
+                    rounds.popleft()
+
+                if self._bucket:
+                    self._bucket.consume(len(data), now)
+                self._length -= 1
+                self._queued[priority] -= 1
+                self._packets[priority] += 1
+                self._bytes[priority] += len(data)
+                return priority, sock_addr, data
+
+        if len(self._peer_buckets) > 1024:
+            # forget the buckets that are full and no longer in use
+            active = set(sock_addr for queues in self._queues for sock_addr in queues)
+            for sock_addr in [sock_addr for sock_addr, bucket in self._peer_buckets.iteritems() if bucket.is_full and not sock_addr in active]:
+                del self._peer_buckets[sock_addr]
+
+        return None
+
 class Endpoint(object):
     def __init__(self):
         self._total_up = 0
         self._total_down = 0
         self._total_send = 0
+        self._total_rejected = 0
         self._cur_sendqueue = 0
 
     @property
@@ -44,15 +323,30 @@ class Endpoint(object):
     @property
     def total_send(self):
         return self._total_send
+
+    @property
+    def total_rejected(self):
+        """
+        The number of received packets that were rejected by the Dispersy packet filter.
+        """
+        return self._total_rejected
     
     @property
     def cur_sendqueue(self):
         return self._cur_sendqueue
 
+    @property
+    def sendqueue_statistics(self):
+        """
+        Returns a dictionary with statistics for each send queue.
+        """
+        return {}
+
     def reset_statistics(self):
         self._total_up = 0
         self._total_down = 0
         self._total_send = 0
+        self._total_rejected = 0
         self._cur_sendqueue = 0
 
     def get_address(self):
@@ -61,6 +355,63 @@ class Endpoint(object):
     def send(self, candidates, packets):
         raise NotImplementedError()
 
+    def _filter_packets(self, packets):
+        """
+        Returns the (sock_addr, data) tuples from PACKETS that pass the Dispersy packet filter.
+
+        This is called on the thread that receives the packets, hence packets for unknown
+        communities, conversions, and messages are rejected without involving the Dispersy thread.
+        """
+        packet_filter = self._dispersy.packet_filter
+        if packet_filter is None:
+            return packets
+
+        prefixes, cids = packet_filter
+        accepted = [(sock_addr, data)
+                    for sock_addr, data
+                    in packets
+                    if (data[:23] in prefixes or data[2:22] in cids or
+                        (data.startswith(TUNNEL_PREFIX) and (data[4:27] in prefixes or data[6:26] in cids)))]
+        self._total_rejected += len(packets) - len(accepted)
+        return accepted
+
+    def _create_candidate_packets(self, packets):
+        """
+        Returns a list with (Candidate, data) tuples for the (sock_addr, data) tuples in PACKETS,
+        removing the tunnel prefix where present.
+
+        Packets from the same sock_addr share one Candidate instance.
+        """
+        candidates = {}
+        result = []
+        for sock_addr, data in packets:
+            tunnel = data.startswith(TUNNEL_PREFIX)
+            key = (sock_addr, tunnel)
+            candidate = candidates.get(key)
+            if candidate is None:
+                candidate = candidates[key] = Candidate(sock_addr, tunnel)
+            result.append((candidate, data[4:] if tunnel else data))
+        return result
+
+    def send_batch(self, batch):
+        """
+        Send packets to candidates, where each candidate may receive different packets.
+
+        BATCH is a dictionary containing Candidate:[packet] pairs.  The default implementation
+        calls send once for each candidate, endpoints should override this when they can queue the
+        entire batch at once.
+
+        Returns True when something has been send.
+        """
+        assert isinstance(batch, dict), type(batch)
+        assert all(isinstance(candidate, Candidate) for candidate in batch.iterkeys())
+        assert all(isinstance(packets, list) for packets in batch.itervalues())
+        result = False
+        for candidate, packets in batch.iteritems():
+            if self.send([candidate], packets):
+                result = True
+        return result
+
 class DummyEndpoint(Endpoint):
     """
     A dummy socket class.
@@ -77,8 +428,11 @@ class DummyEndpoint(Endpoint):
     def send(self, candidates, packets):
         if __debug__: dprint("Thrown away ", sum(len(data) for data in packets), " bytes worth of outgoing data to ", ",".join(str(candidate) for candidate in candidates), level="warning")
 
+    def send_batch(self, batch):
+        if __debug__: dprint("Thrown away ", sum(len(data) for packets in batch.itervalues() for data in packets), " bytes worth of outgoing data to ", ",".join(str(candidate) for candidate in batch.iterkeys()), level="warning")
+
 class RawserverEndpoint(Endpoint):
-    def __init__(self, rawserver, dispersy, port, ip="0.0.0.0"):
+    def __init__(self, rawserver, dispersy, port, ip="0.0.0.0", send_rate=None, peer_send_rate=None):
         super(RawserverEndpoint, self).__init__()
 
         while True:
@@ -96,7 +450,19 @@ class RawserverEndpoint(Endpoint):
         self._dispersy = dispersy
         
         self._sendqueue_lock = threading.RLock()
-        self._sendqueue = []
+        self._sendqueue = SendQueue(send_rate, peer_send_rate)
+        # True when the last send attempt failed because the socket would block
+        self._sendqueue_blocked = False
+        # True while a _process_sendqueue call is scheduled on the rawserver
+        self._sendqueue_scheduled = False
+
+    @property
+    def sendqueue_statistics(self):
+        return self._sendqueue.statistics
+
+    def reset_statistics(self):
+        super(RawserverEndpoint, self).reset_statistics()
+        self._sendqueue.reset_statistics()
 
     def get_address(self):
         return self._socket.getsockname()
@@ -117,22 +483,13 @@ class RawserverEndpoint(Endpoint):
                         name = "???"
                     print >> sys.stderr, "endpoint: %.1f %30s <- %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
                     self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, name)
-                    
-            self._dispersy.callback.register(self.dispersythread_data_came_in, (packets, time()))
+
+            packets = self._filter_packets(packets)
+            if packets:
+                self._dispersy.callback.register(self.dispersythread_data_came_in, (packets, time()))
 
     def dispersythread_data_came_in(self, packets, timestamp):
-        # iterator = ((self._dispersy.get_candidate(sock_addr), data.startswith(TUNNEL_PREFIX), sock_addr, data) for sock_addr, data in packets)
-        # self._dispersy.on_incoming_packets([(candidate if candidate else self._dispersy.create_candidate(WalkCandidate, sock_addr, tunnel), data[4:] if tunnel else data)
-        #                                     for candidate, tunnel, sock_addr, data
-        #                                     in iterator],
-        #                                    True,
-        #                                    timestamp)
-        iterator = ((data.startswith(TUNNEL_PREFIX), sock_addr, data) for sock_addr, data in packets)
-        self._dispersy.on_incoming_packets([(Candidate(sock_addr, tunnel), data[4:] if tunnel else data)
-                                            for tunnel, sock_addr, data
-                                            in iterator],
-                                           True,
-                                           timestamp)
+        self._dispersy.on_incoming_packets(self._create_candidate_packets(packets), True, timestamp)
 
     def send(self, candidates, packets):
         assert isinstance(candidates, (tuple, list, set)), type(candidates)
@@ -145,35 +502,70 @@ class RawserverEndpoint(Endpoint):
         self._total_send += (len(packets) * len(candidates))
         
         wan_address = self._dispersy.wan_address
+        return self._enqueue([(get_packet_priority(data), candidate.get_destination_address(wan_address), TUNNEL_PREFIX + data if candidate.tunnel else data)
+                              for candidate, data
+                              in product(candidates, packets)])
 
-        with self._sendqueue_lock:
-            batch = [(candidate.get_destination_address(wan_address), TUNNEL_PREFIX + data if candidate.tunnel else data)
-                     for candidate, data
-                     in product(candidates, packets)]
+    def send_batch(self, batch):
+        assert isinstance(batch, dict), type(batch)
+        assert all(isinstance(candidate, Candidate) for candidate in batch.iterkeys())
+        assert all(isinstance(packets, list) for packets in batch.itervalues())
+        assert all(isinstance(packet, str) for packets in batch.itervalues() for packet in packets)
+        assert all(len(packet) > 0 for packets in batch.itervalues() for packet in packets)
+
+        self._total_up += sum(len(data) for packets in batch.itervalues() for data in packets)
+        self._total_send += sum(len(packets) for packets in batch.itervalues())
+
+        wan_address = self._dispersy.wan_address
+        queue = []
+        for candidate, packets in batch.iteritems():
+            sock_addr = candidate.get_destination_address(wan_address)
+            if candidate.tunnel:
+                queue.extend((get_packet_priority(data), sock_addr, TUNNEL_PREFIX + data) for data in packets)
+            else:
+                queue.extend((get_packet_priority(data), sock_addr, data) for data in packets)
+        return self._enqueue(queue)
 
-            if len(batch) > 0:
+    def _enqueue(self, batch):
+        """
+        Append a list of (priority, sock_addr, data) tuples to the sendqueue.
+
+        Returns True when something has been send.
+        """
+        if batch:
+            with self._sendqueue_lock:
                 did_have_senqueue = bool(self._sendqueue)
-                self._sendqueue.extend(batch)
-                
-                # If we did not already a sendqueue, then we need to call process_sendqueue in order send these messages
-                if not did_have_senqueue:    
+                has_walker_packets = False
+                for priority, sock_addr, data in batch:
+                    self._sendqueue.append(priority, sock_addr, data)
+                    if priority == PRIORITY_WALKER:
+                        has_walker_packets = True
+
+                # If we did not already a sendqueue, then we need to call process_sendqueue in order send these messages.
+                # Walker packets are send immediately as they are placed in front of the queue.
+                if not did_have_senqueue or has_walker_packets:
                     self._process_sendqueue()
-            
-                # return True when something has been send
-                return True
-            
-        return False 
+
+            # return True when something has been send
+            return True
+
+        return False
 
     def _process_sendqueue(self):
         with self._sendqueue_lock:
             if self._sendqueue:
-                index = 0
                 NUM_PACKETS = min(max(50, len(self._sendqueue) / 10), len(self._sendqueue))
                 if DEBUG:
                     print >> sys.stderr, "endpoint:", len(self._sendqueue), "left in queue, trying to send", NUM_PACKETS
-                
+
+                now = time()
                 for i in xrange(NUM_PACKETS):
-                    sock_addr, data = self._sendqueue[i]
+                    item = self._sendqueue.pop(now)
+                    if item is None:
+                        # rate limited
+                        break
+
+                    priority, sock_addr, data = item
                     try:
                         self._socket.sendto(data, sock_addr)
                         if DEBUG:
@@ -183,29 +575,46 @@ class RawserverEndpoint(Endpoint):
                                 name = "???"
                             print >> sys.stderr, "endpoint: %.1f %30s -> %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
                             self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, name)
-                            
-                        index += 1
-    
+
                     except socket.error, e:
-                        if e[0] != SOCKET_BLOCK_ERRORCODE:
-                            if DEBUG:
-                                print >> sys.stderr, long(time()), "endpoint: could not send", len(data), "to", sock_addr, len(self._sendqueue)
-                                print_exc()
-                                
                         self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
-                        break
-    
-                self._sendqueue = self._sendqueue[index:]
+                        if e[0] == SOCKET_BLOCK_ERRORCODE:
+                            self._sendqueue.appendleft(priority, sock_addr, data)
+                            self._sendqueue_blocked = True
+                            break
+
+                        # the packet is dropped, sending it again will most likely fail again
+                        # (i.e. EACCES when sending to a broadcast address)
+                        if DEBUG:
+                            print >> sys.stderr, long(time()), "endpoint: could not send", len(data), "to", sock_addr, len(self._sendqueue)
+                            print_exc()
+
                 if self._sendqueue:
                     # And schedule a new attempt
-                    self._add_task(self._process_sendqueue, 0.1, "process_sendqueue")
+                    self._schedule_sendqueue()
                     if DEBUG:
                         print >> sys.stderr, "endpoint:", len(self._sendqueue), "left in queue"
                 
                 self._cur_sendqueue = len(self._sendqueue)
                 
+    def _schedule_sendqueue(self):
+        """
+        Schedule a new _process_sendqueue attempt, unless one is already scheduled.
+
+        _process_sendqueue is also called for every enqueued walker packet, hence scheduling an
+        attempt each time would pile up many attempts that all run at about the same time.
+        """
+        if not self._sendqueue_scheduled:
+            self._sendqueue_scheduled = True
+            self._add_task(self._scheduled_process_sendqueue, 0.1, "process_sendqueue")
+
+    def _scheduled_process_sendqueue(self):
+        with self._sendqueue_lock:
+            self._sendqueue_scheduled = False
+            self._process_sendqueue()
+
 class StandaloneEndpoint(RawserverEndpoint):
-    def __init__(self, dispersy, port, ip="0.0.0.0"):
+    def __init__(self, dispersy, port, ip="0.0.0.0", send_rate=None, peer_send_rate=None):
         Endpoint.__init__(self)
         
         self._running = True
@@ -213,39 +622,142 @@ class StandaloneEndpoint(RawserverEndpoint):
         self._thread = threading.Thread(name="StandaloneEndpoint", target=self._loop, args=(port, ip))
         self._thread.daemon = True
 
+        # all sockets that we receive on.  packets are send using the first socket
+        self._sockets = []
+        self._socket = self._bind(socket.AF_INET, ip, port)
+
+        # epoll, when available, wakes the loop as soon as a socket becomes readable or writable.
+        # the pipe is used to wake the loop from other threads
+        if EPOLL_AVAILABLE:
+            self._epoll = epoll()
+            self._wakeup_read, self._wakeup_write = os.pipe()
+            for fd in (self._wakeup_read, self._wakeup_write):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._epoll.register(self._wakeup_read, EPOLLIN)
+            self._epoll.register(self._socket.fileno(), EPOLLIN | EPOLLOUT | EPOLLET)
+        else:
+            self._epoll = None
+
+        self._add_task = lambda task, delay = 0.0, id = "": None 
+        self._sendqueue_lock = threading.RLock()
+        self._sendqueue = SendQueue(send_rate, peer_send_rate)
+        self._sendqueue_blocked = False
+        self._sendqueue_scheduled = False
+
+    def _bind(self, family, ip, port):
         while True:
             try:
-                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
-                self._socket.bind((ip, port))
-                self._socket.setblocking(0)
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
+                if family == socket.AF_INET6 and hasattr(socket, "IPV6_V6ONLY"):
+                    # IPv4 packets are received on the AF_INET socket
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+                sock.bind((ip, port))
+                sock.setblocking(0)
                 if __debug__: dprint("Listening at ", port)
             except socket.error:
                 port += 1
                 continue
             break
-        
-        self._add_task = lambda task, delay = 0.0, id = "": None 
-        self._sendqueue_lock = threading.RLock()
-        self._sendqueue = []
+        self._sockets.append(sock)
+        return sock
+
+    def add_socket(self, port, ip="0.0.0.0", family=socket.AF_INET):
+        """
+        Receive packets on an additional socket, for instance on a different port or on IPv6.
+
+        Packets are always send using the first socket.  Returns the address of the new socket.
+        """
+        assert family in (socket.AF_INET, socket.AF_INET6)
+        sock = self._bind(family, ip, port)
+        if self._epoll:
+            self._epoll.register(sock.fileno(), EPOLLIN | EPOLLET)
+        return sock.getsockname()
 
     def start(self):
         self._thread.start()
 
     def stop(self, timeout=10.0):
         self._running = False
+        self._wakeup()
         self._thread.join(timeout)
 
+        if self._epoll:
+            epoll_, self._epoll = self._epoll, None
+            epoll_.close()
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+
+    def _wakeup(self):
+        if self._epoll:
+            try:
+                os.write(self._wakeup_write, "x")
+            except OSError:
+                # the pipe is full, hence the loop will wake up anyway
+                pass
+
+    def _enqueue(self, batch):
+        result = super(StandaloneEndpoint, self)._enqueue(batch)
+        if result and self._epoll and self._sendqueue and not self._sendqueue_blocked:
+            # the caller did not send everything and the socket did not block, hence no EPOLLOUT
+            # event will wake the loop
+            self._wakeup()
+        return result
+
     def _loop(self, port, ip):
-        recvfrom = self._socket.recvfrom
-        socket_list = [self._socket.fileno()]
-        
+        if self._epoll:
+            self._epoll_loop()
+        else:
+            self._select_loop()
+
+    def _epoll_loop(self):
+        sockets = dict((sock.fileno(), sock) for sock in self._sockets)
+        send_fileno = self._socket.fileno()
+        # stop closes the epoll object once this loop has finished
+        poll = self._epoll.poll
+
+        while self._running:
+            # wait until a socket becomes readable or writable.  when packets are queued, and the
+            # socket did not block, we only need to wait for the rate limiter
+            timeout = -1
+            if self._sendqueue and not self._sendqueue_blocked:
+                timeout = self._sendqueue.get_delay(time())
+
+            for fileno, event in poll(timeout):
+                if fileno == self._wakeup_read:
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+
+                if fileno not in sockets:
+                    # a socket was added after the loop started
+                    sockets = dict((sock.fileno(), sock) for sock in self._sockets)
+
+                if event & EPOLLOUT and fileno == send_fileno:
+                    # the lock ensures that we do not clear the flag before it is set
+                    with self._sendqueue_lock:
+                        self._sendqueue_blocked = False
+
+                if event & (EPOLLIN | EPOLLERR | EPOLLHUP):
+                    # edge triggered, hence _receive must read until the socket would block
+                    self._receive(sockets[fileno])
+
+            if self._sendqueue and not self._sendqueue_blocked:
+                self._process_sendqueue()
+
+    def _select_loop(self):
         prev_sendqueue = 0
         while self._running:
+            socket_list = [sock.fileno() for sock in self._sockets]
+            send_list = [self._socket.fileno()]
+
             # This is a tricky, if we are running on the DAS4 whenever a socket is ready for writing all processes of
             # this node will try to write. Therefore, we have to limit the frequency of trying to write a bit.
             if self._sendqueue and (time() - prev_sendqueue) > 0.1:
-                read_list, write_list, _ = select(socket_list, socket_list, [], 0.1)
+                read_list, write_list, _ = select(socket_list, send_list, [], 0.1)
             else:
                 read_list, write_list, _ = select(socket_list, [], [], 0.1)
             
@@ -254,22 +766,244 @@ class StandaloneEndpoint(RawserverEndpoint):
                 self._process_sendqueue()
                 prev_sendqueue = time()
                 
-            if read_list:
-                packets = []
-                try:
-                    while True:
-                        (data, sock_addr) = recvfrom(65535)
-                        if data:
-                            packets.append((sock_addr, data))
-                        else:
+            for sock in self._sockets:
+                if sock.fileno() in read_list:
+                    self._receive(sock)
+
+    def _receive(self, sock):
+        recvfrom = sock.recvfrom
+        packets = []
+        try:
+            while True:
+                (data, sock_addr) = recvfrom(65535)
+                if data:
+                    packets.append((sock_addr, data))
+                else:
+                    break
+
+        except socket.error, e:
+            if e[0] != SOCKET_BLOCK_ERRORCODE:
+                self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'"%str(e))
+
+        finally:
+            if packets:
+                if sock.family == socket.AF_INET6:
+                    packets = [(convert_ipv6_address(sock_addr), data) for sock_addr, data in packets]
+                self.data_came_in(packets)
+
+class MMsgEndpoint(StandaloneEndpoint):
+    """
+    A StandaloneEndpoint that receives and sends datagrams in batches.
+
+    Instead of one recvfrom or sendto call per datagram, the Linux specific recvmmsg and sendmmsg
+    system calls are used to receive or send up to BATCH_SIZE datagrams per call.  All buffers
+    and message headers are allocated once and reused.
+
+    MMSG_AVAILABLE is False when these system calls are not available, in which case the
+    StandaloneEndpoint should be used instead.
+    """
+    def __init__(self, dispersy, port, ip="0.0.0.0", send_rate=None, peer_send_rate=None, batch_size=64):
+        assert MMSG_AVAILABLE, "recvmmsg and sendmmsg are not available on this system"
+        assert isinstance(batch_size, int)
+        assert 0 < batch_size
+        super(MMsgEndpoint, self).__init__(dispersy, port, ip, send_rate, peer_send_rate)
+        self._batch_size = batch_size
+        self._fileno = self._socket.fileno()
+
+        # receive buffers
+        self._recv_buffers = [ctypes.create_string_buffer(65535) for _ in xrange(batch_size)]
+        self._recv_buffer_addresses = [ctypes.addressof(buffer_) for buffer_ in self._recv_buffers]
+        # slicing a read-only buffer object copies only the sliced bytes into a new str
+        self._recv_buffer_views = [buffer(buffer_) for buffer_ in self._recv_buffers]
+        self._recv_names = (_SockAddrIn * batch_size)()
+        self._recv_iovecs = (_IOVec * batch_size)()
+        self._recv_headers = (_MMsgHdr * batch_size)()
+        for index in xrange(batch_size):
+            iovec = self._recv_iovecs[index]
+            iovec.iov_base = self._recv_buffer_addresses[index]
+            iovec.iov_len = 65535
+            header = self._recv_headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._recv_names[index])
+            # the kernel sets msg_namelen to sizeof(sockaddr_in) for every received datagram, hence
+            # it never needs to be reset
+            header.msg_namelen = _SOCKADDR_IN_SIZE
+            header.msg_iov = ctypes.pointer(iovec)
+            header.msg_iovlen = 1
+        self._recv_headers_view = buffer(self._recv_headers)
+        self._recv_names_view = buffer(self._recv_names)
+        self._unpacked_names = {}
+        self._msg_len_structs = {}
+
+        # send buffers.  the iovecs point directly into the queued strings, hence these strings are
+        # not copied
+        self._packed_names = {}
+        self._iovec_structs = {}
+        self._send_names = (_SockAddrIn * batch_size)()
+        self._send_iovecs = (_IOVec * batch_size)()
+        self._send_headers = (_MMsgHdr * batch_size)()
+        for index in xrange(batch_size):
+            header = self._send_headers[index].msg_hdr
+            header.msg_name = ctypes.addressof(self._send_names[index])
+            header.msg_namelen = _SOCKADDR_IN_SIZE
+            header.msg_iov = ctypes.pointer(self._send_iovecs[index])
+            header.msg_iovlen = 1
+
+    def _receive(self, sock):
+        if sock.family != socket.AF_INET:
+            # the receive buffers only fit a sockaddr_in
+            return super(MMsgEndpoint, self)._receive(sock)
+
+        fileno = sock.fileno()
+        packets = []
+        batch_size = self._batch_size
+        headers = self._recv_headers
+        headers_view = self._recv_headers_view
+        names_view = self._recv_names_view
+        buffer_views = self._recv_buffer_views
+        unpacked_names = self._unpacked_names
+        try:
+            while True:
+                count = _libc.recvmmsg(fileno, headers, batch_size, _MSG_DONTWAIT, None)
+                if count < 0:
+                    error = ctypes.get_errno()
+                    if error not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'[Errno %d] %s'" % (error, os.strerror(error)))
+                    break
+
+                # read all lengths and addresses with one copy each
+                lengths = self._get_msg_len_struct(count).unpack(headers_view[:count * _MMSGHDR_SIZE])
+                names = names_view[:count * _SOCKADDR_IN_SIZE]
+
+                for index in xrange(count):
+                    # bytes 2:4 contain the port and bytes 4:8 contain the ip, both in network order
+                    offset = index * _SOCKADDR_IN_SIZE
+                    name = names[offset + 2:offset + 8]
+                    try:
+                        sock_addr = unpacked_names[name]
+                    except KeyError:
+                        if len(unpacked_names) > 1024:
+                            unpacked_names.clear()
+                        sock_addr = unpacked_names[name] = (socket.inet_ntoa(name[2:]), _unpack_sin_port(name[:2])[0])
+
+                    packets.append((sock_addr, buffer_views[index][:lengths[index]]))
+
+                if count < batch_size:
+                    break
+
+        finally:
+            if packets:
+                self.data_came_in(packets)
+
+    def _process_sendqueue(self):
+        with self._sendqueue_lock:
+            if self._sendqueue:
+                index = 0
+                NUM_PACKETS = min(max(50, len(self._sendqueue) / 10), len(self._sendqueue))
+                if DEBUG:
+                    print >> sys.stderr, "endpoint:", len(self._sendqueue), "left in queue, trying to send", NUM_PACKETS
+
+                now = time()
+                pop = self._sendqueue.pop
+                while index < NUM_PACKETS:
+                    batch = []
+                    for _ in xrange(min(self._batch_size, NUM_PACKETS - index)):
+                        item = pop(now)
+                        if item is None:
+                            # rate limited
                             break
-                        
-                except socket.error, e:
-                    self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'"%str(e))
-                        
-                finally:
-                    if packets:
-                        self.data_came_in(packets)
+                        batch.append(item)
+                    if not batch:
+                        break
+                    count = len(batch)
+
+                    # fill the sockaddr_in and iovec arrays with one memmove each.  the iovecs point
+                    # directly into the queued strings, these strings are kept alive by BATCH
+                    ctypes.memmove(self._send_names, "".join([self._get_packed_name(sock_addr) for _, sock_addr, _ in batch]), count * _SOCKADDR_IN_SIZE)
+                    iovecs = []
+                    for _, _, data in batch:
+                        iovecs.append(id(data) + _STRING_DATA_OFFSET)
+                        iovecs.append(len(data))
+                    ctypes.memmove(self._send_iovecs, self._get_iovec_struct(count).pack(*iovecs), count * _IOVEC_SIZE)
+
+                    sent = _libc.sendmmsg(self._fileno, self._send_headers, count, 0)
+
+                    if sent < 0:
+                        error = ctypes.get_errno()
+                        self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
+                        if error == SOCKET_BLOCK_ERRORCODE:
+                            for priority, sock_addr, data in reversed(batch):
+                                self._sendqueue.appendleft(priority, sock_addr, data)
+                            self._sendqueue_blocked = True
+                            break
+
+                        # sendmmsg fails on the first datagram, that packet is dropped because
+                        # sending it again will most likely fail again (i.e. EACCES when sending to
+                        # a broadcast address).  the remaining packets are send in the next round
+                        if DEBUG:
+                            print >> sys.stderr, long(time()), "endpoint: could not send", len(batch[0][2]), "to", batch[0][1], len(self._sendqueue), errno.errorcode.get(error, error)
+                        for priority, sock_addr, data in reversed(batch[1:]):
+                            self._sendqueue.appendleft(priority, sock_addr, data)
+                        index += 1
+                        continue
+
+                    # put everything that was not send back in the queue
+                    for priority, sock_addr, data in reversed(batch[sent:]):
+                        self._sendqueue.appendleft(priority, sock_addr, data)
+
+                    if DEBUG:
+                        for _, sock_addr, data in batch[:sent]:
+                            try:
+                                name = self._dispersy.convert_packet_to_meta_message(data, load=False, auto_load=False).name
+                            except:
+                                name = "???"
+                            print >> sys.stderr, "endpoint: %.1f %30s -> %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
+                            self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, name)
+
+                    index += sent
+                    if sent < count:
+                        # the socket buffer is full
+                        break
+
+                if self._sendqueue:
+                    # And schedule a new attempt
+                    self._schedule_sendqueue()
+                    if DEBUG:
+                        print >> sys.stderr, "endpoint:", len(self._sendqueue), "left in queue"
+
+                self._cur_sendqueue = len(self._sendqueue)
+
+    def _get_packed_name(self, sock_addr):
+        """
+        Returns the binary sockaddr_in structure for SOCK_ADDR.
+        """
+        try:
+            return self._packed_names[sock_addr]
+        except KeyError:
+            if len(self._packed_names) > 1024:
+                self._packed_names.clear()
+            name = self._packed_names[sock_addr] = "".join((_SIN_FAMILY_INET, _pack_sin_port(sock_addr[1]), socket.inet_aton(sock_addr[0]), "\0" * 8))
+            return name
+
+    def _get_msg_len_struct(self, count):
+        """
+        Returns a Struct that unpacks the msg_len fields from COUNT mmsghdr structures.
+        """
+        try:
+            return self._msg_len_structs[count]
+        except KeyError:
+            struct = self._msg_len_structs[count] = Struct("=" + ("%dxI%dx" % (_MSG_LEN_OFFSET, _MMSGHDR_SIZE - _MSG_LEN_OFFSET - 4)) * count)
+            return struct
+
+    def _get_iovec_struct(self, count):
+        """
+        Returns a Struct that packs COUNT (iov_base, iov_len) pairs, where size_t is assumed to
+        have the same size as a pointer.
+        """
+        try:
+            return self._iovec_structs[count]
+        except KeyError:
+            struct = self._iovec_structs[count] = Struct("PP" * count)
+            return struct
 
 class TunnelEndpoint(Endpoint):
     def __init__(self, swift_process, dispersy):
@@ -324,6 +1058,41 @@ class TunnelEndpoint(Endpoint):
         finally:
             self._swift.splock.release()
 
+    def send_batch(self, batch):
+        assert isinstance(batch, dict), type(batch)
+        assert all(isinstance(candidate, Candidate) for candidate in batch.iterkeys())
+        assert all(isinstance(packets, list) for packets in batch.itervalues())
+        assert all(isinstance(packet, str) for packets in batch.itervalues() for packet in packets)
+        assert all(len(packet) > 0 for packets in batch.itervalues() for packet in packets)
+
+        self._total_up += sum(len(data) for packets in batch.itervalues() for data in packets)
+        self._total_send += sum(len(packets) for packets in batch.itervalues())
+        wan_address = self._dispersy.wan_address
+
+        self._swift.splock.acquire()
+        try:
+            for candidate, packets in batch.iteritems():
+                sock_addr = candidate.get_destination_address(wan_address)
+                assert self._dispersy.is_valid_address(sock_addr), sock_addr
+
+                for data in packets:
+                    if DEBUG:
+                        try:
+                            name = self._dispersy.convert_packet_to_meta_message(data, load=False, auto_load=False).name
+                        except:
+                            name = "???"
+
+                        print >> sys.stderr, "endpoint: %.1f %30s -> %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
+                        self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, name)
+
+                    self._swift.send_tunnel(self._session, sock_addr, data)
+
+            # return True when something has been send
+            return any(batch.itervalues())
+
+        finally:
+            self._swift.splock.release()
+
     def i2ithread_data_came_in(self, session, sock_addr, data):
         # assert session == self._session, [session, self._session]
         if DEBUG:
@@ -336,8 +1105,191 @@ class TunnelEndpoint(Endpoint):
             self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, name)
             
         self._total_down += len(data)
-        self._dispersy.callback.register(self.dispersythread_data_came_in, (sock_addr, data, time()))
+        if self._filter_packets([(sock_addr, data)]):
+            self._dispersy.callback.register(self.dispersythread_data_came_in, (sock_addr, data, time()))
 
     def dispersythread_data_came_in(self, sock_addr, data, timestamp):
         # candidate = self._dispersy.get_candidate(sock_addr) or self._dispersy.create_candidate(WalkCandidate, sock_addr, True)
         self._dispersy.on_incoming_packets([(Candidate(sock_addr, True), data)], True, timestamp)
+
+class MemoryNetwork(object):
+    """
+    An in-memory network connecting MemoryEndpoint instances that run in one process.
+
+    All endpoints share one host, hence packets are routed using the destination port only.  Each
+    packet is lost with probability LOSS and otherwise arrives LATENCY seconds after it was send.
+    The latency and loss can be changed for individual links using set_link.  Loss is decided by a
+    random generator seeded with SEED, making the pattern of lost packets reproducible.
+    """
+    def __init__(self, latency=0.0, loss=0.0, seed=None, first_port=10000):
+        assert isinstance(latency, float), type(latency)
+        assert latency >= 0.0, latency
+        assert isinstance(loss, float), type(loss)
+        assert 0.0 <= loss <= 1.0, loss
+        assert isinstance(first_port, int), type(first_port)
+        self._latency = latency
+        self._loss = loss
+        self._random = Random(seed)
+        self._next_port = first_port
+        self._lock = threading.Lock()
+        # port:MemoryEndpoint pairs
+        self._endpoints = {}
+        # (source port, destination port):(latency, loss) pairs
+        self._links = {}
+
+    @property
+    def endpoints(self):
+        return self._endpoints.values()
+
+    def set_link(self, source, destination, latency=None, loss=None):
+        """
+        Set the LATENCY and LOSS for packets from the SOURCE endpoint to the DESTINATION endpoint.
+
+        None means that the network wide value is used.
+        """
+        assert isinstance(source, MemoryEndpoint), type(source)
+        assert isinstance(destination, MemoryEndpoint), type(destination)
+        assert latency is None or latency >= 0.0, latency
+        assert loss is None or 0.0 <= loss <= 1.0, loss
+        self._links[(source.port, destination.port)] = (self._latency if latency is None else latency,
+                                                         self._loss if loss is None else loss)
+
+    def register(self, endpoint):
+        """
+        Add ENDPOINT to the network.  Returns the port assigned to ENDPOINT.
+        """
+        assert isinstance(endpoint, MemoryEndpoint), type(endpoint)
+        with self._lock:
+            port = self._next_port
+            self._next_port += 1
+            self._endpoints[port] = endpoint
+        return port
+
+    def unregister(self, endpoint):
+        assert isinstance(endpoint, MemoryEndpoint), type(endpoint)
+        with self._lock:
+            self._endpoints.pop(endpoint.port, None)
+            for key in [key for key in self._links if endpoint.port in key]:
+                del self._links[key]
+
+    def deliver(self, source, packets):
+        """
+        Deliver PACKETS, a list with (sock_addr, data) tuples, from the SOURCE endpoint.
+
+        Returns the number of packets that were lost.
+        """
+        assert isinstance(source, MemoryEndpoint), type(source)
+        assert isinstance(packets, list), type(packets)
+        # destination port:[data] pairs
+        destinations = {}
+        lost = 0
+        random = self._random.random
+        with self._lock:
+            for sock_addr, data in packets:
+                latency, loss = self._links.get((source.port, sock_addr[1]), (self._latency, self._loss))
+                if loss and random() < loss:
+                    lost += 1
+                else:
+                    destinations.setdefault(sock_addr[1], []).append(data)
+            endpoints = [(self._endpoints.get(port), self._links.get((source.port, port), (self._latency, self._loss))[0], datas)
+                         for port, datas
+                         in destinations.iteritems()]
+
+        sock_addr = source.sock_addr
+        for endpoint, latency, datas in endpoints:
+            if endpoint is None:
+                lost += len(datas)
+            else:
+                endpoint.data_came_in([(sock_addr, data) for data in datas], latency)
+        return lost
+
+class MemoryEndpoint(Endpoint):
+    """
+    An endpoint that sends packets over a MemoryNetwork instead of a socket.
+
+    Together with multiple Dispersy instances, each with its own callback, this allows a network
+    of peers to be simulated in a single process.
+    """
+    def __init__(self, network, dispersy):
+        assert isinstance(network, MemoryNetwork), type(network)
+        super(MemoryEndpoint, self).__init__()
+        self._network = network
+        self._dispersy = dispersy
+        self._total_lost = 0
+        self._port = network.register(self)
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def sock_addr(self):
+        """
+        The address that other endpoints on the network see as the source of our packets.
+        """
+        return (self._dispersy.lan_address[0], self._port)
+
+    @property
+    def total_lost(self):
+        """
+        The number of send packets that were lost by the network.
+        """
+        return self._total_lost
+
+    def reset_statistics(self):
+        super(MemoryEndpoint, self).reset_statistics()
+        self._total_lost = 0
+
+    def get_address(self):
+        return ("0.0.0.0", self._port)
+
+    def close(self):
+        self._network.unregister(self)
+
+    def send(self, candidates, packets):
+        assert isinstance(candidates, (tuple, list, set)), type(candidates)
+        assert all(isinstance(candidate, Candidate) for candidate in candidates)
+        assert isinstance(packets, (tuple, list, set)), type(packets)
+        assert all(isinstance(packet, str) for packet in packets)
+        assert all(len(packet) > 0 for packet in packets)
+
+        self._total_up += sum(len(data) for data in packets) * len(candidates)
+        self._total_send += (len(packets) * len(candidates))
+
+        wan_address = self._dispersy.wan_address
+        self._total_lost += self._network.deliver(self, [(candidate.get_destination_address(wan_address), TUNNEL_PREFIX + data if candidate.tunnel else data)
+                                                         for candidate, data
+                                                         in product(candidates, packets)])
+
+        # return True when something has been send
+        return candidates and packets
+
+    def send_batch(self, batch):
+        assert isinstance(batch, dict), type(batch)
+        assert all(isinstance(candidate, Candidate) for candidate in batch.iterkeys())
+        assert all(isinstance(packets, list) for packets in batch.itervalues())
+        assert all(isinstance(packet, str) for packets in batch.itervalues() for packet in packets)
+        assert all(len(packet) > 0 for packets in batch.itervalues() for packet in packets)
+
+        self._total_up += sum(len(data) for packets in batch.itervalues() for data in packets)
+        self._total_send += sum(len(packets) for packets in batch.itervalues())
+
+        wan_address = self._dispersy.wan_address
+        self._total_lost += self._network.deliver(self, [(candidate.get_destination_address(wan_address), TUNNEL_PREFIX + data if candidate.tunnel else data)
+                                                         for candidate, packets
+                                                         in batch.iteritems()
+                                                         for data
+                                                         in packets])
+
+        # return True when something has been send
+        return any(batch.itervalues())
+
+    def data_came_in(self, packets, latency):
+        # called on the thread of the sending Dispersy instance
+        self._total_down += sum(len(data) for _, data in packets)
+        packets = self._filter_packets(packets)
+        if packets:
+            self._dispersy.callback.register(self.dispersythread_data_came_in, (packets,), delay=latency)
+
+    def dispersythread_data_came_in(self, packets):
+        self._dispersy.on_incoming_packets(self._create_candidate_packets(packets), True, time())
@@ -6,7 +6,6 @@ try:
 except ImportError:
     from .python27_ordereddict import OrderedDict
 
-from .dispersydatabase import DispersyDatabase
 from .crypto import ec_from_private_bin, ec_from_public_bin, ec_signature_length, ec_verify, ec_sign
 from .revision import update_revision_information
 
@@ -17,14 +16,26 @@ if __debug__:
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
 
+def get_database():
+    """
+    Returns the database of the Dispersy instance that is bound to the current thread.
+
+    Multiple Dispersy instances can run in one process, each with its own database.  Members are
+    always created for the Dispersy instance that is running the current thread, see
+    Dispersy.get_instance.
+    """
+    from .dispersy import Dispersy
+    dispersy = Dispersy.has_instance()
+    assert dispersy, "Dispersy has not yet been created"
+    return dispersy.database
+
 class DummyMember(object):
     def __init__(self, mid):
         assert isinstance(mid, str)
         assert len(mid) == 20
         self._mid = mid
 
-        assert DispersyDatabase.has_instance(), "DispersyDatabase has not yet been created"
-        database = DispersyDatabase.get_instance()
+        database = get_database()
 
         try:
             database_id, = database.execute(u"SELECT id FROM member WHERE mid = ? LIMIT 1", (buffer(mid),)).next()
@@ -128,12 +139,11 @@ class MemberBase(DummyMember):
             if private_key and not self._private_key:
                 self._private_key = private_key
                 self._ec = ec_from_private_bin(private_key)
-                DispersyDatabase.get_instance().execute(u"INSERT INTO private_key (member, private_key) VALUES (?, ?)", (self._database_id, buffer(private_key)))
+                self._database.execute(u"INSERT INTO private_key (member, private_key) VALUES (?, ?)", (self._database_id, buffer(private_key)))
 
         else:
             # create a new instance
-            assert DispersyDatabase.has_instance(), "DispersyDatabase has not yet been created"
-            database = DispersyDatabase.get_instance()
+            database = get_database()
 
             try:
                 database_id, mid, tags, private_key_from_db = database.execute(u"SELECT m.id, m.mid, m.tags, p.private_key FROM member AS m LEFT OUTER JOIN private_key AS p ON p.member = m.id WHERE m.public_key = ? LIMIT 1", (buffer(public_key),)).next()
@@ -334,7 +344,32 @@ class MemberBase(DummyMember):
 
 class Member(MemberBase):
     _cache_length = 1024
-    _cache = OrderedDict()
+    # database:OrderedDict pairs, where the OrderedDict contains public_key:Member pairs.  every
+    # Dispersy instance has its own database, and hence its own members.  a subclass that defines
+    # its own _caches keeps its members separate from the Member cache
+    _caches = {}
+
+    @classmethod
+    def _get_cache(cls):
+        database = get_database()
+        try:
+            return cls._caches[database]
+        except KeyError:
+            cache = cls._caches[database] = OrderedDict()
+            return cache
+
+    @classmethod
+    def remove_caches(cls, database):
+        """
+        Removes the cached members of DATABASE, both from the Member cache and from the caches of
+        subclasses that have their own.  Called when DATABASE is closed.
+        """
+        classes = [cls]
+        while classes:
+            cls = classes.pop()
+            if "_caches" in cls.__dict__:
+                cls._caches.pop(database, None)
+            classes.extend(cls.__subclasses__())
 
     def __new__(cls, public_key, private_key=""):
         assert isinstance(public_key, str)
@@ -343,7 +378,7 @@ class Member(MemberBase):
         assert private_key == "" or ec_check_private_bin(private_key), [len(private_key), private_key.encode("HEX")]
 
         # retrieve Member from cache (based on public_key)
-        return cls._cache.get(public_key) or object.__new__(cls)
+        return cls._get_cache().get(public_key) or object.__new__(cls)
 
     def __init__(self, public_key, private_key=""):
         super(Member, self).__init__(public_key, private_key)
@@ -352,9 +387,10 @@ class Member(MemberBase):
         assert hasattr(self, "_mid"), self
 
         # store Member in cache
-        self._cache[public_key] = self
-        if len(self._cache) > self._cache_length:
-            self._cache.popitem(False)
+        cache = self._get_cache()
+        cache[public_key] = self
+        if len(cache) > self._cache_length:
+            cache.popitem(False)
 
 class MemberFromId(Member):
     def __new__(cls, mid):
@@ -362,7 +398,7 @@ class MemberFromId(Member):
         assert len(mid) == 20
 
         # retrieve Member from cache (based on mid)
-        for member in cls._cache.itervalues():
+        for member in cls._get_cache().itervalues():
             if member._mid == mid:
                 return member
 
@@ -374,7 +410,7 @@ class MemberFromDatabaseId(Member):
         assert isinstance(database_id, (int, long)), type(database_id)
 
         # retrieve Member from cache (based on database_id)
-        for member in cls._cache.itervalues():
+        for member in cls._get_cache().itervalues():
             if member._database_id == database_id:
                 return member
 
@@ -20,20 +20,12 @@ class DelayPacket(Exception):
         self._community = community
 
     def create_request(self, candidate, delayed):
-        # create and send a request.  once the response is received the _process_delayed_packet can
-        # pass the (candidate, delayed) tuple to dispersy for reprocessing
+        # create and send a request.  the (candidate, delayed) tuple is given to dispersy as
+        # delayed_packet, it is reprocessed together with the other packets waiting for the same
+        # response once the response is received
         # @return True if actual request is made
         raise NotImplementedError()
 
-    def _process_delayed_packet(self, response, candidate, delayed):
-        if response:
-            # process the response and the delayed message
-            self._community.dispersy.on_incoming_packets([(candidate, delayed)])
-            self._community.dispersy.statistics.delay_success += 1
-        else:
-            # timeout, do nothing
-            self._community.dispersy.statistics.delay_timeout += 1
-
 class DelayPacketByMissingMember(DelayPacket):
     def __init__(self, community, missing_member_id):
         assert isinstance(missing_member_id, str)
@@ -42,7 +34,7 @@ class DelayPacketByMissingMember(DelayPacket):
         self._missing_member_id = missing_member_id
 
     def create_request(self, candidate, delayed):
-        return self._community.dispersy.create_missing_identity(self._community, candidate, DummyMember(self._missing_member_id), self._process_delayed_packet, (candidate, delayed))
+        return self._community.dispersy.create_missing_identity(self._community, candidate, DummyMember(self._missing_member_id), delayed_packet=(candidate, delayed))
 
 class DelayPacketByMissingLastMessage(DelayPacket):
     def __init__(self, community, member, message, count):
@@ -57,7 +49,7 @@ class DelayPacketByMissingLastMessage(DelayPacket):
         self._count = count
 
     def create_request(self, candidate, delayed):
-        return self._community.dispersy.create_missing_last_message(self._community, candidate, self._member, self._message, self._count, self._process_delayed_packet, (candidate, delayed))
+        return self._community.dispersy.create_missing_last_message(self._community, candidate, self._member, self._message, self._count, delayed_packet=(candidate, delayed))
 
 class DelayPacketByMissingMessage(DelayPacket):
     def __init__(self, community, member, global_time):
@@ -72,7 +64,7 @@ class DelayPacketByMissingMessage(DelayPacket):
         self._global_time = global_time
 
     def create_request(self, candidate, delayed):
-        return self._community.dispersy.create_missing_message(self._community, candidate, self._member, self._global_time, self._process_delayed_packet, (candidate, delayed))
+        return self._community.dispersy.create_missing_message(self._community, candidate, self._member, self._global_time, delayed_packet=(candidate, delayed))
 
 class DropPacket(Exception):
     """
@@ -197,7 +189,7 @@ class DropMessage(Exception):
 #
 
 class BatchConfiguration(object):
-    def __init__(self, max_window=0.0, priority=0, max_size=1024, max_age=300.0):
+    def __init__(self, max_window=0.0, priority=0, max_size=1024, max_age=300.0, adaptive=False, min_window=0.0):
         """
         Per meta message configuration on batch handling.
 
@@ -217,6 +209,13 @@ class BatchConfiguration(object):
         response.  When the requests are delayed for to long they will time out, in this case a
         response no longer needs to be sent.  MAX_AGE for the request messages should hence be lower
         than the used timeout + max_window on the response messages.
+
+        ADAPTIVE enables tuning of the window between MIN_WINDOW and MAX_WINDOW.  After each batch
+        the observed arrival rate and processing time per message are used to estimate the
+        fraction of time that the Dispersy thread spends on this meta message.  The window grows
+        with this load, larger batches amortize the per batch costs such as the database commit.
+        When batches would contain a single message the window is set to MIN_WINDOW, as it would
+        only add latency.  Without ADAPTIVE the window is always MAX_WINDOW.
         """
         assert isinstance(max_window, float)
         assert 0.0 <= max_window, max_window
@@ -225,10 +224,23 @@ class BatchConfiguration(object):
         assert 0 < max_size, max_size
         assert isinstance(max_age, float)
         assert 0.0 <= max_window < max_age, [max_window, max_age]
+        assert isinstance(adaptive, bool)
+        assert isinstance(min_window, float)
+        assert 0.0 <= min_window <= max_window, [min_window, max_window]
         self._max_window = max_window
         self._priority = priority
         self._max_size = max_size
         self._max_age = max_age
+        self._adaptive = adaptive
+        self._min_window = min_window
+
+        # the current window and the size of the most recent batch
+        self._window = max_window
+        self._size = 0
+        # smoothed arrival rate (messages per second) and processing time (seconds per message)
+        self._rate = 0.0
+        self._cost = 0.0
+        self._last_batch = 0.0
 
     @property
     def enabled(self):
@@ -251,11 +263,62 @@ class BatchConfiguration(object):
     def max_age(self):
         return self._max_age
 
+    @property
+    def adaptive(self):
+        return self._adaptive
+
+    @property
+    def min_window(self):
+        return self._min_window
+
+    @property
+    def window(self):
+        """
+        The current window in seconds.
+        """
+        return self._window
+
+    @property
+    def size(self):
+        """
+        The number of messages in the most recent batch.
+        """
+        return self._size
+
+    def batch_processed(self, size, duration, now):
+        """
+        Called after a batch of SIZE messages was processed in DURATION seconds.  Updates the
+        window when the configuration is adaptive.
+        """
+        assert isinstance(size, int)
+        assert 0 < size
+        assert isinstance(duration, float)
+        assert isinstance(now, float)
+        self._size = size
+
+        if self._adaptive:
+            # the messages in this batch arrived since the previous batch, or within the window
+            # when the previous batch is long ago
+            interval = max(self._window, min(now - self._last_batch, self._max_age), 0.001)
+            self._last_batch = now
+            self._rate = 0.75 * self._rate + 0.25 * (size / interval)
+            self._cost = 0.75 * self._cost + 0.25 * (duration / size)
+
+            if self._rate * self._max_window < 2.0:
+                # even the largest window would not combine messages
+                self._window = self._min_window
+            else:
+                # the full window is used once this meta message occupies half the thread
+                load = self._rate * self._cost
+                self._window = self._min_window + (self._max_window - self._min_window) * min(1.0, 2.0 * load)
+
 #
 # packet
 #
 
 class Packet(MetaObject.Implementation):
+    __slots__ = ["_packet", "_packet_id"]
+
     def __init__(self, meta, packet, packet_id):
         assert isinstance(packet, str)
         assert isinstance(packet_id, (int, long))
@@ -326,7 +389,9 @@ class Packet(MetaObject.Implementation):
 #
 class Message(MetaObject):
     class Implementation(Packet):
-        def __init__(self, meta, authentication, resolution, distribution, destination, payload, conversion=None, candidate=None, packet="", packet_id=0, sign=True):
+        __slots__ = ["_authentication", "_resolution", "_distribution", "_destination", "_payload", "_candidate", "_lazy_payload", "_resume", "_conversion"]
+
+        def __init__(self, meta, authentication, resolution, distribution, destination, payload, conversion=None, candidate=None, packet="", packet_id=0, sign=True, lazy_payload=None):
             if __debug__:
                 from .payload import Payload
                 from .conversion import Conversion
@@ -336,7 +401,7 @@ class Message(MetaObject):
             assert isinstance(resolution, meta.resolution.Implementation), "RESOLUTION has invalid type '%s'" % type(resolution)
             assert isinstance(distribution, meta.distribution.Implementation), "DISTRIBUTION has invalid type '%s'" % type(distribution)
             assert isinstance(destination, meta.destination.Implementation), "DESTINATION has invalid type '%s'" % type(destination)
-            assert isinstance(payload, meta.payload.Implementation), "PAYLOAD has invalid type '%s'" % type(payload)
+            assert isinstance(payload, meta.payload.Implementation) or (payload is None and lazy_payload and conversion and packet), "PAYLOAD has invalid type '%s'" % type(payload)
             assert conversion is None or isinstance(conversion, Conversion), "CONVERSION has invalid type '%s'" % type(conversion)
             assert candidate is None or isinstance(candidate, Candidate)
             assert isinstance(packet, str)
@@ -349,6 +414,10 @@ class Message(MetaObject):
             self._payload = payload
             self._candidate = candidate
 
+            # _LAZY_PAYLOAD is given by the conversion when the payload has not been decoded yet.
+            # The payload is decoded, using the conversion, the first time it is accessed
+            self._lazy_payload = lazy_payload
+
             # _RESUME contains the message that caused SELF to be processed after it was delayed
             self._resume = None
 
@@ -392,8 +461,19 @@ class Message(MetaObject):
 
         @property
         def payload(self):
+            if self._payload is None:
+                # may raise DropPacket or DelayPacket
+                self._payload = self._conversion.decode_payload(self._lazy_payload)
+                self._lazy_payload = None
             return self._payload
 
+        @property
+        def has_payload(self):
+            """
+            True when the payload has been decoded.
+            """
+            return self._payload is not None
+
         @property
         def candidate(self):
             return self._candidate
@@ -412,6 +492,17 @@ class Message(MetaObject):
             return self
 
         def regenerate_packet(self, packet=""):
+            """
+            Replace the packet that this message owns.
+
+            A message owns its packet: it is encoded, and signed, exactly once when the message is
+            created without a packet.  Messages that are decoded, loaded from the database, stored,
+            forwarded, or sent as proof always use these packet bytes as is.  The packet is only
+            encoded again when the message itself changes, i.e. when a signature is added through
+            authentication.set_signature.
+
+            When PACKET is given it is used instead of encoding the message again.
+            """
             if packet:
                 self._packet = packet
             else:
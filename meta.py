@@ -8,6 +8,8 @@ update_revision_information("$HeadURL$", "$Revision$")
 
 class MetaObject(object):
     class Implementation(object):
+        __slots__ = ["_meta"]
+
         def __init__(self, meta):
             assert isinstance(meta, MetaObject)
             self._meta = meta
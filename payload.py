@@ -20,7 +20,7 @@ update_revision_information("$HeadURL$", "$Revision$")
 
 class Payload(MetaObject):
     class Implementation(MetaObject.Implementation):
-        pass
+        __slots__ = []
 
     def setup(self, message):
         """
@@ -35,6 +35,8 @@ class Payload(MetaObject):
 
 class IntroductionRequestPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_destination_address", "_source_lan_address", "_source_wan_address", "_advice", "_connection_type", "_identifier", "_time_low", "_time_high", "_modulo", "_offset", "_bloom_filter"]
+
         def __init__(self, meta, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier):
             """
             Create the payload for an introduction-request message.
@@ -157,6 +159,8 @@ class IntroductionRequestPayload(Payload):
 
 class IntroductionResponsePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_destination_address", "_source_lan_address", "_source_wan_address", "_lan_introduction_address", "_wan_introduction_address", "_connection_type", "_tunnel", "_identifier"]
+
         def __init__(self, meta, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier):
             """
             Create the payload for an introduction-response message.
@@ -246,6 +250,8 @@ class IntroductionResponsePayload(Payload):
 
 class PunctureRequestPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_lan_walker_address", "_wan_walker_address", "_identifier"]
+
         def __init__(self, meta, lan_walker_address, wan_walker_address, identifier):
             """
             Create the payload for a puncture-request payload.
@@ -287,6 +293,8 @@ class PunctureRequestPayload(Payload):
 
 class PuncturePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_source_lan_address", "_source_wan_address", "_identifier"]
+
         def __init__(self, meta, source_lan_address, source_wan_address, identifier):
             """
             Create the payload for a puncture message
@@ -323,6 +331,8 @@ class PuncturePayload(Payload):
 
 class AuthorizePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_permission_triplets"]
+
         def __init__(self, meta, permission_triplets):
             """
             Authorize the given permission_triplets.
@@ -354,6 +364,8 @@ class AuthorizePayload(Payload):
 
 class RevokePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_permission_triplets"]
+
         def __init__(self, meta, permission_triplets):
             """
             Revoke the given permission_triplets.
@@ -385,6 +397,8 @@ class RevokePayload(Payload):
 
 class UndoPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_member", "_global_time", "_packet"]
+
         def __init__(self, meta, member, global_time, packet=None):
             if __debug__:
                 from .member import Member
@@ -420,6 +434,8 @@ class UndoPayload(Payload):
 
 class MissingSequencePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_member", "_message", "_missing_low", "_missing_high"]
+
         def __init__(self, meta, member, message, missing_low, missing_high):
             """
             We are missing messages of type MESSAGE signed by USER.  We
@@ -458,6 +474,8 @@ class MissingSequencePayload(Payload):
 
 class SignaturePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_identifier", "_message"]
+
         def __init__(self, meta, identifier, message):
             if __debug__:
                 from .message import Message
@@ -478,18 +496,20 @@ class SignaturePayload(Payload):
 
 class SignatureRequestPayload(SignaturePayload):
     class Implementation(SignaturePayload.Implementation):
-        pass
+        __slots__ = []
 
 class SignatureResponsePayload(SignaturePayload):
     class Implementation(SignaturePayload.Implementation):
-        pass
+        __slots__ = []
 
 class IdentityPayload(Payload):
     class Implementation(Payload.Implementation):
-        pass
+        __slots__ = []
 
 class MissingIdentityPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_mid"]
+
         def __init__(self, meta, mid):
             assert isinstance(mid, str)
             assert len(mid) == 20
@@ -502,6 +522,8 @@ class MissingIdentityPayload(Payload):
 
 class DestroyCommunityPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_degree"]
+
         def __init__(self, meta, degree):
             assert isinstance(degree, unicode)
             assert degree in (u"soft-kill", u"hard-kill")
@@ -522,6 +544,8 @@ class DestroyCommunityPayload(Payload):
 
 class MissingMessagePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_member", "_global_times"]
+
         def __init__(self, meta, member, global_times):
             if __debug__:
                 from .member import Member
@@ -545,6 +569,8 @@ class MissingMessagePayload(Payload):
 
 class MissingLastMessagePayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_member", "_message", "_count"]
+
         def __init__(self, meta, member, message, count):
             if __debug__:
                 from .member import Member
@@ -568,6 +594,8 @@ class MissingLastMessagePayload(Payload):
 
 class MissingProofPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_member", "_global_time"]
+
         def __init__(self, meta, member, global_time):
             if __debug__:
                 from .member import Member
@@ -588,6 +616,8 @@ class MissingProofPayload(Payload):
 
 class DynamicSettingsPayload(Payload):
     class Implementation(Payload.Implementation):
+        __slots__ = ["_policies"]
+
         def __init__(self, meta, policies):
             """
             Create a new payload container for a dispersy-dynamic-settings message.
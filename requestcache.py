@@ -1,10 +1,13 @@
+from collections import deque
 from random import random
+from time import time
+
+from .dprint import dprint
 from .revision import update_revision_information
 
 if __debug__:
     def identifier_to_string(identifier):
         return identifier.encode("HEX") if isinstance(identifier, str) else identifier
-    from .dprint import dprint
 
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
@@ -14,6 +17,10 @@ class Cache(object):
     cleanup_delay = 10.0
 
     def on_timeout(self):
+        """
+        Called when TIMEOUT_DELAY seconds passed without a response.  Returns True when the
+        request was retried, in which case the timeout starts again.
+        """
         raise NotImplementedError()
     
     def on_cleanup(self):
@@ -23,16 +30,47 @@ class Cache(object):
         return "<%s>" % self.__class__.__name__
 
 class RequestCache(object):
+    """
+    Assigns identifiers to outstanding requests and calls Cache.on_timeout and Cache.on_cleanup
+    once their delays expire.
+
+    Claimed identifiers are handed out sequentially, starting at a random offset, and skip the
+    identifiers that are still in use.  The identifiers are sent in 16 bit payload fields, hence
+    they wrap around at 2**16.
+
+    Entries are not scheduled individually.  All entries with the same delay expire in the order
+    that they were added, hence they are kept in one queue that is processed by one Callback task.
+    Each task sleeps until the first entry in its queue expires and then handles all expired
+    entries at once.  An exception raised by Cache.on_timeout or Cache.on_cleanup is logged and
+    the identifier is released, it does not affect the other entries.
+    """
     def __init__(self, callback):
         self._callback = callback
+        # identifier:Cache pairs
         self._identifiers = dict()
+        # identifier:(deadline, identifier, cache, func) pairs.  only this entry is valid, other
+        # entries for the same identifier are skipped when their queue is processed
+        self._entries = dict()
+        # (func name, delay):deque pairs, each queue is processed by _process_queue
+        self._queues = dict()
+        # the next identifier to claim
+        self._next_identifier = int(random() * 2**16)
+        # Cache class name:count pairs
+        self._counts = dict()
+
+    @property
+    def statistics(self):
+        """
+        Returns a dictionary with the number of entries for each Cache class.
+        """
+        return dict(self._counts)
 
     def claim(self, cache):
-        while True:
-            identifier = int(random() * 2**16)
-            if not identifier in self._identifiers:
-                if __debug__: dprint("claiming on ", identifier_to_string(identifier), " for ", cache)
-                break
+        identifier = self._next_identifier
+        while identifier in self._identifiers:
+            identifier = (identifier + 1) % 2**16
+        self._next_identifier = (identifier + 1) % 2**16
+        if __debug__: dprint("claiming on ", identifier_to_string(identifier), " for ", cache)
 
         self.set(identifier, cache)
         return identifier
@@ -45,9 +83,11 @@ class RequestCache(object):
         assert cache.timeout_delay > 0.0
 
         if __debug__: dprint("set ", identifier_to_string(identifier), " for ", cache, " (", cache.timeout_delay, "s timeout)")
-        self._callback.register(self._on_timeout, (identifier,), id_="requestcache-%s" % identifier, delay=cache.timeout_delay)
         self._identifiers[identifier] = cache
         cache.identifier = identifier
+        name = cache.__class__.__name__
+        self._counts[name] = self._counts.get(name, 0) + 1
+        self._schedule(identifier, cache, cache.timeout_delay, self._on_timeout)
 
     def has(self, identifier, cls):
         assert isinstance(identifier, (int, long, str)), type(identifier)
@@ -75,31 +115,87 @@ class RequestCache(object):
             if __debug__: dprint("canceling timeout on ", identifier_to_string(identifier), " for ", cache)
 
             if cache.cleanup_delay:
-                self._callback.replace_register("requestcache-%s" % identifier, self._on_cleanup, (identifier,), delay=cache.cleanup_delay)
+                self._schedule(identifier, cache, cache.cleanup_delay, self._on_cleanup)
 
             else:
-                self._callback.unregister("requestcache-%s" % identifier)
-                del self._identifiers[identifier]
+                self._remove(identifier)
 
             return cache
 
+    def _schedule(self, identifier, cache, delay, func):
+        """
+        Call FUNC(IDENTIFIER) in DELAY seconds, replacing any previously scheduled call for
+        IDENTIFIER.
+        """
+        entry = (time() + delay, identifier, cache, func)
+        self._entries[identifier] = entry
+
+        key = (func.__name__, delay)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._callback.register(self._process_queue, (key, queue), delay=delay)
+        queue.append(entry)
+
+    def _process_queue(self, key, queue):
+        try:
+            while queue:
+                now = time()
+                if queue[0][0] > now:
+                    yield queue[0][0] - now
+                    continue
+
+                # handle all expired entries at once
+                while queue and queue[0][0] <= now:
+                    entry = queue.popleft()
+                    identifier = entry[1]
+                    if self._entries.get(identifier) is entry:
+                        del self._entries[identifier]
+                        try:
+                            entry[3](identifier)
+                        except Exception:
+                            dprint("exception while handling ", entry[2], exception=True, level="error")
+
+        finally:
+            # a new queue is created for KEY when entries are scheduled after this task has finished
+            if self._queues.get(key) is queue:
+                del self._queues[key]
+
+    def _remove(self, identifier):
+        cache = self._identifiers.pop(identifier)
+        self._entries.pop(identifier, None)
+        name = cache.__class__.__name__
+        if self._counts[name] > 1:
+            self._counts[name] -= 1
+        else:
+            del self._counts[name]
+
     def _on_timeout(self, identifier):
         assert identifier in self._identifiers, identifier
         cache = self._identifiers.get(identifier)
         if __debug__: dprint("timeout on ", identifier_to_string(identifier), " for ", cache)
-        cache.on_timeout()
-        
-        #Niels: 01-10-2012 if identifier is not yet removed by timeout method
-        if identifier in self._identifiers:
-            if cache.cleanup_delay:
-                self._callback.register(self._on_cleanup, (identifier,), id_="requestcache-%s" % identifier, delay=cache.cleanup_delay)
-            else:
-                del self._identifiers[identifier]
+        retried = False
+        try:
+            retried = cache.on_timeout()
+
+        finally:
+            if self._identifiers.get(identifier) is cache and not identifier in self._entries:
+                if retried:
+                    self._schedule(identifier, cache, cache.timeout_delay, self._on_timeout)
+
+                #Niels: 01-10-2012 if identifier is not yet removed by timeout method
+                elif cache.cleanup_delay:
+                    self._schedule(identifier, cache, cache.cleanup_delay, self._on_cleanup)
+
+                else:
+                    self._remove(identifier)
 
     def _on_cleanup(self, identifier):
         assert identifier in self._identifiers
         cache = self._identifiers[identifier]
         if __debug__: dprint("cleanup on ", identifier_to_string(identifier), " for ", cache)
-        cache.on_cleanup()
-        
-        del self._identifiers[identifier]
+        try:
+            cache.on_cleanup()
+
+        finally:
+            self._remove(identifier)
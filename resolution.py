@@ -6,7 +6,7 @@ update_revision_information("$HeadURL$", "$Revision$")
 
 class Resolution(MetaObject):
     class Implementation(MetaObject.Implementation):
-        pass
+        __slots__ = []
 
     def setup(self, message):
         """
@@ -21,14 +21,14 @@ class PublicResolution(Resolution):
     PublicResolution allows any member to create a message.
     """
     class Implementation(Resolution.Implementation):
-        pass
+        __slots__ = []
 
 class LinearResolution(Resolution):
     """
     LinearResolution allows only members that have a specific permission to create a message.
     """
     class Implementation(Resolution.Implementation):
-        pass
+        __slots__ = []
 
 class DynamicResolution(Resolution):
     """
@@ -39,6 +39,8 @@ class DynamicResolution(Resolution):
     and LinearResolution.
     """
     class Implementation(Resolution.Implementation):
+        __slots__ = ["_policy"]
+
         def __init__(self, meta, policy):
             """
             Create a DynamicResolution.Implementation instance.
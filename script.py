@@ -10,19 +10,21 @@ Run some python code, usually to test one or more features.
 """
 
 from hashlib import sha1
-from random import shuffle
+from random import Random, shuffle
 from time import time
 import gc
 import inspect
 import socket
+import sys
 
-from .candidate import BootstrapCandidate
+from .callback import Callback
+from .candidate import BootstrapCandidate, Candidate
 from .crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
 from .debug import Node
 from .debugcommunity import DebugCommunity, DebugNode
 from .dispersy import Dispersy
-from .dispersydatabase import DispersyDatabase
 from .dprint import dprint
+from .endpoint import MMSG_AVAILABLE, MMsgEndpoint, StandaloneEndpoint, MemoryNetwork, MemoryEndpoint
 from .member import Member
 from .message import BatchConfiguration, Message, DelayMessageByProof, DropMessage
 from .resolution import PublicResolution, LinearResolution
@@ -54,7 +56,7 @@ class ScriptBase(object):
         self._kargs = kargs
         self._testcases = []
         self._dispersy = Dispersy.get_instance()
-        self._dispersy_database = DispersyDatabase.get_instance()
+        self._dispersy_database = self._dispersy.database
         # self._dispersy.callback.register(self.run)
         if self.enable_wait_for_wan_address:
             self.add_testcase(self.wait_for_wan_address)
@@ -765,9 +767,11 @@ class DispersyTimelineScript(ScriptBase):
         self.add_testcase(self.succeed_check)
         self.add_testcase(self.fail_check)
         self.add_testcase(self.loading_community)
+        self.add_testcase(self.loading_community_snapshot)
         self.add_testcase(self.delay_by_proof)
         self.add_testcase(self.missing_proof)
         self.add_testcase(self.missing_authorize_proof)
+        self.add_testcase(self.random_permissions)
 
     def succeed_check(self):
         """
@@ -860,6 +864,58 @@ class DispersyTimelineScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+    def loading_community_snapshot(self):
+        """
+        When a community is unloaded a snapshot of its timeline is stored.  Loading the community
+        must give the same permissions, also when the snapshot is invalid.
+        """
+        class LoadingCommunitySnapshotTestCommunity(DebugCommunity):
+            pass
+
+        def load_community():
+            communities = [LoadingCommunitySnapshotTestCommunity.load_community(master) for master in LoadingCommunitySnapshotTestCommunity.get_master_members()]
+            assert_(len(communities) == 1)
+            assert_(communities[0].cid == cid)
+            return communities[0]
+
+        community = LoadingCommunitySnapshotTestCommunity.create_community(self._my_member)
+        cid = community.cid
+        database_id = community.database_id
+        community.unload_community()
+        yield 0.555
+
+        # the snapshot must contain the permissions given when the community was created
+        count, = self._dispersy.database.execute(u"SELECT count FROM timeline_snapshot WHERE community = ?", (database_id,)).next()
+        assert_(count > 0, count)
+        community = load_community()
+        message = community.create_dispersy_destroy_community(u"hard-kill", store=False, update=False, forward=False)
+        allowed, proofs = community.timeline.check(message)
+        assert_(allowed)
+        assert_(proofs and all(proof.name == u"dispersy-authorize" and proof.packet_id for proof in proofs), proofs)
+
+        # remove the right to hard-kill, the new snapshot must include the revoke
+        community.create_dispersy_revoke([(community.my_member, community.get_meta_message(u"dispersy-destroy-community"), u"permit")], sign_with_master=True)
+        community.unload_community()
+        yield 0.555
+
+        community = load_community()
+        message = community.create_dispersy_destroy_community(u"hard-kill", store=False, update=False, forward=False)
+        allowed, _ = community.timeline.check(message)
+        assert_(not allowed)
+        community.unload_community()
+        yield 0.555
+
+        # an invalid snapshot must be ignored
+        self._dispersy.database.execute(u"UPDATE timeline_snapshot SET snapshot = ? WHERE community = ?", (buffer("invalid"), database_id))
+        community = load_community()
+        message = community.create_dispersy_destroy_community(u"hard-kill", store=False, update=False, forward=False)
+        allowed, _ = community.timeline.check(message)
+        assert_(not allowed)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill", sign_with_master=True)
+        self._dispersy.get_community(community.cid).unload_community()
+
     def delay_by_proof(self):
         """
         When SELF receives a message that it has no permission for, it will send a
@@ -1030,6 +1086,108 @@ class DispersyTimelineScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+    def random_permissions(self):
+        """
+        The master member grants and revokes permissions, and changes the resolution policy, at
+        random global times.  Timeline.check must agree with the most recent change at or before
+        the global time of each message, and Timeline.check_batch must give the same results as
+        Timeline.check.  This covers the LinearResolution and DynamicResolution policies and
+        messages signed by two members.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+        timeline = community.timeline
+        rng = Random(42)
+        protected = community.get_meta_message(u"protected-full-sync-text")
+        dynamic = community.get_meta_message(u"dynamic-resolution-text")
+        doublemember = community.get_meta_message(u"protected-doublemember-text")
+
+        nodes = []
+        for _ in xrange(4):
+            node = DebugNode()
+            node.init_socket()
+            node.set_community(community)
+            node.init_my_member(candidate=False, identity=False)
+            nodes.append(node)
+
+        # (member, meta name):{global time:allowed} and global time:policy pairs.  every change uses
+        # a different global time, conflicting changes at the same global time are not supported
+        permissions = {}
+        policies = {}
+        for global_time in rng.sample(xrange(1, 250), 150):
+            if rng.random() < 0.2:
+                policy = rng.choice(dynamic.resolution.policies)
+                proof = community.create_dispersy_dynamic_settings([(dynamic, policy)], sign_with_master=True, store=False, update=False, forward=False)
+                timeline.change_resolution_policy(dynamic, global_time, policy, proof)
+                policies[global_time] = policy
+
+            else:
+                member = rng.choice(nodes).my_member
+                meta = rng.choice([protected, dynamic, doublemember])
+                allowed = rng.random() < 0.6
+                triplets = [(member, meta, u"permit")]
+                if allowed:
+                    proof = community.create_dispersy_authorize(triplets, sign_with_master=True, store=False, update=False, forward=False)
+                    result = timeline.authorize(community.master_member, global_time, triplets, proof)
+                else:
+                    proof = community.create_dispersy_revoke(triplets, sign_with_master=True, store=False, update=False, forward=False)
+                    result = timeline.revoke(community.master_member, global_time, triplets, proof)
+                assert_(result[0])
+                permissions.setdefault((member, meta.name), {})[global_time] = allowed
+
+        def is_allowed(members, meta, policy, global_time):
+            if meta == dynamic:
+                times = [policy_time for policy_time in policies if policy_time < global_time]
+                current = policies[max(times)] if times else dynamic.resolution.default
+                if not policy == current:
+                    return False
+                if isinstance(policy, PublicResolution):
+                    return True
+
+            for member in members:
+                history = permissions.get((member, meta.name), {})
+                times = [permission_time for permission_time in history if permission_time <= global_time]
+                if not (times and history[max(times)]):
+                    return False
+            return True
+
+        # meta:[message] pairs
+        batches = {}
+        for index in xrange(1000):
+            global_time = rng.randint(1, 260)
+            node, other = rng.sample(nodes, 2)
+            meta = rng.choice([protected, dynamic, doublemember])
+            policy = None
+            if meta == protected:
+                message = node.create_protected_full_sync_text_message("random permissions #%d" % index, global_time)
+                members = [node.my_member]
+            elif meta == dynamic:
+                policy = rng.choice(dynamic.resolution.policies)
+                message = node.create_dynamic_resolution_text_message("random permissions #%d" % index, global_time, policy.implement())
+                members = [node.my_member]
+            else:
+                message = node.create_protected_doublemember_text_message(other.my_member, "random permissions #%d" % index, global_time)
+                members = [node.my_member, other.my_member]
+
+            allowed, _ = timeline.check(message)
+            assert_(allowed == is_allowed(members, meta, policy, global_time), message.name, global_time, allowed)
+            batches.setdefault(meta, []).append(message)
+
+        # check_batch shares lookups between messages, the outcome must be the same as check
+        for messages in batches.itervalues():
+            while messages:
+                size = rng.randint(1, 50)
+                batch, messages = messages[:size], messages[size:]
+                results = timeline.check_batch(batch)
+                assert_(len(results) == len(batch))
+                for message, (allowed, proofs) in zip(batch, results):
+                    expected_allowed, expected_proofs = timeline.check(message)
+                    assert_(allowed == expected_allowed, message.name, message.distribution.global_time)
+                    assert_([proof.packet for proof in proofs] == [proof.packet for proof in expected_proofs], message.name, message.distribution.global_time)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
 class DispersyDestroyCommunityScript(ScriptBase):
     def run(self):
         ec = ec_generate_key(u"low")
@@ -1378,7 +1536,7 @@ class DispersyBatchScript(ScriptBase):
 
         # wait till the batch is processed
         meta = community.get_meta_message(u"full-sync-text")
-        while meta in self._dispersy._batch_cache:
+        while meta in self._dispersy._batch_cache.get(community, ()):
             yield 0.1
 
         end = time()
@@ -2168,6 +2326,7 @@ class DispersyMissingMessageScript(ScriptBase):
         self.add_testcase(self.single_request)
         self.add_testcase(self.single_request_out_of_order)
         self.add_testcase(self.triple_request)
+        self.add_testcase(self.missing_identity_retry)
 
     def single_request(self):
         """
@@ -2279,6 +2438,72 @@ class DispersyMissingMessageScript(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+    def missing_identity_retry(self):
+        """
+        NODE1 and NODE2 both give SELF a message created by CREATOR, whose identity SELF does not
+        have.  SELF asks NODE1 for the identity, NODE1 does not respond, hence SELF asks NODE2 once
+        the request times out.  After NODE2 responds both delayed messages are processed together.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+        statistics = self._dispersy.statistics
+
+        node1 = DebugNode()
+        node1.init_socket()
+        node1.set_community(community)
+        node1.init_my_member()
+
+        node2 = DebugNode()
+        node2.init_socket()
+        node2.set_community(community)
+        node2.init_my_member()
+
+        # CREATOR never sends anything to SELF itself
+        creator = DebugNode()
+        creator.init_socket()
+        creator.set_community(community)
+        creator.init_my_member(candidate=False, identity=False)
+        messages = [creator.create_full_sync_text_message("missing identity #%d" % global_time, global_time) for global_time in (10, 11)]
+        map(creator.encode_message, messages)
+
+        node1.drop_packets()
+        node2.drop_packets()
+        delay_success = statistics.delay_success
+        delay_timeout = statistics.delay_timeout
+
+        # both nodes trigger the same missing identity, only NODE1 is asked
+        node1.give_packet(messages[0].packet)
+        node2.give_packet(messages[1].packet)
+        yield 0.11
+        _, request = node1.receive_message(message_names=[u"dispersy-missing-identity"])
+        assert_(request.payload.mid == creator.my_member.mid)
+        try:
+            _, request = node2.receive_message(message_names=[u"dispersy-missing-identity"])
+        except socket.error:
+            pass
+        else:
+            assert_(False, "NODE2 may only be asked after the request to NODE1 timed out")
+
+        # NODE1 does not respond, after the timeout NODE2 is asked
+        yield 5.0
+        _, request = node2.receive_message(message_names=[u"dispersy-missing-identity"])
+        assert_(request.payload.mid == creator.my_member.mid)
+        assert_(statistics.delay_success == delay_success)
+
+        # NODE2 responds, both delayed messages are stored
+        identity = creator.create_dispersy_identity_message(2)
+        creator.encode_message(identity)
+        node2.give_packet(identity.packet)
+        yield 0.11
+        times = [global_time for global_time, in self._dispersy_database.execute(u"SELECT global_time FROM sync WHERE community = ? AND member = ? AND meta_message = ? ORDER BY global_time",
+                                                                                  (community.database_id, creator.my_member.database_id, messages[0].database_id))]
+        assert_(times == [10, 11], times)
+        assert_(statistics.delay_success == delay_success + 2, statistics.delay_success - delay_success)
+        assert_(statistics.delay_timeout == delay_timeout, statistics.delay_timeout - delay_timeout)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
 class DispersyUndoScript(ScriptBase):
     def run(self):
         ec = ec_generate_key(u"low")
@@ -2662,6 +2887,7 @@ class DispersyUndoScript(ScriptBase):
             undone = list(self._dispersy_database.execute(u"SELECT undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
                                                           (community.database_id, node.my_member.database_id, message.distribution.global_time)))
             assert_(len(undone) == 1)
+            assert_(undone[0][0], "message @%d is not undone" % message.distribution.global_time)
             undone_packet, = self._dispersy_database.execute(u"SELECT packet FROM sync WHERE id = ?", (undone[0][0],)).next()
             undone_packet = str(undone_packet)
             assert_(undo.packet == undone_packet)
@@ -3292,3 +3518,413 @@ class DispersyBootstrapServersStresstest(ScriptBase):
         community.create_dispersy_destroy_community(u"hard-kill")
         self._dispersy.get_community(community.cid).unload_community()
 
+
+class DispersyMessageMemoryScript(ScriptBase):
+    def run(self):
+        ec = ec_generate_key(u"very-low")
+        self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        self.add_testcase(self.bytes_per_message, (1000,))
+
+    def bytes_per_message(self, length):
+        """
+        Decode LENGTH full-sync-text packets and report the number of bytes that the resulting
+        Message.Implementation instances, including their policy implementations, occupy.
+
+        Run this script on two revisions to compare the memory usage before and after a change.
+        """
+        def sizeof(obj):
+            size = sys.getsizeof(obj)
+            if hasattr(obj, "__dict__"):
+                size += sys.getsizeof(obj.__dict__)
+            return size
+
+        community = DebugCommunity.create_community(self._my_member)
+        conversion = community.get_conversion()
+
+        # create node and ensure that SELF knows the node address
+        node = DebugNode()
+        node.init_socket()
+        node.set_community(community)
+        node.init_my_member()
+
+        packets = [node.encode_message(node.create_full_sync_text_message("Dprint=False, memory #%d" % global_time, global_time)) for global_time in xrange(10, 10 + length)]
+        candidate = Candidate(node.lan_address, False)
+
+        gc.collect()
+        messages = [conversion.decode_message(candidate, packet, verify=False) for packet in packets]
+
+        total = 0
+        dicts = 0
+        for message in messages:
+            for obj in (message, message.authentication, message.resolution, message.distribution, message.destination, message.payload):
+                total += sizeof(obj)
+                if hasattr(obj, "__dict__"):
+                    dicts += 1
+
+        dprint(length, " messages use ", total, " bytes (", total / length, " bytes per message, ", dicts / length, " instance dictionaries per message)", force=1)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+class DispersyWalkCandidatesScript(ScriptBase):
+    @property
+    def enable_wait_for_wan_address(self):
+        return False
+
+    def run(self):
+        ec = ec_generate_key(u"very-low")
+        self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        self.add_testcase(self.walk_target_selection, (10000, 1000))
+
+    def walk_target_selection(self, count, steps):
+        """
+        Create COUNT stumble and intro candidates and take STEPS walker steps.  Every step must
+        select an eligible candidate that was not yet walked to, i.e. the candidate with the oldest
+        stumble or intro time.  Reports the time needed per step.
+        """
+        community = DebugCommunity.create_community(self._my_member)
+
+        now = time()
+        for index in xrange(count):
+            address = ("10.%d.%d.%d" % (index // 62500, index // 250 % 250, index % 250 + 1), 7000)
+            candidate = community.create_candidate(address, False, address, address, u"unknown")
+            if index % 2:
+                candidate.stumble(community, now - index * 0.001)
+            else:
+                candidate.intro(community, now - index * 0.001)
+
+        walked = set()
+        begin = time()
+        for _ in xrange(steps):
+            now = time()
+            candidate = community.dispersy_yield_walk_candidates().next()
+            assert_(candidate.is_eligible_for_walk(community, now))
+            assert_(not candidate in walked, candidate)
+            walked.add(candidate)
+            candidate.walk(community, now, 0.0)
+        end = time()
+
+        dprint(steps, " walker steps with ", count, " candidates took ", "%.3f" % (end - begin), " seconds (", "%.1f" % ((end - begin) * 1000000.0 / steps), " us per step)", force=1)
+
+        # cleanup
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+class DispersyCandidateMemoryScript(ScriptBase):
+    @property
+    def enable_wait_for_wan_address(self):
+        return False
+
+    def run(self):
+        ec = ec_generate_key(u"very-low")
+        self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        self.add_testcase(self.bytes_per_candidate, (10000, 1))
+        self.add_testcase(self.bytes_per_candidate, (10000, 4))
+
+    def bytes_per_candidate(self, count, community_count):
+        """
+        Create COUNT walk candidates that are each known in COMMUNITY_COUNT communities and report
+        the number of bytes that the candidates, including their addresses and per community
+        timestamps, occupy.
+
+        Run this script on two revisions to compare the memory usage before and after a change.
+        """
+        def sizeof(obj):
+            size = sys.getsizeof(obj)
+            if hasattr(obj, "__dict__"):
+                size += sys.getsizeof(obj.__dict__)
+            return size
+
+        communities = [DebugCommunity.create_community(self._my_member) for _ in xrange(community_count)]
+
+        now = time()
+        candidates = []
+        for index in xrange(count):
+            # the address strings are created separately to mimic addresses decoded from packets
+            address = ("10.%d.%d.%d" % (index // 62500, index // 250 % 250, index % 250 + 1), 7000)
+            candidate = communities[0].create_candidate(address, False, (address[0], address[1]), (address[0], address[1]), u"unknown")
+            for community in communities:
+                candidate.stumble(community, now)
+            candidates.append(candidate)
+
+        gc.collect()
+        total = 0
+        for candidate in candidates:
+            seen = set()
+            for obj in (candidate, candidate.sock_addr, candidate.sock_addr[0], candidate.lan_address, candidate.lan_address[0], candidate.wan_address, candidate.wan_address[0], candidate._associations, candidate._timestamps, candidate._global_times):
+                if not id(obj) in seen:
+                    seen.add(id(obj))
+                    total += sizeof(obj)
+            for timestamps in candidate._timestamps.itervalues():
+                total += sizeof(timestamps)
+
+        dprint(count, " candidates in ", community_count, " communities use ", total, " bytes (", total / count, " bytes per candidate, ", total / count / community_count, " bytes per candidate per community)", force=1)
+
+        # cleanup
+        for community in communities:
+            community.create_dispersy_destroy_community(u"hard-kill")
+            self._dispersy.get_community(community.cid).unload_community()
+
+class DispersyReceivePathScript(ScriptBase):
+    @property
+    def enable_wait_for_wan_address(self):
+        return False
+
+    def run(self):
+        ec = ec_generate_key(u"very-low")
+        self._my_member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        self.add_testcase(self.receive_path, (10, 1000, 100))
+
+    def receive_path(self, node_count, length, rounds):
+        """
+        Give ROUNDS batches of LENGTH packets, received from NODE_COUNT nodes, to the receive path
+        and report the number of packets per second.  Each batch contains a mix of full-sync-text,
+        ASC-text, and last-1-test packets.
+
+        The messages are cached with a large batch window, hence only the conversion into Candidate
+        instances, the grouping by meta message, and the candidate lookup are measured.
+        """
+        class ReceivePathCommunity(DebugCommunity):
+            def _initialize_meta_messages(self):
+                super(ReceivePathCommunity, self)._initialize_meta_messages()
+
+                for name in (u"full-sync-text", u"ASC-text", u"last-1-test"):
+                    batch = BatchConfiguration(max_window=60.0, max_size=length * rounds)
+                    meta = self._meta_messages[name]
+                    meta = Message(meta.community, meta.name, meta.authentication, meta.resolution, meta.distribution, meta.destination, meta.payload, meta.check_callback, meta.handle_callback, meta.undo_callback, batch=batch)
+                    self._meta_messages[meta.name] = meta
+
+        community = ReceivePathCommunity.create_community(self._my_member)
+
+        nodes = []
+        for _ in xrange(node_count):
+            node = DebugNode()
+            node.init_socket()
+            node.set_community(community)
+            node.init_my_member()
+            nodes.append(node)
+
+        packets = []
+        for index in xrange(length):
+            node = nodes[index % node_count]
+            global_time = 10 + index
+            if index % 5 < 3:
+                message = node.create_full_sync_text_message("Dprint=False, receive path #%d" % global_time, global_time)
+            elif index % 5 == 3:
+                message = node.create_in_order_text_message("Dprint=False, receive path #%d" % global_time, global_time)
+            else:
+                message = node.create_last_1_test_message("Dprint=False, receive path #%d" % global_time, global_time)
+            packets.append((node.lan_address, node.encode_message(message)))
+        shuffle(packets)
+
+        endpoint = self._dispersy.endpoint
+        begin = time()
+        for _ in xrange(rounds):
+            self._dispersy.on_incoming_packets(endpoint._create_candidate_packets(packets), True, time())
+        end = time()
+
+        dprint(length * rounds, " packets from ", node_count, " nodes took ", "%.3f" % (end - begin), " seconds (", int(length * rounds / max(0.001, end - begin)), " packets per second)", force=1)
+
+        # cleanup, unloading the community removes the cached batches
+        community.create_dispersy_destroy_community(u"hard-kill")
+        self._dispersy.get_community(community.cid).unload_community()
+
+class DispersyEndpointThroughputScript(ScriptBase):
+    def run(self):
+        self.add_testcase(self.loopback_throughput, (StandaloneEndpoint, 100000))
+        if MMSG_AVAILABLE:
+            self.add_testcase(self.loopback_throughput, (MMsgEndpoint, 100000))
+        self.add_testcase(self.send_error, (StandaloneEndpoint,))
+        if MMSG_AVAILABLE:
+            self.add_testcase(self.send_error, (MMsgEndpoint,))
+
+    def loopback_throughput(self, endpoint_class, length):
+        """
+        Send LENGTH packets from one ENDPOINT_CLASS instance to another over the loopback interface
+        and report the achieved send and receive rates.
+
+        UDP does not guarantee delivery, hence the number of packets that were received is reported
+        but not verified.
+        """
+        class CountingEndpoint(endpoint_class):
+            received = 0
+
+            def data_came_in(self, packets):
+                self.received += len(packets)
+
+        receiver = CountingEndpoint(self._dispersy, 0, "127.0.0.1")
+        receiver.start()
+        sender = endpoint_class(self._dispersy, 0, "127.0.0.1")
+        sender.start()
+        candidate = Candidate(receiver.get_address(), False)
+        packets = ["Dprint=False, throughput packet".ljust(300) for _ in xrange(100)]
+
+        begin = time()
+        for _ in xrange(length / len(packets)):
+            sender.send([candidate], packets)
+            while sender.cur_sendqueue:
+                previous = sender.cur_sendqueue
+                sender._process_sendqueue()
+                if sender.cur_sendqueue == previous:
+                    # nothing was send, i.e. the socket would block.  the endpoint thread sends the
+                    # remainder once the socket becomes writable
+                    break
+
+        # wait until the endpoint thread has send the remainder
+        while sender.cur_sendqueue:
+            yield 0.01
+        send_end = time()
+
+        # wait until the receiver is idle
+        received = -1
+        while received < receiver.received:
+            received = receiver.received
+            yield 0.1
+        sender.stop()
+        receiver.stop()
+
+        dprint(endpoint_class.__name__, " send ", length, " packets in ", "%.2f" % (send_end - begin), " seconds (", "%.0f" % (length / max(0.001, send_end - begin)), " packets/second), received ", received, " packets", force=1)
+
+    def send_error(self, endpoint_class):
+        """
+        A packet that can not be send, other than because the socket would block, is dropped
+        instead of retried over and over again.  The packets to other destinations are still send.
+        """
+        class CountingEndpoint(endpoint_class):
+            received = 0
+
+            def data_came_in(self, packets):
+                self.received += len(packets)
+
+        statistics = self._dispersy.statistics
+        enabled = statistics.are_debug_statistics_enabled()
+        statistics.enable_debug_statistics(True)
+        errors = statistics.endpoint_send.get(u"socket-error", 0)
+
+        receiver = CountingEndpoint(self._dispersy, 0, "127.0.0.1")
+        receiver.start()
+        sender = endpoint_class(self._dispersy, 0, "127.0.0.1")
+        sender.start()
+
+        # sending to the broadcast address fails with EACCES because SO_BROADCAST is not set
+        sender.send([Candidate(("255.255.255.255", receiver.get_address()[1]), False), Candidate(receiver.get_address(), False)], ["Dprint=False, send error packet"])
+        yield 1.0
+
+        sender.stop()
+        receiver.stop()
+        assert_(sender.cur_sendqueue == 0, sender.cur_sendqueue)
+        assert_(receiver.received == 1, receiver.received)
+        assert_(statistics.endpoint_send.get(u"socket-error", 0) - errors == 1, statistics.endpoint_send)
+        statistics.enable_debug_statistics(enabled)
+
+class DispersyMemoryNetworkScript(ScriptBase):
+    @property
+    def enable_wait_for_wan_address(self):
+        return False
+
+    def run(self):
+        self.add_testcase(self.memory_network, (0.1, 0.0))
+        self.add_testcase(self.memory_network_loss)
+
+    def create_peers(self, network, count):
+        """
+        Create COUNT Dispersy instances, each with its own callback and database, connected to
+        NETWORK.  Returns a list with (callback, dispersy) tuples.
+        """
+        peers = []
+        for index in xrange(count):
+            callback = Callback()
+            callback.start(name="Peer-%d" % index)
+            dispersy = callback.call(Dispersy, (callback, self._dispersy.working_directory, u":memory:"))
+            dispersy.endpoint = MemoryEndpoint(network, dispersy)
+            peers.append((callback, dispersy))
+        return peers
+
+    def create_communities(self, peers):
+        """
+        Create a DebugCommunity at the first peer and join it at all other peers.  Returns a list with
+        one community per peer.
+        """
+        def create():
+            ec = ec_generate_key(u"low")
+            return DebugCommunity.create_community(Member(ec_to_public_bin(ec), ec_to_private_bin(ec)))
+
+        def join(public_key):
+            ec = ec_generate_key(u"low")
+            return DebugCommunity.join_community(Member(public_key), Member(ec_to_public_bin(ec), ec_to_private_bin(ec)))
+
+        communities = [peers[0][0].call(create)]
+        public_key = communities[0].master_member.public_key
+        communities.extend(callback.call(join, (public_key,)) for callback, _ in peers[1:])
+        return communities
+
+    def count_received(self, peers, communities, text):
+        def count(community):
+            meta = community.get_meta_message(u"full-sync-text")
+            return len([packet
+                        for packet,
+                        in community.dispersy.database.execute(u"SELECT packet FROM sync WHERE community = ? AND meta_message = ?",
+                                                               (community.database_id, meta.database_id))
+                        if text in str(packet)])
+        return [callback.call(count, (community,)) for (callback, _), community in zip(peers, communities)]
+
+    def memory_network(self, latency, loss):
+        """
+        Three Dispersy instances in this process exchange a message over a MemoryNetwork.  Each
+        instance must store the message in its own database.
+        """
+        network = MemoryNetwork(latency=latency, loss=loss, seed=0)
+        peers = self.create_peers(network, 3)
+        try:
+            communities = self.create_communities(peers)
+            assert_(len(set(dispersy.database for _, dispersy in peers)) == 3, "every instance must have its own database")
+            assert_(all(community.dispersy is dispersy for (_, dispersy), community in zip(peers, communities)))
+
+            # the first peer sends a message to the others
+            def send():
+                message = communities[0].create_full_sync_text("Dprint=False, memory network", forward=False)
+                candidates = [Candidate(dispersy.endpoint.sock_addr, False) for _, dispersy in peers[1:]]
+                peers[0][1].endpoint.send(candidates, [message.packet])
+            peers[0][0].call(send)
+
+            # the message is delayed until the identity of its creator is received, hence at least
+            # three times the latency
+            for _ in xrange(50):
+                yield latency
+                if self.count_received(peers, communities, "memory network") == [1, 1, 1]:
+                    break
+            assert_(self.count_received(peers, communities, "memory network") == [1, 1, 1], self.count_received(peers, communities, "memory network"))
+
+        finally:
+            for callback, dispersy in peers:
+                dispersy.endpoint.close()
+                callback.stop()
+
+    def memory_network_loss(self):
+        """
+        A link with 100% loss must not deliver any packets.
+        """
+        network = MemoryNetwork(seed=0)
+        peers = self.create_peers(network, 2)
+        try:
+            communities = self.create_communities(peers)
+            network.set_link(peers[0][1].endpoint, peers[1][1].endpoint, loss=1.0)
+
+            def send(community, destination):
+                message = community.create_full_sync_text("Dprint=False, lossy network", forward=False)
+                community.dispersy.endpoint.send([Candidate(destination.endpoint.sock_addr, False)], [message.packet])
+            peers[0][0].call(send, (communities[0], peers[1][1]))
+            yield 0.5
+
+            assert_(peers[0][1].endpoint.total_lost == 1, peers[0][1].endpoint.total_lost)
+            assert_(self.count_received(peers, communities, "lossy network") == [1, 0])
+
+        finally:
+            for callback, dispersy in peers:
+                dispersy.endpoint.close()
+                callback.stop()
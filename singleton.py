@@ -7,7 +7,7 @@ Helper class to easily and cleanly use singleton objects
 
 from gc import get_referrers
 from random import sample
-from threading import RLock
+from threading import RLock, local
 
 # update version information directly from SVN
 from .revision import update_revision_information
@@ -32,9 +32,46 @@ class Singleton(object):
     # retrieve existing singleton instance, bar is NOT set to 456
     foo = Foo.get_instance(456)
     assert foo.bar == 123
+
+    # a different instance can be bound to the current thread, get_instance and has_instance will
+    # return this instance when called from this thread
+    Foo.bind_instance(Foo(456))
+    assert Foo.get_instance().bar == 456
+    Foo.unbind_instance()
     """
 
     _singleton_lock = RLock()
+    # per thread singleton_placeholder:instance pairs, see bind_instance
+    _singleton_local = local()
+
+    @classmethod
+    def bind_instance(cls, instance, singleton_placeholder=None):
+        """
+        Binds INSTANCE to the current thread.
+
+        Calls to get_instance and has_instance made from the current thread will return INSTANCE
+        instead of the process wide singleton instance.  This allows multiple instances to run in
+        one process, each on its own thread.
+        """
+        assert isinstance(instance, cls), type(instance)
+        if singleton_placeholder is None:
+            singleton_placeholder = cls
+
+        try:
+            instances = cls._singleton_local.instances
+        except AttributeError:
+            instances = cls._singleton_local.instances = {}
+        instances[singleton_placeholder] = instance
+
+    @classmethod
+    def unbind_instance(cls, singleton_placeholder=None):
+        """
+        Removes the instance bound to the current thread, if any.
+        """
+        if singleton_placeholder is None:
+            singleton_placeholder = cls
+
+        getattr(cls._singleton_local, "instances", {}).pop(singleton_placeholder, None)
 
     @classmethod
     def has_instance(cls, singleton_placeholder=None):
@@ -44,6 +81,10 @@ class Singleton(object):
         if singleton_placeholder is None:
             singleton_placeholder = cls
 
+        instance = getattr(cls._singleton_local, "instances", {}).get(singleton_placeholder)
+        if instance is not None:
+            return instance
+
         with singleton_placeholder._singleton_lock:
             if hasattr(singleton_placeholder, "_singleton_instance"):
                 return getattr(singleton_placeholder, "_singleton_instance")
@@ -58,6 +99,10 @@ class Singleton(object):
         else:
             singleton_placeholder = cls
 
+        instance = getattr(cls._singleton_local, "instances", {}).get(singleton_placeholder)
+        if instance is not None:
+            return instance
+
         with singleton_placeholder._singleton_lock:
             if not hasattr(singleton_placeholder, "_singleton_instance"):
                 setattr(singleton_placeholder, "_singleton_instance", cls(*args, **kargs))
@@ -67,13 +112,18 @@ class Singleton(object):
     def del_instance(cls, singleton_placeholder=None):
         """
         Removes the existing singleton instance
+
+        The instance is also unbound from the current thread, see bind_instance.
         """
         if singleton_placeholder is None:
             singleton_placeholder = cls
 
         with singleton_placeholder._singleton_lock:
             if hasattr(singleton_placeholder, "_singleton_instance"):
+                instance = getattr(singleton_placeholder, "_singleton_instance")
                 delattr(singleton_placeholder, "_singleton_instance")
+                if getattr(cls._singleton_local, "instances", {}).get(singleton_placeholder) is instance:
+                    cls.unbind_instance(singleton_placeholder)
 
     @classmethod
     def referenced_instance(cls, singleton_placeholder=None):
@@ -237,6 +287,21 @@ if __name__ == "__main__":
     Foo.del_instance()
     assert_(not Foo.referenced_instance())
 
+    foo = Foo.get_instance("foo")
+    Foo.bind_instance(Foo("bar"))
+    assert_(Foo.get_instance().message == "bar")
+    assert_(Foo.has_instance().message == "bar")
+    Foo.unbind_instance()
+    assert_(Foo.get_instance() is foo)
+    Foo.del_instance()
+    del foo
+
+    foo = Foo.get_instance("foo")
+    Foo.bind_instance(foo)
+    Foo.del_instance()
+    assert_(Foo.has_instance() is None)
+    del foo
+
     #
     #
     #
@@ -44,17 +44,37 @@ class DispersyStatistics(Statistics):
         self.delay_timeout = 0
         # nr delay messages being send
         self.delay_send = 0
+        # nr delayed packets and bytes currently held, and nr delayed packets evicted to stay
+        # within the byte budget
+        self.delay_held = 0
+        self.delay_bytes = 0
+        self.delay_evictions = 0
         
         # nr sync messages created by this peer send using _send method
         self.created_count = 0
+
+        # nr of messages encoded and nr of signatures made, and these values per second since start
+        self.encode_count = 0
+        self.sign_count = 0
+        self.encode_rate = 0.0
+        self.sign_rate = 0.0
         
         # nr of bytes up/down and packets send as reported by endpoint 
         self.total_down = 0
         self.total_up = 0
         self.total_send = 0
+
+        # nr of packets rejected by the endpoint before reaching the Dispersy thread
+        self.total_rejected = 0
         
         # size of the sendqueue
         self.cur_sendqueue = 0
+
+        # queued packets and send packets and bytes for each sendqueue priority
+        self.sendqueues = None
+
+        # number of outstanding requests for each Cache class
+        self.request_cache = None
         
         # nr of candidates introduced/stumbled upon
         self.total_candidates_discovered = 0
@@ -108,6 +128,8 @@ class DispersyStatistics(Statistics):
 
     def update(self, database=False):
         self.timestamp = time()
+        self.encode_rate = self.encode_count / max(1.0, self.timestamp - self.start)
+        self.sign_rate = self.sign_count / max(1.0, self.timestamp - self.start)
         self.connection_type = self._dispersy.connection_type
         self.lan_address = self._dispersy.lan_address
         self.wan_address = self._dispersy.wan_address
@@ -115,7 +137,13 @@ class DispersyStatistics(Statistics):
         self.total_down = self._dispersy.endpoint.total_down
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
+        self.total_rejected = self._dispersy.endpoint.total_rejected
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+        self.sendqueues = dict((name, dict(statistics)) for name, statistics in self._dispersy.endpoint.sendqueue_statistics.iteritems())
+        self.request_cache = self._dispersy.request_cache.statistics
+        self.delay_held = self._dispersy.delayed_packets.count
+        self.delay_bytes = self._dispersy.delayed_packets.bytes
+        self.delay_evictions = self._dispersy.delayed_packets.evictions
         
         self.communities = [community.statistics for community in self._dispersy.get_communities()]
         for community in self.communities:
@@ -128,14 +156,22 @@ class DispersyStatistics(Statistics):
         self.delay_send = 0
         self.delay_success = 0
         self.delay_timeout = 0
+        self._dispersy.delayed_packets.reset_statistics()
+        self.delay_evictions = 0
         self.received_count = 0
         self.created_count = 0
+        self.encode_count = 0
+        self.sign_count = 0
+        self.encode_rate = 0.0
+        self.sign_rate = 0.0
 
         self._dispersy.endpoint.reset_statistics()
         self.total_down = self._dispersy.endpoint.total_down
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
+        self.total_rejected = self._dispersy.endpoint.total_rejected
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+        self.sendqueues = dict((name, dict(statistics)) for name, statistics in self._dispersy.endpoint.sendqueue_statistics.iteritems())
         self.start = self.timestamp = time()
 
         self.walk_attempt = 0
@@ -177,6 +213,19 @@ class CommunityStatistics(Statistics):
         self.mid = community.my_member.mid
         self.sync_bloom_new = 0
         self.sync_bloom_reuse = 0
+
+        # nr of received messages with a SyncDistribution policy that were stored and nr of candidates
+        # that contacted us while not in the community, these determine the walker weight
+        self.messages_stored = 0
+        self.candidates_joined = 0
+
+        # walker weight, nr of steps taken, and the achieved nr of steps per second
+        self.walk_weight = 1.0
+        self.walk_steps = 0
+        self.walk_rate = 0.0
+
+        # meta message name:(window, size) pairs for all batched meta messages
+        self.batches = None
         self.update()
 
     def update(self, database=False):
@@ -188,6 +237,7 @@ class CommunityStatistics(Statistics):
         self.candidates = [(candidate.lan_address, candidate.wan_address, candidate.get_global_time(self._community))
                            for candidate
                            in self._community._iter_categories([u'walk', u'stumble', u'intro'], once = True) if candidate]
+        self.batches = dict((meta.name, (meta.batch.window, meta.batch.size)) for meta in self._community.get_meta_messages() if meta.batch.enabled)
         if database:
             self.database = dict(self._community.dispersy.database.execute(u"SELECT meta_message.name, COUNT(sync.id) FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? GROUP BY sync.meta_message", (self._community.database_id,)))
         else:
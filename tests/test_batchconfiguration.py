@@ -0,0 +1,49 @@
+import unittest
+from random import Random
+
+from ..message import BatchConfiguration
+
+class TestBatchConfiguration(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = BatchConfiguration(max_window=2.0, min_window=0.1, max_age=30.0, adaptive=True)
+
+    def feed(self, now, count, size, interval, duration):
+        """
+        Process COUNT batches of SIZE messages, one every INTERVAL seconds, each taking DURATION
+        seconds.  Returns the time of the last batch.
+        """
+        for _ in xrange(count):
+            now += interval
+            self.batch.batch_processed(size, duration, now)
+            self.assertTrue(self.batch.min_window <= self.batch.window <= self.batch.max_window, self.batch.window)
+            self.assertEqual(self.batch.size, size)
+        return now
+
+    def test_high_rate(self):
+        # 200 messages per second, most of the thread is busy processing them
+        self.feed(0.0, 50, 400, 2.0, 1.5)
+        self.assertAlmostEqual(self.batch.window, self.batch.max_window)
+
+    def test_low_rate(self):
+        now = self.feed(0.0, 50, 400, 2.0, 1.5)
+
+        # single messages every ten seconds, the window falls back to min_window
+        self.feed(now, 50, 1, 10.0, 0.001)
+        self.assertEqual(self.batch.window, self.batch.min_window)
+
+    def test_cheap_messages(self):
+        # many messages that are cheap to process only need a small window
+        self.feed(0.0, 50, 400, 2.0, 0.01)
+        self.assertTrue(self.batch.window < 0.5 * self.batch.max_window, self.batch.window)
+
+    def test_random_sequence(self):
+        rng = Random(0)
+        now = 0.0
+        for _ in xrange(100):
+            now = self.feed(now, rng.randint(1, 10), rng.randint(1, 1000), rng.uniform(0.01, 60.0), rng.uniform(0.0001, 2.0))
+
+    def test_not_adaptive(self):
+        self.batch = BatchConfiguration(max_window=2.0, min_window=0.1, max_age=30.0)
+        self.feed(0.0, 10, 1, 10.0, 0.001)
+        self.assertEqual(self.batch.window, self.batch.max_window)
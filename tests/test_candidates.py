@@ -1,4 +1,5 @@
 import unittest
+from itertools import islice
 from time import time
 
 from ..dispersy import Dispersy
@@ -67,6 +68,68 @@ class TestCandidates(unittest.TestCase):
         
         self.assertEquals(expected, got)
     
+    def test_yield_random_candidates_category_change(self):
+        c = DebugCommunity.create_community(self.mm)
+        now = time()
+        candidates = []
+        for i in range(3):
+            address = ("127.0.0.1", i+1)
+            candidate = c.create_candidate(address, False, address, address, u"unknown")
+            candidate.stumble(c, now)
+            candidates.append(candidate)
+
+        # an inactive candidate must no longer be yielded
+        candidates[1].inactive(c, now)
+        got = set(candidate.lan_address for candidate in islice(c.dispersy_yield_random_candidates(), 4) if candidate)
+        self.assertEquals(set([("127.0.0.1", 1), ("127.0.0.1", 3)]), got)
+
+        # once it stumbles again it must be yielded again
+        candidates[1].stumble(c, now)
+        got = set(candidate.lan_address for candidate in islice(c.dispersy_yield_random_candidates(), 6) if candidate)
+        self.assertEquals(set([("127.0.0.1", 1), ("127.0.0.1", 2), ("127.0.0.1", 3)]), got)
+
+    def test_associated_candidates(self):
+        c = DebugCommunity.create_community(self.mm)
+        ec = ec_generate_key(u"low")
+        member = Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+        address = ("127.0.0.1", 1)
+        candidate = c.create_candidate(address, False, address, address, u"unknown")
+        candidate.associate(c, member)
+        self.assertEquals([candidate], list(c._candidates.get_associated_candidates(member)))
+
+        # removed candidates are no longer associated
+        del self.d._candidates[address]
+        self.assertEquals([], list(c._candidates.get_associated_candidates(member)))
+
+        # but will be once they are added again
+        c.add_candidate(candidate)
+        self.assertEquals([candidate], list(c._candidates.get_associated_candidates(member)))
+
+        candidate.disassociate(c, member)
+        self.assertEquals([], list(c._candidates.get_associated_candidates(member)))
+
+    def test_expire_candidates(self):
+        c = DebugCommunity.create_community(self.mm)
+        now = time()
+
+        stumbled = c.create_candidate(("127.0.0.1", 1), False, ("127.0.0.1", 1), ("127.0.0.1", 1), u"unknown")
+        stumbled.stumble(c, now)
+        introduced = c.create_candidate(("127.0.0.1", 2), False, ("127.0.0.1", 2), ("127.0.0.1", 2), u"unknown")
+        introduced.intro(c, now)
+        self.assertEquals([stumbled], list(c.dispersy_yield_candidates()))
+
+        # the introduced candidate is inactive and the stumbled candidate became an intro candidate
+        stumbled.intro(c, now + 40.0)
+        self.assertEquals([], c._candidates.expire(now + 60.0))
+        self.assertEquals(u"intro", c._candidates._candidate_categories.get(stumbled))
+        self.assertEquals(None, c._candidates._candidate_categories.get(introduced))
+        self.assertEquals(2, len(c._candidates))
+
+        # both candidates are obsolete
+        self.assertEquals(set([stumbled, introduced]), set(c._candidates.expire(now + 300.0)))
+        self.assertEquals(0, len(c._candidates))
+
     def test_merge_candidates(self):
         c = DebugCommunity.create_community(self.mm)
         
@@ -0,0 +1,82 @@
+import unittest
+
+from ..candidate import Candidate
+from ..delayedpacketstore import DelayedPacketStore
+
+class TestDelayedPacketStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = DelayedPacketStore(max_bytes=1000, max_candidate_bytes=400)
+        self.a = Candidate(("127.0.0.1", 1), False)
+        self.b = Candidate(("127.0.0.1", 2), False)
+        self.c = Candidate(("127.0.0.1", 3), False)
+
+    def assertStore(self, count, bytes_, evictions):
+        self.assertEqual((self.store.count, self.store.bytes, self.store.evictions), (count, bytes_, evictions))
+
+    def test_pop(self):
+        self.assertTrue(self.store.add(1, self.a, "a" * 100))
+        self.assertTrue(self.store.add(1, self.b, "b" * 100))
+        self.assertTrue(self.store.add(2, self.a, "c" * 100))
+        self.assertStore(3, 300, 0)
+
+        # packets are returned in the order that they were added, with their candidates
+        self.assertEqual(self.store.pop(1), [(self.a, "a" * 100), (self.b, "b" * 100)])
+        self.assertStore(1, 100, 0)
+        self.assertEqual(self.store.pop(1), [])
+        self.assertEqual(self.store.pop(2), [(self.a, "c" * 100)])
+        self.assertStore(0, 0, 0)
+
+        # the per candidate accounting is back to zero as well
+        self.assertTrue(self.store.add(3, self.a, "d" * 400))
+        self.assertStore(1, 400, 0)
+
+    def test_candidate_eviction(self):
+        for index in xrange(4):
+            self.assertTrue(self.store.add(index, self.a, str(index) * 100))
+        self.assertTrue(self.store.add(4, self.b, "b" * 100))
+        self.assertStore(5, 500, 0)
+
+        # the oldest packet from the same candidate makes room, packets from other candidates stay
+        self.assertTrue(self.store.add(5, self.a, "5" * 150))
+        self.assertStore(4, 450, 2)
+        self.assertEqual(self.store.pop(0), [])
+        self.assertEqual(self.store.pop(1), [])
+        self.assertEqual(self.store.pop(4), [(self.b, "b" * 100)])
+        self.assertEqual(self.store.pop(5), [(self.a, "5" * 150)])
+        self.assertStore(2, 200, 2)
+
+    def test_global_eviction(self):
+        self.assertTrue(self.store.add(1, self.a, "a" * 400))
+        self.assertTrue(self.store.add(2, self.b, "b" * 400))
+        self.assertTrue(self.store.add(3, self.c, "c" * 100))
+
+        # the least recently used packet is evicted, regardless of its candidate
+        self.assertTrue(self.store.add(4, self.c, "d" * 200))
+        self.assertStore(3, 700, 1)
+        self.assertEqual(self.store.pop(1), [])
+        self.assertEqual([packet for _, packet in self.store.pop(2)], ["b" * 400])
+
+    def test_oversize(self):
+        self.assertTrue(self.store.add(1, self.a, "a" * 100))
+
+        # a packet larger than the per candidate budget is not stored and evicts nothing
+        self.assertFalse(self.store.add(2, self.a, "b" * 401))
+        self.assertStore(1, 100, 1)
+        self.assertEqual(self.store.pop(2), [])
+
+        self.store.reset_statistics()
+        self.assertStore(1, 100, 0)
+
+    def test_add_existing(self):
+        self.assertTrue(self.store.add(1, self.a, "a" * 400))
+        self.assertTrue(self.store.add(2, self.b, "b" * 400))
+
+        # adding the same packet again does not store it twice but makes it the most recently used
+        self.assertTrue(self.store.add(1, self.a, "a" * 400))
+        self.assertStore(2, 800, 0)
+
+        self.assertTrue(self.store.add(3, self.c, "c" * 300))
+        self.assertStore(2, 700, 1)
+        self.assertEqual(self.store.pop(2), [])
+        self.assertEqual(self.store.pop(1), [(self.a, "a" * 400)])
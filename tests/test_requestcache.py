@@ -0,0 +1,104 @@
+import unittest
+from time import sleep
+
+from ..callback import Callback
+from ..requestcache import Cache, RequestCache
+
+class RecordingCache(Cache):
+    timeout_delay = 0.1
+    cleanup_delay = 0.0
+
+    def __init__(self, events, retries=0, exception=False):
+        self.events = events
+        self.retries = retries
+        self.exception = exception
+
+    def on_timeout(self):
+        self.events.append(("timeout", self.identifier))
+        if self.exception:
+            raise RuntimeError("on_timeout failed")
+        if self.retries:
+            self.retries -= 1
+            return True
+
+    def on_cleanup(self):
+        self.events.append(("cleanup", self.identifier))
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.callback = Callback()
+        self.callback.start(name="RequestCache-Test")
+        self.request_cache = self.callback.call(RequestCache, (self.callback,))
+
+    def tearDown(self):
+        self.callback.stop()
+
+    def call(self, func, *args):
+        return self.callback.call(func, args)
+
+    def test_claim_wrap_around(self):
+        events = []
+        self.request_cache._next_identifier = 2**16 - 2
+        self.call(self.request_cache.set, 0, RecordingCache(events))
+
+        # claimed identifiers wrap around at 2**16 and skip identifiers that are in use
+        claimed = [self.call(self.request_cache.claim, RecordingCache(events)) for _ in xrange(4)]
+        self.assertEqual(claimed, [2**16 - 2, 2**16 - 1, 1, 2])
+
+        # released identifiers are claimed again once the sequence comes round
+        self.call(self.request_cache.pop, 1, RecordingCache)
+        self.request_cache._next_identifier = 1
+        self.assertEqual(self.call(self.request_cache.claim, RecordingCache(events)), 1)
+
+    def test_replaced_entries(self):
+        events = []
+        cache = RecordingCache(events)
+        cache.cleanup_delay = 0.2
+        self.call(self.request_cache.set, 1, cache)
+
+        # the response arrives before the timeout, replacing the timeout with a cleanup
+        self.assertIs(self.call(self.request_cache.pop, 1, RecordingCache), cache)
+        sleep(0.4)
+        self.assertEqual(events, [("cleanup", 1)])
+        self.assertFalse(self.call(self.request_cache.has, 1, RecordingCache))
+
+        # a retried request gets a new timeout, the previous entry does not expire it again
+        cache = RecordingCache(events, retries=1)
+        del events[:]
+        self.call(self.request_cache.set, 2, cache)
+        sleep(0.35)
+        self.assertEqual(events, [("timeout", 2), ("timeout", 2)])
+        self.assertEqual(self.request_cache.statistics, {})
+
+    def test_bulk_expiry(self):
+        events = []
+        identifiers = range(100, 300)
+        def set_all():
+            for identifier in identifiers:
+                self.request_cache.set(identifier, RecordingCache(events))
+        self.call(set_all)
+
+        # all entries share one queue and expire in the order that they were added
+        self.assertEqual(len(self.request_cache._queues), 1)
+        self.assertEqual(self.request_cache.statistics, {"RecordingCache": len(identifiers)})
+        sleep(0.3)
+        self.assertEqual(events, [("timeout", identifier) for identifier in identifiers])
+        self.assertEqual(self.request_cache.statistics, {})
+        self.assertEqual(self.request_cache._queues, {})
+
+    def test_exception_in_timeout(self):
+        events = []
+        self.call(self.request_cache.set, 1, RecordingCache(events, exception=True))
+        self.call(self.request_cache.set, 2, RecordingCache(events))
+        sleep(0.3)
+
+        # the failing entry is released and does not prevent the next entry from expiring
+        self.assertEqual(events, [("timeout", 1), ("timeout", 2)])
+        self.assertEqual(self.request_cache.statistics, {})
+        self.assertEqual(self.request_cache._queues, {})
+
+        # the queue is created again for new entries
+        self.call(self.request_cache.set, 1, RecordingCache(events))
+        sleep(0.3)
+        self.assertEqual(events[-1], ("timeout", 1))
@@ -3,9 +3,12 @@ The Timeline is an important part of Dispersy.  The Timeline can be
 queried as to who had what actions at some point in time.
 """
 
+from bisect import bisect_left, bisect_right
 from itertools import count, groupby
 
 from .authentication import MemberAuthentication, DoubleMemberAuthentication
+from .encoding import encode, decode
+from .member import Member
 from .resolution import PublicResolution, LinearResolution, DynamicResolution
 from .revision import update_revision_information
 
@@ -15,6 +18,9 @@ if __debug__:
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
 
+# the version of the binary string returned by Timeline.get_snapshot
+TIMELINE_SNAPSHOT_VERSION = 1
+
 class Timeline(object):
     def __init__(self, community):
         if __debug__:
@@ -28,6 +34,12 @@ class Timeline(object):
         # Member / [(global_time, {u"permission^message-name":(True/False, [Message.Implementation])})]
         self._members = {}
 
+        # _permissions contains the same grants and revokes, sorted by global time, per member and
+        # permission.  this allows _check to find the permission at a certain global time using
+        # bisect
+        # (Member, u"permission^message-name") / ([global_time], [(True/False, [Message.Implementation])])
+        self._permissions = {}
+
         # _policies contains the policies that the community is currently using (dynamic settings)
         # [(global_time, {u"resolution^message-name":(resolution-policy, [Message.Implementation])})]
         self._policies = []
@@ -37,6 +49,7 @@ class Timeline(object):
             for global_time, dic in self._policies:
                 dprint("policy @", global_time)
                 for key, (policy, proofs) in dic.iteritems():
+                    self._load_proofs(proofs)
                     dprint("policy ", "%50s" % key, "  ", policy, " based on ", len(proofs), " proofs")
 
             for member, lst in self._members.iteritems():
@@ -44,6 +57,7 @@ class Timeline(object):
                 for global_time, dic in lst:
                     dprint("member ", member.database_id, " @", global_time)
                     for key, (allowed, proofs) in sorted(dic.iteritems()):
+                        self._load_proofs(proofs)
                         if allowed:
                             assert all(proof.name == u"dispersy-authorize" for proof in proofs)
                             dprint("member ", member.database_id, " ", "%50s" % key, "  granted by ", ", ".join("%d@%d" % (proof.authentication.member.database_id, proof.distribution.global_time) for proof in proofs))
@@ -118,6 +132,58 @@ class Timeline(object):
                     return (False, [proof for proof in all_proofs])
             return (True, [proof for proof in all_proofs])
 
+    def check_batch(self, messages, permission=u"permit"):
+        """
+        Check if messages, that all use the same meta message, are allowed.
+
+        Returns a list containing an (allowed, proofs) tuple for each message in MESSAGES, see
+        check.
+
+        The outcome of check only changes at the global times where a permission or resolution
+        policy changes.  Messages created by the same members between two such changes share one
+        lookup.
+        """
+        if __debug__:
+            from .message import Message
+        assert isinstance(messages, list)
+        assert len(messages) > 0
+        assert all(isinstance(message, Message.Implementation) for message in messages)
+        assert all(message.meta == messages[0].meta for message in messages)
+        meta = messages[0].meta
+
+        if meta.name in (u"dispersy-authorize", u"dispersy-revoke", u"dispersy-undo-other"):
+            # the outcome depends on the payload
+            return [self.check(message, permission) for message in messages]
+
+        key = permission + "^" + meta.name
+        if isinstance(meta.resolution, DynamicResolution):
+            policy_key = u"resolution^" + meta.name
+            policy_times = [policy_time for policy_time, policies in self._policies if policy_key in policies]
+        else:
+            policy_times = []
+
+        results = []
+        cache = {}
+        for message in messages:
+            members = tuple(message.authentication.members) if isinstance(message.authentication, DoubleMemberAuthentication.Implementation) else (message.authentication.member,)
+            global_time = message.distribution.global_time
+
+            # get_resolution_policy uses the policies set before global_time, _check uses the
+            # permissions set at or before global_time
+            bucket = (members,
+                      tuple(bisect_right(self._permissions.get((member, key), ((), ()))[0], global_time) for member in members),
+                      bisect_left(policy_times, global_time),
+                      message.resolution.policy.meta if isinstance(message.resolution, DynamicResolution.Implementation) else None)
+
+            if bucket in cache:
+                allowed, proofs = cache[bucket]
+            else:
+                allowed, proofs = cache[bucket] = self.check(message, permission)
+            results.append((allowed, list(proofs)))
+
+        if __debug__: dprint(len(messages), " ", meta.name, " messages checked using ", len(cache), " lookups")
+        return results
+
     def allowed(self, meta, global_time=0, permission=u"permit"):
         """
         Check if we are allowed to create a message.
@@ -154,87 +220,66 @@ class Timeline(object):
                 assert pair[1] in (u"permit", u"authorize", u"revoke", u"undo")
             assert isinstance(resolution, (PublicResolution.Implementation, LinearResolution.Implementation, DynamicResolution.Implementation, PublicResolution, LinearResolution, DynamicResolution)), resolution
 
-        # TODO: we can make this more efficient by changing the loop a bit.  make a shallow copy of
-        # the permission_pairs and remove one after another as they succeed.  key is to loop though
-        # the self._members[member] once (currently looping over the timeline for every item in
-        # permission_pairs).
+        # the master member can do anything
+        if member == self._community.master_member:
+            if __debug__: dprint("ACCEPT time:", global_time, " user:", member.database_id, " -> ", len(permission_pairs), " permission pairs (master member)")
+            return (True, [])
 
         all_proofs = []
 
         for message, permission in permission_pairs:
-            # the master member can do anything
-            if member == self._community.master_member:
-                if __debug__: dprint("ACCEPT time:", global_time, " user:", member.database_id, " -> ", permission, "^", message.name, " (master member)")
-
-            else:
-                # dynamically set the resolution policy
-                if isinstance(resolution, DynamicResolution):
-                    resolution, proofs = self.get_resolution_policy(message, global_time)
-                    assert isinstance(resolution, (PublicResolution, LinearResolution))
-                    all_proofs.extend(proofs)
-
-                elif isinstance(resolution, DynamicResolution.Implementation):
-                    local_resolution, proofs = self.get_resolution_policy(message, global_time)
-                    assert isinstance(local_resolution, (PublicResolution, LinearResolution))
-                    all_proofs.extend(proofs)
-
-                    if not resolution.policy.meta == local_resolution:
-                        if __debug__: dprint("FAIL time:", global_time, " user:", member.database_id, " (conflicting resolution policy, ", resolution.policy.meta, ", ", local_resolution, ")")
-                        return (False, all_proofs)
-
-                    resolution = resolution.policy
-                    if __debug__: dprint("APPLY time:", global_time, " resolution^", message.name, " -> ", resolution.__class__.__name__)
-
-                # everyone is allowed PublicResolution
-                if isinstance(resolution, (PublicResolution, PublicResolution.Implementation)):
-                    if __debug__: dprint("ACCEPT time:", global_time, " user:", member.database_id, " -> ", permission, "^", message.name, " (public resolution)")
-
-                # allowed LinearResolution is stored in Timeline
-                elif isinstance(resolution, (LinearResolution, LinearResolution.Implementation)):
-                    key = permission + "^" + message.name
-
-                    if member in self._members:
-                        iterator = reversed(self._members[member])
-                        try:
-                            # go backwards while time > global_time
-                            while True:
-                                time, permissions = iterator.next()
-                                if time <= global_time:
-                                    break
-
-                            # check permissions and continue backwards in time
-                            while True:
-                                if key in permissions:
-                                    assert isinstance(permissions[key], tuple)
-                                    assert len(permissions[key]) == 2
-                                    assert isinstance(permissions[key][0], bool)
-                                    assert isinstance(permissions[key][1], list)
-                                    assert len(permissions[key][1]) > 0
-                                    assert not filter(lambda x: not isinstance(x, Message.Implementation), permissions[key][1])
-                                    allowed, proofs = permissions[key]
-
-                                    if allowed:
-                                        if __debug__: dprint("ACCEPT time:", global_time, " user:", member.database_id, " -> ", key, " (authorized)")
-                                        all_proofs.extend(proofs)
-                                        break
-                                    else:
-                                        if __debug__: dprint("DENIED time:", global_time, " user:", member.database_id, " -> ", key, " (revoked)", level="warning")
-                                        return (False, [proofs])
-
-                                time, permissions = iterator.next()
-
-                        except StopIteration:
-                            if __debug__: dprint("FAIL time:", global_time, " user:", member.database_id, " -> ", key, " (not authorized)", level="warning")
-                            return (False, [])
-                    else:
-                        if __debug__: dprint("FAIL time:", global_time, " user:", member.database_id, " -> ", key, " (no authorization)", level="warning")
-                        return (False, [])
-
-                    # accept with proof
-                    assert len(all_proofs) > 0
+            # dynamically set the resolution policy
+            if isinstance(resolution, DynamicResolution):
+                resolution, proofs = self.get_resolution_policy(message, global_time)
+                assert isinstance(resolution, (PublicResolution, LinearResolution))
+                all_proofs.extend(proofs)
+
+            elif isinstance(resolution, DynamicResolution.Implementation):
+                local_resolution, proofs = self.get_resolution_policy(message, global_time)
+                assert isinstance(local_resolution, (PublicResolution, LinearResolution))
+                all_proofs.extend(proofs)
+
+                if not resolution.policy.meta == local_resolution:
+                    if __debug__: dprint("FAIL time:", global_time, " user:", member.database_id, " (conflicting resolution policy, ", resolution.policy.meta, ", ", local_resolution, ")")
+                    return (False, all_proofs)
+
+                resolution = resolution.policy
+                if __debug__: dprint("APPLY time:", global_time, " resolution^", message.name, " -> ", resolution.__class__.__name__)
+
+            # everyone is allowed PublicResolution
+            if isinstance(resolution, (PublicResolution, PublicResolution.Implementation)):
+                if __debug__: dprint("ACCEPT time:", global_time, " user:", member.database_id, " -> ", permission, "^", message.name, " (public resolution)")
+
+            # allowed LinearResolution is stored in Timeline
+            elif isinstance(resolution, (LinearResolution, LinearResolution.Implementation)):
+                key = permission + "^" + message.name
 
+                # the last grant or revoke at or before global_time decides
+                times, values = self._permissions.get((member, key), ((), ()))
+                index = bisect_right(times, global_time)
+                if index == 0:
+                    if __debug__: dprint("FAIL time:", global_time, " user:", member.database_id, " -> ", key, " (not authorized)", level="warning")
+                    return (False, [])
+
+                assert isinstance(values[index - 1], tuple)
+                assert len(values[index - 1]) == 2
+                assert isinstance(values[index - 1][0], bool)
+                assert isinstance(values[index - 1][1], list)
+                assert len(values[index - 1][1]) > 0
+                allowed, proofs = values[index - 1]
+
+                if allowed:
+                    if __debug__: dprint("ACCEPT time:", global_time, " user:", member.database_id, " -> ", key, " (authorized)")
+                    all_proofs.extend(self._load_proofs(proofs))
                 else:
-                    raise NotImplementedError("Unknown Resolution")
+                    if __debug__: dprint("DENIED time:", global_time, " user:", member.database_id, " -> ", key, " (revoked)", level="warning")
+                    return (False, self._load_proofs(proofs))
+
+                # accept with proof
+                assert len(all_proofs) > 0
+
+            else:
+                raise NotImplementedError("Unknown Resolution")
 
         return (True, all_proofs)
 
@@ -299,6 +344,7 @@ class Timeline(object):
                             # no earlier proof on this global time
                             if __debug__: dprint("AUTHORIZE time:", global_time, " user:", member.database_id, " -> ", key, " (extending)")
                             permissions[key] = (True, [proof])
+                            self._index_permission(member, key, global_time, permissions[key])
                         break
 
                     # insert when time > global_time
@@ -306,6 +352,7 @@ class Timeline(object):
                         # TODO: ensure that INDEX is correct!
                         if __debug__: dprint("AUTHORIZE time:", global_time, " user:", member.database_id, " -> ", key, " (inserting)")
                         self._members[member].insert(index, (global_time, {key:(True, [proof])}))
+                        self._index_permission(member, key, global_time, self._members[member][index][1][key])
                         break
 
                     # otherwise: go forward while time < global_time
@@ -314,6 +361,7 @@ class Timeline(object):
                     # we have reached the end without a BREAK: append the permission
                     if __debug__: dprint("AUTHORIZE time:", global_time, " user:", member.database_id, " -> ", key, " (appending)")
                     self._members[member].append((global_time, {key:(True, [proof])}))
+                    self._index_permission(member, key, global_time, self._members[member][-1][1][key])
 
             else:
                 raise NotImplementedError(message.resolution)
@@ -375,6 +423,7 @@ class Timeline(object):
                             # no earlier proof on this global time
                             if __debug__: dprint("REVOKE time:", global_time, " user:", member.database_id, " -> ", key, " (extending)")
                             permissions[key] = (False, [proof])
+                            self._index_permission(member, key, global_time, permissions[key])
                         break
 
                     # insert when time > global_time
@@ -382,6 +431,7 @@ class Timeline(object):
                         # TODO: ensure that INDEX is correct!
                         if __debug__: dprint("REVOKE time:", global_time, " user:", member.database_id, " -> ", key, " (inserting)")
                         self._members[member].insert(index, (global_time, {key:(False, [proof])}))
+                        self._index_permission(member, key, global_time, self._members[member][index][1][key])
                         break
 
                     # otherwise: go forward while time < global_time
@@ -390,12 +440,26 @@ class Timeline(object):
                     # we have reached the end without a BREAK: append the permission
                     if __debug__: dprint("REVOKE time:", global_time, " user:", member.database_id, " -> ", key, " (appending)")
                     self._members[member].append((global_time, {key:(False, [proof])}))
+                    self._index_permission(member, key, global_time, self._members[member][-1][1][key])
 
             else:
                 raise NotImplementedError(message.resolution)
 
         return (True, revoke_proofs)
 
+    def _index_permission(self, member, key, global_time, value):
+        """
+        Store VALUE, an (allowed, proofs) tuple, for MEMBER and KEY at GLOBAL_TIME in the
+        _permissions index.
+        """
+        times, values = self._permissions.setdefault((member, key), ([], []))
+        index = bisect_left(times, global_time)
+        if index < len(times) and times[index] == global_time:
+            values[index] = value
+        else:
+            times.insert(index, global_time)
+            values.insert(index, value)
+
     def get_resolution_policy(self, message, global_time):
         """
         Returns the resolution policy and associated proof that is used for MESSAGE at time
@@ -410,7 +474,8 @@ class Timeline(object):
         for policy_time, policies in reversed(self._policies):
             if policy_time < global_time and key in policies:
                 if __debug__: dprint("using ", policies[key][0].__class__.__name__, " for time ", global_time, " (configured at ", policy_time, ")")
-                return policies[key]
+                policy, proofs = policies[key]
+                return policy, self._load_proofs(proofs)
 
         if __debug__: dprint("using ", message.resolution.default.__class__.__name__, " for time ", global_time, " (default)")
         return message.resolution.default, []
@@ -436,3 +501,114 @@ class Timeline(object):
         # TODO it is possible that different members set different policies at the same time
         policies[u"resolution^" + message.name] = (policy, [proof])
         if __debug__: dprint(self._policies, lines=1)
+
+    def get_snapshot(self):
+        """
+        Returns the permissions and policies in this timeline as a binary string that can be given
+        to load_snapshot.
+
+        Proofs are stored by their sync table identifier.  Returns None when one or more proofs are
+        not stored in the database.
+        """
+        def packet_ids(proofs):
+            return tuple(proof if isinstance(proof, (int, long)) else proof.packet_id for proof in proofs)
+
+        members = tuple((member.public_key,
+                         tuple((global_time, dict((key, (allowed, packet_ids(proofs))) for key, (allowed, proofs) in permissions.iteritems()))
+                               for global_time, permissions
+                               in lst))
+                        for member, lst
+                        in self._members.iteritems())
+
+        policies = []
+        for global_time, dic in self._policies:
+            items = {}
+            for key, (policy, proofs) in dic.iteritems():
+                meta = self._community.get_meta_message(key.split(u"^", 1)[1])
+                items[key] = (meta.resolution.policies.index(policy), packet_ids(proofs))
+            policies.append((global_time, items))
+
+        # all proofs must be in the database
+        all_ids = set(packet_id for _, lst in members for _, dic in lst for _, ids in dic.itervalues() for packet_id in ids)
+        all_ids.update(packet_id for _, dic in policies for _, ids in dic.itervalues() for packet_id in ids)
+        all_ids = list(all_ids)
+        execute = self._community.dispersy.database.execute
+        count = 0
+        for index in xrange(0, len(all_ids), 500):
+            chunk = all_ids[index:index + 500]
+            count += execute(u"SELECT COUNT(*) FROM sync WHERE id IN (" + ", ".join("?" for _ in chunk) + ")", chunk).next()[0]
+        if count < len(all_ids):
+            if __debug__: dprint("unable to create snapshot, ", len(all_ids) - count, " proofs are not stored", level="warning")
+            return None
+
+        return encode((TIMELINE_SNAPSHOT_VERSION, members, tuple(policies)))
+
+    def load_snapshot(self, snapshot):
+        """
+        Replaces the permissions and policies in this timeline with those in SNAPSHOT, a binary
+        string returned by get_snapshot.
+
+        The proofs are only loaded from the database when they are needed.  Returns False, leaving
+        the timeline unchanged, when SNAPSHOT can not be used.
+        """
+        assert isinstance(snapshot, str)
+        try:
+            _, (version, members, policies) = decode(snapshot)
+            if version != TIMELINE_SNAPSHOT_VERSION:
+                if __debug__: dprint("unknown snapshot version ", version, level="warning")
+                return False
+
+            names = set(meta.name for meta in self._community.get_meta_messages())
+            if not all(key.split(u"^", 1)[1] in names for _, lst in members for _, permissions in lst for key in permissions):
+                if __debug__: dprint("snapshot refers to unknown meta messages", level="warning")
+                return False
+
+            timeline_members = {}
+            for public_key, lst in members:
+                timeline_members[Member(public_key)] = [(global_time, dict((key, (allowed, list(ids))) for key, (allowed, ids) in permissions.iteritems()))
+                                                        for global_time, permissions
+                                                        in lst]
+
+            timeline_policies = []
+            for global_time, dic in policies:
+                items = {}
+                for key, (index, ids) in dic.iteritems():
+                    meta = self._community.get_meta_message(key.split(u"^", 1)[1])
+                    items[key] = (meta.resolution.policies[index], list(ids))
+                timeline_policies.append((global_time, items))
+
+        except (ValueError, TypeError, KeyError, IndexError):
+            if __debug__: dprint("invalid snapshot", exception=True, level="warning")
+            return False
+
+        self._members = timeline_members
+        self._policies = timeline_policies
+        self._permissions = {}
+        for member, lst in timeline_members.iteritems():
+            for global_time, permissions in lst:
+                for key, value in permissions.iteritems():
+                    self._index_permission(member, key, global_time, value)
+        return True
+
+    def _load_proofs(self, proofs):
+        """
+        Replaces the sync table identifiers in PROOFS, as restored by load_snapshot, with the
+        messages that they refer to.  PROOFS is modified in place and returned.
+        """
+        packet_ids = [proof for proof in proofs if isinstance(proof, (int, long))]
+        if packet_ids:
+            community = self._community
+            packets = dict(community.dispersy.database.execute(u"SELECT id, packet FROM sync WHERE id IN (" + ", ".join("?" for _ in packet_ids) + ")", packet_ids))
+            messages = []
+            for proof in proofs:
+                if isinstance(proof, (int, long)):
+                    message = community.dispersy.convert_packet_to_message(str(packets[proof]), community, verify=False) if proof in packets else None
+                    if message:
+                        message.packet_id = proof
+                        messages.append(message)
+                    elif __debug__:
+                        dprint("unable to load proof ", proof, level="warning")
+                else:
+                    messages.append(proof)
+            proofs[:] = messages
+        return proofs
@@ -8,7 +8,7 @@ import signal
 from ..callback import Callback
 from ..dispersy import Dispersy
 from ..dprint import dprint
-from ..endpoint import StandaloneEndpoint
+from ..endpoint import MMSG_AVAILABLE, MMsgEndpoint, StandaloneEndpoint
 from threading import currentThread
 
 def watchdog(dispersy):
@@ -80,7 +80,7 @@ def main_real(setup=None):
     #     dispersy.endpoint = TunnelEndpoint(swift_process, dispersy)
     #     swift_process.add_download(dispersy.endpoint)
     # else:
-    dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip)
+    dispersy.endpoint = (MMsgEndpoint if MMSG_AVAILABLE else StandaloneEndpoint)(dispersy, opt.port, opt.ip)
     dispersy.endpoint.start()
     
 
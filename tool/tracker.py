@@ -47,7 +47,7 @@ from ..conversion import BinaryConversion
 from ..crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
 from ..dispersy import Dispersy
 from ..dprint import dprint
-from ..endpoint import StandaloneEndpoint
+from ..endpoint import MMSG_AVAILABLE, MMsgEndpoint, StandaloneEndpoint
 from ..member import DummyMember, Member
 
 if sys.platform == 'win32':
@@ -137,6 +137,10 @@ class TrackerCommunity(Community):
     def initiate_conversions(self):
         return [BinaryTrackerConversion(self, "\x00")]
 
+    def get_packet_prefixes(self):
+        # conversions are created when a packet is received
+        return None
+
     def get_conversion(self, prefix=None):
         if not prefix in self._conversions:
 
@@ -243,6 +247,10 @@ class TrackerDispersy(Dispersy):
     def persistent_storage_filename(self):
         return self._persistent_storage_filename
 
+    def _update_packet_filter(self):
+        # the tracker joins every community that it receives a packet for
+        self._packet_filter = None
+
     def get_community(self, cid, load=False, auto_load=True):
         try:
             return super(TrackerDispersy, self).get_community(cid, True, True)
@@ -295,9 +303,8 @@ class TrackerDispersy(Dispersy):
                 return True
 
             # check 2: does the community have any cached messages waiting to be processed
-            for meta in self._batch_cache.iterkeys():
-                if meta.community == community:
-                    return True
+            if community in self._batch_cache:
+                return True
 
             # the community is inactive
             return False
@@ -360,7 +367,7 @@ def main():
 
     # start Dispersy
     dispersy = TrackerDispersy.get_instance(Callback(), unicode(opt.statedir), bool(opt.silent))
-    dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip)
+    dispersy.endpoint = (MMsgEndpoint if MMSG_AVAILABLE else StandaloneEndpoint)(dispersy, opt.port, opt.ip)
     dispersy.endpoint.start()
     dispersy.define_auto_load(TrackerCommunity)
     dispersy.define_auto_load(TrackerHardKilledCommunity)